@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Compare the XML decoders available to WryDict, on the response envelopes
+used as fixtures in wry.tests.data.
+
+    $ python benchmarks/decoding.py [iterations]
+"""
+
+import sys
+import timeit
+from wry import data_structures
+from wry.config import RESOURCE_URIs
+from wry.data_structures import WryDict
+from wry.tests import data
+
+
+
+def envelopes():
+    '''Return the fixture response envelopes, as XML strings.'''
+    boot_sources = RESOURCE_URIs['CIM_BootSourceSetting']
+    pull = data.client_pull_factory()
+    docs = [
+        data.client_get(RESOURCE_URIs['AMT_BootSettingData']),
+        data.client_get(RESOURCE_URIs['CIM_BootConfigSetting']),
+        data.client_enumerate(None, None, None, boot_sources),
+        data.client_enumerate_optimized(None, None, None, boot_sources),
+    ]
+    docs.extend(pull(None, None, None, boot_sources, '25000000-0000-0000-0000-000000000000') for _ in range(3))
+    return [doc.root().string() for doc in docs]
+
+
+class _Doc(object):
+    '''Just enough of a pywsman.XmlDoc for WryDict, without pywsman's own overhead.'''
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def root(self):
+        return self
+
+    def string(self):
+        return self.xml
+
+
+def decode_all(docs, decoder):
+    data_structures.XML_DECODER = decoder
+    return [WryDict(doc) for doc in docs]
+
+
+def main(iterations=2000):
+    docs = [_Doc(xml) for xml in envelopes()]
+    original = data_structures.XML_DECODER
+    try:
+        results = dict((decoder, decode_all(docs, decoder)) for decoder in data_structures.DECODERS)
+        assert all(result == results['xmltodict'] for result in results.values()), 'The decoders disagree.'
+        timings = {}
+        for decoder in sorted(data_structures.DECODERS):
+            seconds = min(timeit.repeat(lambda: decode_all(docs, decoder), number=iterations, repeat=3))
+            timings[decoder] = seconds
+            print '%-10s %8.1f us per envelope' % (decoder, seconds / iterations / len(docs) * 1e6)
+    finally:
+        data_structures.XML_DECODER = original
+    print 'expat is %.1fx faster than xmltodict' % (timings['xmltodict'] / timings['expat'])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
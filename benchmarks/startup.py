@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Time how long a fresh interpreter takes to import wry and make an AMTDevice,
+as a short-lived script (or a cron job, or a CLI) would.
+
+    $ python benchmarks/startup.py --runs 20 --limit 50
+
+Each run is a new process. The median is reported, with the process's total
+wall time, and exits with status 1 if it is over --limit milliseconds.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from timeit import default_timer
+from stats import percentile
+
+
+# Run in each child: prints the milliseconds taken, and the modules loaded.
+CHILD = '''
+from timeit import default_timer
+started = default_timer()
+import wry
+device = wry.AMTDevice('127.0.0.1', 'http', 'user', 'pass')
+elapsed = default_timer() - started
+import json, sys
+print json.dumps({'ms': elapsed * 1000, 'modules': sorted(name for name, module in sys.modules.items() if module)})
+'''
+
+# Modules which making a device should not load.
+HEAVY = ('pywsman', 'xmltodict', 'uuid', 'ctypes', 'ssl', 'xml.sax', 'tempfile', 'ast')
+
+
+def run():
+    '''Time one new process. Returns its in-process result, and its total milliseconds.'''
+    started = default_timer()
+    output = subprocess.check_output([sys.executable, '-c', CHILD])
+    total = (default_timer() - started) * 1000
+    return json.loads(output), total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='The number of processes to time.')
+    parser.add_argument('--limit', type=float, default=50, help='The most milliseconds to allow, at the median.')
+    args = parser.parse_args(argv)
+    run() # Warm up, compiling wry if need be.
+    results = [run() for _ in range(args.runs)]
+    import_ms = sorted(result['ms'] for result, _ in results)
+    process_ms = sorted(total for _, total in results)
+    median = percentile(import_ms, .5)
+    print 'import wry + AMTDevice  p50 %6.1fms  p95 %6.1fms' % (median, percentile(import_ms, .95))
+    print 'whole process           p50 %6.1fms  p95 %6.1fms' % (percentile(process_ms, .5), percentile(process_ms, .95))
+    loaded = [name for name in HEAVY if name in results[0][0]['modules']]
+    if loaded:
+        print 'Loaded needlessly: %s' % ', '.join(loaded)
+    if median > args.limit:
+        print 'Over the limit of %.0fms.' % args.limit
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
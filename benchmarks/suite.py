@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Time wry's hot paths, and whole operations against a simulated device on
+localhost, reporting throughput and p50/p95/p99 latencies.
+
+    $ python benchmarks/suite.py --save baseline.json
+    $ python benchmarks/suite.py --compare baseline.json
+
+Give case names as arguments to run only those. With --trace, dump() is also
+timed against each device in a recording made with wry.recording.Recorder.
+"""
+
+import argparse
+import json
+import sys
+from timeit import default_timer
+from decoding import _Doc, envelopes
+from stats import percentile
+from wry import capabilities
+from wry import common
+from wry import data_structures
+from wry import recording
+from wry.data_structures import WryDict, WryOptions, _convert_values
+from wry.device import AMTDevice
+from wry.simulator import Simulator, VirtualDevice
+from wry.transport import HTTPTransport
+
+try:
+    import pywsman
+except ImportError: # Only the native options cases need openwsman.
+    pywsman = None
+
+
+def measure(func, iterations):
+    '''Call func iterations times, and return the statistics of its latencies.'''
+    func() # Warm up.
+    latencies = []
+    started = default_timer()
+    for _ in xrange(iterations):
+        before = default_timer()
+        func()
+        latencies.append(default_timer() - before)
+    elapsed = default_timer() - started
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'throughput': iterations / elapsed,
+        'p50': percentile(latencies, .5),
+        'p95': percentile(latencies, .95),
+        'p99': percentile(latencies, .99),
+    }
+
+
+def local_device(port, **kwargs):
+    '''An AMTDevice which talks to the simulated device on port.'''
+    def transport(location, _, *args):
+        return HTTPTransport(location, port, *args)
+    return AMTDevice('127.0.0.1', 'http', 'admin', 'P@ssw0rd', transport=transport, **kwargs)
+
+
+def replay_cases(path):
+    '''Cases dumping each device recorded in the trace at path, as fast as the recording can be replayed.'''
+    trace = recording.Recording(path)
+    hosts = sorted(set(key[0] for key in trace.entries))
+    devices = [AMTDevice(host, 'http', 'user', 'pass', transport=trace.transport,
+        capability_cache=capabilities.CapabilityCache()) for host in hosts]
+    return [('replay_dump', lambda: [device.dump() for device in devices], 20)]
+
+
+def native_cases(options):
+    '''Cases converting options for pywsman.Client, and copying the result.'''
+    if pywsman is None:
+        return []
+
+    def native_cold():
+        data_structures._NATIVE_OPTIONS.clear()
+        return options.native()
+
+    native = options.native()
+    return [
+        ('native_cold', native_cold, 20000),
+        ('native_warm', options.native, 50000),
+        ('get_options_copy', lambda: common.get_options_copy(native), 50000),
+    ]
+
+
+def cases(port):
+    '''Return a list of (name, function, iterations), the last few timing requests to the device on port.'''
+    docs = [_Doc(xml) for xml in envelopes()]
+    settings = WryDict(docs[0]) # AMT_BootSettingData.
+    options = WryOptions().with_selector('InstanceID', 'Intel(r) AMT: Boot Configuration 0')
+    device = local_device(port)
+
+    def set_medium():
+        device.boot.medium = 'Network'
+
+    return native_cases(options) + [
+        ('decode', lambda: [WryDict(doc) for doc in docs], 2000),
+        ('encode', settings.as_xml, 5000),
+        ('convert_values', lambda: _convert_values(settings), 10000),
+        ('build_invocation', lambda: common.build_invocation(
+            'CIM_PowerManagementService', 'RequestPowerStateChange', options,
+            resource_name='CIM_ComputerSystem', affected_item='ManagedElement',
+            selector=('Name', 'ManagedSystem', 'Intel(r) AMT Power Management Service'),
+            args_before=[('PowerState', '2')], anonymous=True), 5000),
+        ('power_state', lambda: device.power.state, 500),
+        ('power_on', device.power.turn_on, 500),
+        ('boot_medium', set_medium, 300),
+        ('dump', device.dump, 50),
+    ]
+
+
+def report(name, result, baseline=None):
+    line = '%-18s %10.0f/s  p50 %9.1fus  p95 %9.1fus  p99 %9.1fus' % (
+        name, result['throughput'], result['p50'] * 1e6, result['p95'] * 1e6, result['p99'] * 1e6)
+    if baseline:
+        line += '  p50 %+6.1f%%' % ((result['p50'] / baseline['p50'] - 1) * 100)
+    print line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*', help='The cases to run. By default, all of them.')
+    parser.add_argument('--save', metavar='PATH', help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare the results with a saved baseline.')
+    parser.add_argument('--scale', type=float, default=1, help='Multiply the number of iterations.')
+    parser.add_argument('--trace', metavar='PATH', help='Also replay a recording of real traffic.')
+    args = parser.parse_args(argv)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+    results = {}
+    simulator = Simulator()
+    port = simulator.listen(device=VirtualDevice())
+    with simulator:
+        for name, func, iterations in cases(port) + (replay_cases(args.trace) if args.trace else []):
+            if args.names and name not in args.names:
+                continue
+            results[name] = measure(func, max(1, int(iterations * args.scale)))
+            report(name, results[name], baseline.get(name))
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -30,6 +30,11 @@ setup(
     long_description=open('README.md').read(),
     url='https://github.com/ocadotechnology/wry/',
     test_suite='wry.tests',
+    entry_points={
+        'console_scripts': [
+            'wry = wry.cli:main',
+        ],
+    },
     install_requires=[
         'pywsman >= 2.5.2, < 2.6.0',
         'xmltodict >= 0.7',
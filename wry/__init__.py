@@ -12,3 +12,6 @@
 
 from wry.device import AMTDevice
 
+from wry.fleet import AMTFleet
+
+from wry.decorators import RetryPolicy
@@ -0,0 +1,647 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Non-blocking AMT device control, for holding many device conversations on a
+single thread.
+
+Every operation returns a :class:`wry.eventloop.Future`. Requests are built
+with the same code as the blocking interface, and sent over a pure-Python
+HTTP transport with digest authentication, rather than through openwsman.
+"""
+
+import errno
+import logging
+import socket
+import ssl
+import sys
+from collections import deque
+from functools import wraps
+from time import time
+from wry import common
+from wry import decorators
+from wry import exceptions
+from wry import health
+from wry import instrumentation
+from wry import wsman
+from wry.config import ENUMERATION_MAX_ELEMENTS, RESOURCE_URIs
+from wry.data_structures import WryDict, WryOptions
+from wry.device import AMTBoot, AMTKVM, AMTPower, DeviceCapability, AMT_KVM_ENABLEMENT_MAP, AMT_POWER_STATE_MAP
+from wry.eventloop import Future, Return, coroutine, get_event_loop, sleep
+
+
+
+LOG = logging.getLogger(__name__)
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class AsyncTransport(object):
+    '''
+    A non-blocking WS-Man client. Its methods take the same arguments as
+    those of pywsman.Client, but return Futures.
+
+    A Future's result is an XmlDoc, or None if the device could not be
+    reached, mirroring pywsman.Client.
+    '''
+
+    def __init__(self, location, port, path, protocol, username, password,
+        loop=None, timeout=60, max_connections=2, ssl_context=None):
+        '''
+        :param timeout: Seconds to allow for each request, including connecting,
+        if its options do not set a timeout.
+        :param max_connections: The maximum number of requests in flight to
+        this device at once. Further requests are queued.
+        :param ssl_context: An ssl.SSLContext used when protocol is https.
+        Defaults to ssl.create_default_context().
+        '''
+        self.host = location
+        self.port = port
+        self.path = path
+        self.scheme = protocol
+        self.url = '%s://%s:%s%s' % (protocol, location, port, path)
+        self.loop = loop or get_event_loop()
+        self.timeout = timeout
+        self.auth = wsman.DigestAuth(username, password)
+        self.ssl_context = ssl_context
+        self.dumpfile = None
+        self._idle = []
+        self._slots = max_connections
+        self._waiters = deque()
+
+    def new_options(self):
+        return WryOptions()
+
+    def set_dumpfile(self, dumpfile):
+        '''Write requests to dumpfile when the options' dump flag is set.'''
+        self.dumpfile = dumpfile
+
+    def get(self, options, resource_uri):
+        return self._request(wsman.get_request(self.url, resource_uri, options), options)
+
+    def put(self, options, resource_uri, data, length=None):
+        return self._request(wsman.put_request(self.url, resource_uri, data, options), options)
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        return self._request(wsman.enumerate_request(self.url, resource_uri, options, wsman_filter), options)
+
+    def pull(self, options, wsman_filter, resource_uri, context):
+        return self._request(wsman.pull_request(self.url, resource_uri, context, options), options)
+
+    def invoke(self, options, resource_uri, method, data):
+        return self._request(wsman.invoke_request(self.url, resource_uri, method, data, options), options)
+
+    def identify(self, options=None):
+        return self._request(wsman.identify_request(), options)
+
+    def _request(self, envelope, options):
+        if self.dumpfile is not None and getattr(options, 'get_flags', lambda: 0)() & wsman.FLAG_DUMP_REQUEST:
+            self.dumpfile.write(envelope + '\n')
+            self.dumpfile.flush()
+        return self._send(envelope, getattr(options, 'timeout', None) or self.timeout)
+
+    @coroutine
+    def _send(self, envelope, timeout):
+        if isinstance(envelope, unicode):
+            envelope = envelope.encode('utf-8')
+        yield self._acquire()
+        try:
+            response = yield self._post(envelope, time() + timeout)
+        except (socket.error, EOFError) as error:
+            LOG.debug('Request to %s failed: %s', self.url, error)
+            response = None
+        finally:
+            self._release()
+        if response is None:
+            raise Return(None)
+        if response.status == 401:
+            LOG.warning('Authentication with %s failed.', self.url)
+            raise Return(None)
+        if not response.body:
+            raise Return(None)
+        try:
+            raise Return(wsman.XmlDoc(response.body))
+        except wsman.ElementTree.ParseError as error:
+            raise exceptions.XMLParseError('Could not parse the response from %s: %s' % (self.url, error))
+
+    @coroutine
+    def _post(self, envelope, deadline):
+        challenges = 0
+        while True:
+            reused = bool(self._idle)
+            sock = self._idle.pop() if reused else (yield self._open(deadline))
+            headers = [('Content-Type', 'application/soap+xml;charset=UTF-8')]
+            if self.auth.ready:
+                headers.append(('Authorization', self.auth.header('POST', self.path)))
+            request = wsman.http_request('POST', '%s:%s' % (self.host, self.port), self.path, envelope, headers)
+            try:
+                response = yield self._exchange(sock, request, deadline)
+            except (socket.error, EOFError):
+                sock.close()
+                if reused:
+                    continue # The device closed an idle connection; try a fresh one.
+                raise
+            if response.keep_alive:
+                self._idle.append(sock)
+            else:
+                sock.close()
+            challenge = response.headers.get('www-authenticate')
+            if response.status == 401 and challenge and challenges < 2:
+                challenges += 1
+                self.auth.update(challenge)
+                continue
+            raise Return(response)
+
+    @coroutine
+    def _open(self, deadline):
+        address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(address[0], address[1], address[2])
+        sock.setblocking(False)
+        try:
+            try:
+                sock.connect(address[4])
+            except socket.error as error:
+                if error.errno not in _WOULD_BLOCK:
+                    raise
+                yield self._wait(sock, deadline, writable=True)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise socket.error(error, 'Could not connect to %s' % self.url)
+            if self.scheme == 'https':
+                context = self.ssl_context or ssl.create_default_context()
+                sock = context.wrap_socket(sock, server_hostname=self.host, do_handshake_on_connect=False)
+                while True:
+                    try:
+                        sock.do_handshake()
+                        break
+                    except ssl.SSLWantReadError:
+                        yield self._wait(sock, deadline)
+                    except ssl.SSLWantWriteError:
+                        yield self._wait(sock, deadline, writable=True)
+        except Exception:
+            sock.close()
+            raise
+        raise Return(sock)
+
+    @coroutine
+    def _exchange(self, sock, request, deadline):
+        while request:
+            try:
+                sent = sock.send(request)
+            except ssl.SSLWantWriteError:
+                yield self._wait(sock, deadline, writable=True)
+            except socket.error as error:
+                if error.errno not in _WOULD_BLOCK:
+                    raise
+                yield self._wait(sock, deadline, writable=True)
+            else:
+                request = request[sent:]
+        parser = wsman.HTTPParser()
+        while True:
+            try:
+                data = sock.recv(65536)
+            except ssl.SSLWantReadError:
+                yield self._wait(sock, deadline)
+                continue
+            except socket.error as error:
+                if error.errno not in _WOULD_BLOCK:
+                    raise
+                yield self._wait(sock, deadline)
+                continue
+            if not data:
+                if parser.eof():
+                    raise Return(parser)
+                raise EOFError('Connection to %s closed mid-response.' % self.url)
+            if parser.feed(data):
+                raise Return(parser)
+
+    def _wait(self, sock, deadline, writable=False):
+        '''A Future which completes when sock is ready, or fails with socket.timeout at deadline.'''
+        future = Future()
+        fd = sock.fileno()
+        remove = self.loop.remove_writer if writable else self.loop.remove_reader
+
+        def ready():
+            remove(fd)
+            timer.cancel()
+            future.set_result(None)
+
+        def expired():
+            remove(fd)
+            future.set_exception(socket.timeout('Request to %s timed out.' % self.url))
+
+        timer = self.loop.call_later(max(0, deadline - time()), expired)
+        (self.loop.add_writer if writable else self.loop.add_reader)(fd, ready)
+        return future
+
+    def _acquire(self):
+        future = Future()
+        if self._slots:
+            self._slots -= 1
+            future.set_result(None)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def _release(self):
+        if self._waiters:
+            self._waiters.popleft().set_result(None)
+        else:
+            self._slots += 1
+
+
+def retry(infunc):
+    '''As decorators.retry, for coroutines.'''
+    @coroutine
+    @wraps(infunc)
+    def newfunc(*args, **kwargs):
+        policy = decorators.get_retry_policy(kwargs)
+        started = time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = yield infunc(*args, **kwargs)
+            except Exception as error:
+                exc_info = sys.exc_info()
+                delay = policy.next_delay(error, attempt, started)
+                if delay is None:
+                    decorators.record_attempts(error, attempt)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                decorators.record_attempts(result, attempt)
+                raise Return(result)
+            yield sleep(delay, loop=getattr(args[0], 'loop', None)) # The client's loop, which may not be the default.
+    return newfunc
+
+
+def check_health(infunc):
+    '''As decorators.check_health, for coroutines.'''
+    @coroutine
+    @wraps(infunc)
+    def newfunc(*args, **kwargs):
+        endpoint = health.client_endpoint(args[0])
+        if endpoint is not None:
+            health.REGISTRY.before(endpoint)
+        reachable = True
+        try:
+            result = yield infunc(*args, **kwargs)
+        except exceptions.AMTConnectFailure:
+            reachable = False
+            raise
+        finally:
+            if endpoint is not None:
+                health.REGISTRY.record(endpoint, reachable)
+        raise Return(result)
+    return newfunc
+
+
+def instrument(action):
+    '''As instrumentation.instrument, for coroutines. Phases are not reported.'''
+    def decorator(infunc):
+        @wraps(infunc)
+        def newfunc(*args, **kwargs):
+            if not instrumentation._hooks:
+                return infunc(*args, **kwargs)
+            started = time()
+            future = infunc(*args, **kwargs)
+
+            def done(future):
+                error = future.exception()
+                result = future.result() if error is None else None
+                instrumentation.emit(action, args, kwargs, time() - started, result, error)
+
+            future.add_done_callback(done)
+            return future
+        return newfunc
+    return decorator
+
+
+@instrument('Get')
+@retry
+@check_health
+@coroutine
+def wsman_get(client, resource_uri, options=None, silent=False):
+    doc = yield client.get(options, resource_uri)
+    raise Return(common._validate(doc, silent=silent))
+
+
+@instrument('Pull')
+@retry
+@check_health
+@coroutine
+def wsman_pull(client, resource_uri, options=None, wsman_filter=None, context=None, silent=False):
+    doc = yield client.pull(options, wsman_filter, resource_uri, context)
+    raise Return(common._validate(doc, silent=silent))
+
+
+@instrument('Enumerate')
+@retry
+@check_health
+@coroutine
+def wsman_enumerate(client, resource_uri, options=None, wsman_filter=None, silent=False):
+    doc = yield client.enumerate(options, wsman_filter, resource_uri)
+    raise Return(common._validate(doc, silent=silent))
+
+
+@instrument('Put')
+@retry
+@check_health
+@coroutine
+def wsman_put(client, resource_uri, data, options=None, silent=False):
+    doc = yield client.put(options, resource_uri, str(data), len(data))
+    raise Return(common._validate(doc, silent=silent))
+
+
+@instrument('Invoke')
+@retry
+@check_health
+@coroutine
+def wsman_invoke(client, resource_uri, method, data=None, options=None, silent=False):
+    doc = yield client.invoke(options, resource_uri, str(method), data)
+    raise Return(common._validate(doc, silent=silent))
+
+
+@coroutine
+def get_resource(client, resource_name, options=None, as_xmldoc=False):
+    doc = yield wsman_get(client, RESOURCE_URIs[resource_name], options=options)
+    raise Return(doc if as_xmldoc else WryDict(doc))
+
+
+@coroutine
+def enumerate_resource(client, resource_name, wsman_filter=None, options=None, max_elements=ENUMERATION_MAX_ELEMENTS):
+    '''As common.enumerate_resource.'''
+    uri = RESOURCE_URIs[resource_name]
+    options = common._enumeration_options(options, max_elements)
+    doc = yield wsman_enumerate(client, uri, options=options, wsman_filter=wsman_filter)
+    response = WryDict(doc)['EnumerateResponse']
+    output = {resource_name: common._enumerated_items(response, resource_name)}
+    while 'EndOfSequence' not in response:
+        context = response['EnumerationContext']
+        doc = yield wsman_pull(client, uri, context=str(context), options=options, wsman_filter=wsman_filter)
+        response = WryDict(doc)['PullResponse']
+        response.setdefault('EnumerationContext', context)
+        output[resource_name].extend(common._enumerated_items(response, resource_name))
+    raise Return(output)
+
+
+@coroutine
+def put_resource(client, indict, options=None, uri=None, silent=False):
+    if not uri:
+        uri = RESOURCE_URIs[indict.keys()[0]]
+    doc = yield wsman_put(client, uri, indict.as_xml(), options=options, silent=silent)
+    raise Return(WryDict(doc))
+
+
+@coroutine
+def invoke_method(service_name, method_name, options, client, **kwargs):
+    '''As common.invoke_method, sharing its request building.'''
+    service_uri, xml, options = common.build_invocation(service_name, method_name, options, **kwargs)
+    doc = yield wsman_invoke(client, service_uri, method_name, xml, options=options)
+    raise Return(common.method_return(doc, method_name))
+
+
+class AsyncAMTDevice(object):
+    '''
+    A non-blocking counterpart to :class:`wry.AMTDevice`.
+
+    >>> dev = AsyncAMTDevice(address, 'http', username, password)
+    >>> loop = get_event_loop()
+    >>> loop.run_until_complete(dev.power.turn_on())
+    '''
+
+    def __init__(self, location, protocol, username, password, loop=None, retry_policy=None, **kwargs):
+        '''
+        :param retry_policy: As for AMTDevice.
+        Further keyword arguments are passed to AsyncTransport.
+        '''
+        port = common.AMT_PROTOCOL_PORT_MAP[protocol]
+        path = '/wsman'
+        self.client = AsyncTransport(location, port, path, protocol, username, password, loop=loop, **kwargs)
+        self.options = WryOptions(retry_policy=retry_policy)
+
+        self.boot = AsyncAMTBoot(self.client, self.options)
+        self.power = AsyncAMTPower(self.client, self.options)
+        self.kvm = AsyncAMTKVM(self.client, self.options)
+
+    @property
+    def debug(self):
+        return self.options.dump_request
+
+    @debug.setter
+    def debug(self, value):
+        self.options = self.options.with_dump_request(value)
+        for capability in (self.boot, self.power, self.kvm):
+            capability.options = self.options
+
+    def get_resource(self, resource_name, as_xmldoc=False):
+        return get_resource(self.client, resource_name, options=self.options, as_xmldoc=as_xmldoc)
+
+    def enumerate_resource(self, resource_name):
+        return enumerate_resource(self.client, resource_name, options=self.options)
+
+    def put_resource(self, data, uri=None, silent=False):
+        return put_resource(self.client, data, options=self.options, uri=uri, silent=silent)
+
+
+class AsyncDeviceCapability(DeviceCapability):
+    '''
+    A DeviceCapability whose requests return Futures. Methods inherited from
+    the blocking capabilities which only invoke a method (eg.
+    AMTPower.turn_off) therefore work unchanged.
+    '''
+
+    @coroutine
+    def get(self, resource_name=None, setting=None):
+        if not resource_name:
+            resource_name = self.resource_name
+        resource = yield get_resource(self.client, resource_name, options=self.options)
+        if setting:
+            raise Return(resource[resource_name][setting])
+        raise Return(resource[resource_name])
+
+    @coroutine
+    def put(self, resource_name=None, input_dict=None, silent=False, as_update=True):
+        if not resource_name:
+            resource_name = self.resource_name
+        if as_update:
+            resource = yield get_resource(self.client, resource_name, options=self.options)
+            resource[resource_name].update(input_dict)
+        else:
+            resource = WryDict({resource_name: input_dict})
+        response = yield put_resource(self.client, resource, silent=silent, options=self.options)
+        raise Return(response)
+
+    def walk(self, resource_name, wsman_filter=None):
+        return enumerate_resource(self.client, resource_name, wsman_filter=wsman_filter, options=self.options)
+
+    def invoke_method(self, **kwargs):
+        return invoke_method(options=self.options, client=self.client, **kwargs)
+
+
+class AsyncAMTPower(AsyncDeviceCapability, AMTPower):
+    '''Control over a device's power state.'''
+
+    @property
+    def state(self):
+        '''A Future for the device's power state, as a StateMap.'''
+        return self._state()
+
+    @coroutine
+    def _state(self):
+        response = yield self.get(setting='PowerState')
+        raise Return(AMT_POWER_STATE_MAP[response])
+
+    @coroutine
+    def toggle(self):
+        '''If the device is off, turn it on. If it is on, turn it off.'''
+        state = yield self.state
+        if state.state == 'on':
+            result = yield self.turn_off()
+        elif state.state == 'off':
+            result = yield self.turn_on()
+        else:
+            raise ValueError('Cannot toggle a device in power state %r.' % (state, ))
+        raise Return(result)
+
+
+class AsyncAMTKVM(AsyncDeviceCapability, AMTKVM):
+    '''
+    Control over a device's KVM (VNC) functionality.
+
+    Properties return Futures, and are read-only. Use the set_* methods to
+    change settings.
+    '''
+
+    @property
+    def enabled(self):
+        return self._enabled()
+
+    @coroutine
+    def _enabled(self):
+        e_state = yield self.get('CIM_KVMRedirectionSAP', 'EnabledState')
+        raise Return(AMT_KVM_ENABLEMENT_MAP[e_state].state)
+
+    def set_enabled(self, value):
+        if value is True:
+            return self.request_state_change('CIM_KVMRedirectionSAP', 2)
+        elif value is False:
+            return self.request_state_change('CIM_KVMRedirectionSAP', 3)
+        else:
+            raise TypeError('Please specify Either True or False.')
+
+    @property
+    def port_5900_enabled(self):
+        return self.get('IPS_KVMRedirectionSettingData', 'Is5900PortEnabled')
+
+    def set_port_5900_enabled(self, value):
+        return self.put('IPS_KVMRedirectionSettingData', {'Is5900PortEnabled': value})
+
+    @property
+    def default_screen(self):
+        return self.get('IPS_KVMRedirectionSettingData', 'DefaultScreen')
+
+    def set_default_screen(self, value):
+        return self.put('IPS_KVMRedirectionSettingData', {'DefaultScreen': value})
+
+    @property
+    def opt_in_timeout(self):
+        return self._opt_in_timeout()
+
+    @coroutine
+    def _opt_in_timeout(self):
+        settings = yield self.get('IPS_KVMRedirectionSettingData')
+        if not settings['OptInPolicy']:
+            raise Return(0)
+        raise Return(settings['OptInPolicyTimeout'])
+
+    def set_opt_in_timeout(self, value):
+        if not value:
+            return self.put('IPS_KVMRedirectionSettingData', {'OptInPolicy': False})
+        return self.put('IPS_KVMRedirectionSettingData', {'OptInPolicy': True, 'OptInPolicyTimeout': value})
+
+    @property
+    def session_timeout(self):
+        return self.get('IPS_KVMRedirectionSettingData', 'SessionTimeout')
+
+    def set_session_timeout(self, value):
+        return self.put('IPS_KVMRedirectionSettingData', {'SessionTimeout': value})
+
+
+class AsyncAMTBoot(AsyncDeviceCapability, AMTBoot):
+    '''
+    Control how the machine will boot next time.
+
+    Properties return Futures, and are read-only. Use set_medium to choose the
+    boot medium.
+    '''
+
+    @property
+    def supported_media(self):
+        return self._supported_media()
+
+    @coroutine
+    def _supported_media(self):
+        if self._sources is None:
+            returned = yield self.walk('CIM_BootSourceSetting')
+            self._remember_sources(returned)
+        raise Return([boot_string.split(':')[-2] for boot_string, _ in self._sources])
+
+    @property
+    def medium(self):
+        raise NotImplementedError('It is not currently possible to detect which medium a device will boot from.')
+
+    @coroutine
+    def set_medium(self, value):
+        '''Set boot medium for next boot. Sends the same requests as AMTBoot.medium.'''
+        remembered = self._sources is not None and self._config_instance is not None
+        if self._sources is None:
+            returned = yield self.walk('CIM_BootSourceSetting')
+            self._remember_sources(returned)
+        instance_id = self._source_id(value)
+        if self._config_instance is None:
+            boot_config = yield self.get('CIM_BootConfigSetting')
+            self._config_instance = str(boot_config['InstanceID'])
+        try:
+            response = yield self._change_boot_order(instance_id)
+        except exceptions.WSManFault:
+            if not remembered:
+                raise
+            self.forget()
+            response = yield self.set_medium(value)
+            raise Return(response)
+        yield self._set_boot_config_role()
+        raise Return(response)
+
+    @property
+    def config(self):
+        return self.get('AMT_BootSettingData')
+
+    @coroutine
+    def _set_boot_config_role(self, enabled_state=True):
+        if enabled_state == True:
+            role = '1'
+        elif enabled_state == False:
+            role = '32768'
+        if not self._service_checked:
+            svc = yield self.get('CIM_BootService')
+            assert svc['ElementName'] == 'Intel(r) AMT Boot Service'
+            self._service_checked = True
+        result = yield self.invoke_method(
+            service_name='CIM_BootService',
+            resource_name='CIM_BootConfigSetting',
+            affected_item='BootConfigSetting',
+            method_name='SetBootConfigRole',
+            selector=('InstanceID', 'Intel(r) AMT: Boot Configuration 0', ),
+            args_after=[('Role', role)],
+        )
+        raise Return(result)
@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Caching of resources fetched from a device.
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+from time import time
+from wry.config import RESOURCE_CACHE_SIZE, RESOURCE_CACHE_TTL, RESOURCE_DEPENDENCIES
+from wry.data_structures import WryDict
+
+
+
+def _copy(resource):
+    '''Copy a WryDict deeply enough that the copy can be modified and put.'''
+    output = WryDict((name, copy.deepcopy(value)) for name, value in resource.items())
+    for attr in ('from_xml', 'source_doc'):
+        if hasattr(resource, attr):
+            setattr(output, attr, getattr(resource, attr))
+    return output
+
+
+class ResourceCache(object):
+    '''
+    A per-device cache of resources, keyed by resource name and the
+    selectors they were fetched with, as (name, value) pairs.
+
+    Entries expire ttl seconds after they were fetched, and the least recently
+    used entries are evicted once there are more than max_size of them.
+    Writing to a resource, or invoking a method on a service, invalidates it
+    along with any resources listed for it in config.RESOURCE_DEPENDENCIES.
+
+    hits and misses count lookups, to help with choosing a ttl.
+    '''
+
+    def __init__(self, ttl=RESOURCE_CACHE_TTL, max_size=RESOURCE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, resource_name, selectors=()):
+        '''Return a copy of a fresh cached resource, or None.'''
+        key = (resource_name, tuple(selectors))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time():
+                self.misses += 1
+                return None
+            self._entries[key] = entry # Most recently used last.
+            self.hits += 1
+        return _copy(entry[1])
+
+    def set(self, resource_name, resource, selectors=()):
+        key = (resource_name, tuple(selectors))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time() + self.ttl, _copy(resource))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *resource_names):
+        '''Forget the named resources, whatever their selectors, and any resources they affect.'''
+        affected = set(resource_names)
+        for name in resource_names:
+            affected.update(RESOURCE_DEPENDENCIES.get(name, []))
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in affected]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
@@ -0,0 +1,112 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+What each device's firmware supports, as learned by AMTDevice.probe(), so that
+resources a device is known not to support are not requested from it again.
+
+Devices share CACHE unless they are given a CapabilityCache of their own. To
+keep what has been learned between runs, give it a path:
+
+>>> cache = CapabilityCache('/var/cache/wry/capabilities.json')
+>>> dev = AMTDevice(address, 'http', username, password, capability_cache=cache)
+"""
+
+import json
+import os
+import threading
+from collections import namedtuple
+
+
+
+class Capabilities(namedtuple('Capabilities', ['product_version', 'unsupported'])):
+    '''
+    product_version is as reported by the device's Identify response, eg.
+    u'AMT 11.8'. unsupported is a frozenset of the names of the resources
+    which faulted as not supported (see config.UNSUPPORTED_FAULTS) when the
+    device was probed.
+    '''
+
+    def supports(self, resource_name):
+        return resource_name not in self.unsupported
+
+
+class CapabilityCache(object):
+    '''
+    Capabilities, keyed by device address. An entry is only valid for the
+    firmware version it was learned from.
+
+    If path is given, entries are loaded from that JSON file, and it is
+    rewritten whenever one is set. The firmware may have changed since a
+    loaded entry was saved, so it is not returned until it has been checked,
+    by a get() with the device's current product_version. Instances are
+    thread-safe.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as infile:
+                for address, entry in json.load(infile).items():
+                    self._entries[address] = Capabilities(entry['product_version'], frozenset(entry['unsupported']))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, address, product_version=None):
+        '''
+        Return the Capabilities known for address, or None. If product_version
+        is given, entries learned from other firmware are ignored. If not,
+        entries loaded from path which have not been checked are ignored.
+        '''
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None:
+                return None
+            if product_version is None:
+                return entry if address in self._checked else None
+            if entry.product_version != product_version:
+                return None
+            self._checked.add(address)
+        return entry
+
+    def set(self, address, capabilities):
+        with self._lock:
+            self._entries[address] = capabilities
+            self._checked.add(address)
+            if self.path:
+                self._save()
+
+    def discard(self, address):
+        with self._lock:
+            self._entries.pop(address, None)
+            self._checked.discard(address)
+            if self.path:
+                self._save()
+
+    def _save(self):
+        output = dict(
+            (address, {'product_version': entry.product_version, 'unsupported': sorted(entry.unsupported)})
+            for address, entry in self._entries.items()
+        )
+        directory = os.path.dirname(os.path.abspath(self.path))
+        import tempfile
+        fd, temporary = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(output, outfile, indent=4, sort_keys=True)
+        os.rename(temporary, self.path) # Readers never see a partly written file.
+
+
+CACHE = CapabilityCache()
@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+The wry command: run an operation across the devices in an inventory, many at
+once, and write a line of JSON for each as it finishes.
+
+    $ wry --inventory hosts.txt --concurrency 100 power state | jq -c 'select(.ok | not)'
+    $ echo '10.0.0.0/24 admin' | WRY_PASSWORD=secret wry boot set Network
+
+An inventory has one device per line: its host, then optionally a username and
+a password, separated by whitespace. A host may be a network in CIDR notation,
+standing for each address in it. Lines may instead be JSON objects, with
+"host", "username", "password" and "protocol" keys. Blank lines and those
+starting with # are skipped. Missing credentials are taken from --username and
+--password, or else from the WRY_USERNAME and WRY_PASSWORD environment
+variables.
+
+Each output line has the host, the operation, whether it succeeded ("ok"),
+the seconds taken, and either its "result" or the "error" (the exception's
+name) and "message" it failed with. The exit status is 0 when every device
+succeeded, and 1 otherwise.
+"""
+
+import argparse
+import errno
+import json
+import logging
+import os
+import sys
+from collections import namedtuple, OrderedDict
+from time import time
+from wry import common
+from wry import instrumentation
+from wry.config import FLEET_MAX_WORKERS
+from wry.device import AMTDevice
+from wry.discovery import iter_addresses
+from wry.fleet import AMTFleet
+from wry.transport import HTTPTransport
+
+
+
+LOG = logging.getLogger(__name__)
+
+
+def log_request(measurement):
+    '''An instrumentation hook logging each request at DEBUG level, for --verbose.'''
+    outcome = measurement.error or measurement.fault or 'ok'
+    LOG.debug('%s %s %s: %s in %.3fs (%d attempts)', measurement.host, measurement.action, measurement.resource_uri,
+        outcome, measurement.seconds, measurement.attempts)
+
+
+class Host(namedtuple('Host', ['host', 'username', 'password', 'protocol'])):
+    '''
+    A device in an inventory, and the credentials to use for it. Those the
+    inventory does not give are None.
+    '''
+
+
+def read_inventory(lines):
+    '''
+    Yield a Host for each device in an inventory, given as an iterable of its
+    lines. Raises ValueError for lines which cannot be read.
+    '''
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+            except ValueError as error:
+                raise ValueError('Line %d of the inventory is not valid JSON: %s' % (number, error))
+            if 'host' not in entry:
+                raise ValueError('Line %d of the inventory has no host.' % number)
+            fields = [entry['host'], entry.get('username'), entry.get('password'), entry.get('protocol')]
+        else:
+            fields = line.split()
+            if len(fields) > 3:
+                raise ValueError('Line %d of the inventory has more than a host, username and password.' % number)
+            fields += [None] * (4 - len(fields))
+        if '/' in fields[0]:
+            for address in iter_addresses([fields[0]]):
+                yield Host(address, *fields[1:])
+        else:
+            yield Host(*fields)
+
+
+def _dump(device):
+    resources = OrderedDict()
+    unavailable = []
+    for name, resource in sorted(device.iter_dump()):
+        if isinstance(resource, Exception):
+            unavailable.append(name)
+        else:
+            resources.update(resource)
+    return {'resources': resources, 'unavailable': unavailable}
+
+
+def _set_medium(device, medium):
+    device.boot.medium = medium
+
+
+def _set_kvm(enabled):
+    def operation(device):
+        device.kvm.enabled = enabled
+    return operation
+
+
+# Operations, by name, as functions of a device and the operation's arguments.
+OPERATIONS = OrderedDict([
+    ('power state', lambda device: device.power.state._asdict()),
+    ('power on', lambda device: device.power.turn_on()),
+    ('power off', lambda device: device.power.turn_off()),
+    ('power reset', lambda device: device.power.reset()),
+    ('boot media', lambda device: device.boot.supported_media),
+    ('boot config', lambda device: device.boot.config),
+    ('boot set', _set_medium),
+    ('kvm state', lambda device: device.kvm.enabled),
+    ('kvm enable', _set_kvm(True)),
+    ('kvm disable', _set_kvm(False)),
+    ('identify', lambda device: common.identify(device.client, options=device.options)),
+    ('dump', _dump),
+])
+
+# The arguments taken by those operations which take any.
+ARGUMENTS = {
+    'boot set': ['MEDIUM'],
+}
+
+TRANSPORTS = {
+    'pywsman': None, # AMTDevice's default.
+    'http': HTTPTransport,
+}
+
+
+def parse_operation(words):
+    '''Return the name of the operation that words (eg. ['boot', 'set', 'Network']) ask for, and its arguments.'''
+    for length in (2, 1):
+        name = ' '.join(words[:length])
+        if name in OPERATIONS:
+            arguments = words[length:]
+            expected = ARGUMENTS.get(name, [])
+            if len(arguments) != len(expected):
+                raise ValueError('Usage: wry [options] %s' % ' '.join([name] + expected))
+            return name, arguments
+    raise ValueError('Unknown operation %r. Choose from: %s.' % (' '.join(words), ', '.join(OPERATIONS)))
+
+
+def _record(host, name, seconds, value=None, exception=None):
+    record = OrderedDict([('host', host), ('operation', name), ('ok', exception is None), ('seconds', seconds)])
+    if exception is None:
+        record['result'] = value
+    else:
+        record['error'] = type(exception).__name__
+        record['message'] = unicode(exception)
+    return record
+
+
+def run(devices, name, arguments=(), concurrency=FLEET_MAX_WORKERS, timeout=None, output=None):
+    '''
+    Run the named operation on each of devices, concurrency at a time, and
+    write a line of JSON to output for each as it finishes.
+
+    :param output: A file. By default, sys.stdout.
+    :returns: The number of devices on which the operation failed.
+    '''
+    output = sys.stdout if output is None else output
+    operation = OPERATIONS[name]
+    started = time()
+    seconds = {}
+
+    def timed(device):
+        begun = time()
+        try:
+            return operation(device, *arguments)
+        finally:
+            seconds[id(device)] = time() - begun
+
+    failures = 0
+    for result in AMTFleet(devices, max_workers=concurrency, timeout=timeout).run(timed):
+        if not result.ok:
+            failures += 1
+        # Devices abandoned at the deadline are reported with the time waited for them.
+        elapsed = round(seconds.get(id(result.device), time() - started), 6)
+        record = _record(result.device.location, name, elapsed, result.value, result.exception)
+        output.write(json.dumps(record, default=unicode) + '\n')
+        output.flush()
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='wry', description='Run an operation across many AMT devices at once.',
+        epilog='Operations: %s.' % ', '.join(' '.join([name] + ARGUMENTS.get(name, [])) for name in OPERATIONS))
+    parser.add_argument('operation', nargs='+', metavar='OPERATION', help='eg. "power state", or "boot set Network".')
+    parser.add_argument('-i', '--inventory', default='-',
+        help='The file listing the devices to operate on. By default, they are read from stdin.')
+    parser.add_argument('-c', '--concurrency', type=int, default=FLEET_MAX_WORKERS,
+        help='The most devices to operate on at once.')
+    parser.add_argument('-u', '--username', default=os.environ.get('WRY_USERNAME', 'admin'),
+        help='For devices the inventory gives none for.')
+    parser.add_argument('-p', '--password', default=os.environ.get('WRY_PASSWORD'),
+        help='For devices the inventory gives none for. Prefer setting WRY_PASSWORD.')
+    parser.add_argument('--protocol', choices=['http', 'https'], default='http')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='pywsman')
+    parser.add_argument('--timeout', type=float,
+        help='An overall deadline, in seconds. Devices not finished by then are reported as failed.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log requests to stderr.')
+    args = parser.parse_args(argv)
+    try:
+        name, arguments = parse_operation(args.operation)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1.')
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if args.verbose:
+        instrumentation.add_hook(log_request)
+
+    infile = sys.stdin if args.inventory == '-' else open(args.inventory)
+    try:
+        hosts = list(read_inventory(infile))
+    except ValueError as error:
+        parser.error(str(error))
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+    if not hosts:
+        parser.error('The inventory lists no devices.')
+    for host in hosts:
+        if (host.password or args.password) is None:
+            parser.error('No password for %s: give one in the inventory, with --password, or in WRY_PASSWORD.' % host.host)
+
+    devices = [
+        AMTDevice(host.host, host.protocol or args.protocol, host.username or args.username,
+            host.password or args.password, transport=TRANSPORTS[args.transport])
+        for host in hosts
+    ]
+    try:
+        failures = run(devices, name, arguments, concurrency=args.concurrency, timeout=args.timeout)
+    except KeyboardInterrupt:
+        return 130
+    except IOError as error:
+        if error.errno == errno.EPIPE: # Whatever was reading the output has stopped.
+            return 1
+        raise
+    if failures:
+        LOG.warning('%d of %d devices failed.', failures, len(devices))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
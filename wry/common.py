@@ -14,16 +14,19 @@
 Common functionalities for AMT Driver
 """
 import logging
-import pywsman
-import xmltodict
-from ast import literal_eval
+import re
+from time import time
 from xml.etree import ElementTree
 from wry import data_structures
 from wry import exceptions
-from wry.decorators import retry, add_client_options
-from wry.config import RESOURCE_URIs, SCHEMAS
-from wry.data_structures import _strip_namespace_prefixes, WryDict
-from collections import OrderedDict
+from wry import instrumentation
+from wry import wsman
+from wry.instrumentation import instrument
+from wry.decorators import retry, add_client_options, check_health
+from wry.config import (CONNECT_RETRIES, ENUMERATION_MAX_ELEMENTS, EVENT_RESOURCE_URI, EVENT_SUBSCRIPTION_EXPIRATION,
+    RESOURCE_METHODS, RESOURCE_URIs, SCHEMAS)
+from wry.data_structures import _strip_namespace_prefixes, WryDict, WryOptions
+from collections import namedtuple, OrderedDict
 
 
 
@@ -37,6 +40,83 @@ AMT_PROTOCOL_PORT_MAP = {
 }
 
 
+class Transport(object):
+    '''
+    The interface through which the wsman_* functions talk to a device.
+
+    pywsman.Client is the default transport, and implements this interface
+    natively. Other transports should subclass this, and be constructed with
+    the same arguments as pywsman.Client:
+    (location, port, path, protocol, username, password).
+
+    Each method returns a response document (see wsman.XmlDoc), or None if
+    the device could not be reached.
+
+    Subclasses which can be used from several threads at once should set
+    thread_safe.
+    '''
+
+    thread_safe = False
+
+    def new_options(self):
+        '''Return an empty options object suitable for this transport.'''
+        return WryOptions()
+
+    def set_dumpfile(self, dumpfile):
+        '''Write requests to dumpfile when the options' dump flag is set.'''
+        self.dumpfile = dumpfile
+
+    def get(self, options, resource_uri):
+        raise NotImplementedError
+
+    def put(self, options, resource_uri, data, length):
+        raise NotImplementedError
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        raise NotImplementedError
+
+    def pull(self, options, wsman_filter, resource_uri, context):
+        raise NotImplementedError
+
+    def invoke(self, options, resource_uri, method, data):
+        '''As pywsman.Client.invoke, but data is an XML string rather than a document.'''
+        raise NotImplementedError
+
+    def identify(self, options):
+        raise NotImplementedError
+
+    def subscribe(self, options, wsman_filter, resource_uri):
+        '''Events are delivered to options.delivery_uri.'''
+        raise NotImplementedError
+
+    def renew(self, options, resource_uri, identifier):
+        raise NotImplementedError
+
+    def unsubscribe(self, options, wsman_filter, resource_uri, identifier):
+        raise NotImplementedError
+
+
+def _send(client, method, *args):
+    '''
+    Call client.method(*args). For clients which do not report the phases of
+    requests (such as pywsman.Client), its wall time is measured as network,
+    and decoding the response (as WryDict will) as parse.
+    '''
+    timing = instrumentation.current()
+    if timing is None or isinstance(client, Transport):
+        return getattr(client, method)(*args)
+    started = time()
+    doc = getattr(client, method)(*args)
+    timing.network += time() - started
+    timing.build = timing.request_bytes = timing.response_bytes = None # Not known outside openwsman.
+    timing.reported = True
+    if doc is not None:
+        started = time()
+        data_structures.predecode(doc)
+        timing.parse += time() - started
+    return doc
+
+
 def _validate(doc, silent=False):
     if doc is None:
         raise exceptions.AMTConnectFailure
@@ -47,88 +127,228 @@ def _validate(doc, silent=False):
 
 
 def get_options_copy(options):
-    new_options = pywsman.ClientOptions()
-    for attr in dir(options):
-        if attr.startswith('get_'):
-            setter = attr.replace('get_', 'set_')
-            value = getattr(options, attr)()
-            getattr(options, setter)(value)
-    if options.get_flags() == 16:
-        new_options.set_dump_request()
+    '''
+    Return a copy of native options (such as pywsman.ClientOptions), carrying
+    over only their flags. WryOptions are immutable, and returned as they are.
+    '''
+    if options is None or isinstance(options, WryOptions):
+        return options or WryOptions()
+    new_options = options.__class__()
+    new_options.set_flags(options.get_flags())
     return new_options
 
 
-@add_client_options
+def _updated_options(options, flags=0, max_elements=None, selector=None):
+    '''
+    Return options with the given flags, max_elements and (name, value)
+    selector added: as a new WryOptions, or as a changed copy of native ones.
+    '''
+    if isinstance(options, WryOptions) or options is None:
+        options = (options or WryOptions()).with_flags(flags)
+        if max_elements:
+            options = options.with_max_elements(max_elements)
+        if selector:
+            options = options.with_selector(*selector)
+        return options
+    options = get_options_copy(options)
+    if flags:
+        options.set_flags(flags)
+    if max_elements:
+        options.set_max_elements(max_elements)
+    if selector:
+        options.add_selector(*selector)
+    return options
+
+
+@instrument('Get')
 @retry
+@check_health
+@add_client_options
 def wsman_get(client, resource_uri, options=None, silent=False):
     '''Get target server info'''
-    doc = client.get(options, resource_uri)
+    doc = _send(client, 'get', options, resource_uri)
     return _validate(doc, silent=silent)
 
 
-@add_client_options
+@instrument('Pull')
 @retry
+@check_health
+@add_client_options
 def wsman_pull(client, resource_uri, options=None, wsman_filter=None, context=None, silent=False):
     '''Get target server info'''
-    doc = client.pull(options, wsman_filter, resource_uri, context)
+    doc = _send(client, 'pull', options, wsman_filter, resource_uri, context)
     return _validate(doc, silent=silent)
 
 
-@add_client_options
+@instrument('Enumerate')
 @retry
+@check_health
+@add_client_options
 def wsman_enumerate(client, resource_uri, options=None, wsman_filter=None, silent=False):
     '''Get target server info'''
-    doc = client.enumerate(options, wsman_filter, resource_uri)
+    doc = _send(client, 'enumerate', options, wsman_filter, resource_uri)
     return _validate(doc, silent=silent)
 
 
-@add_client_options
+@instrument('Put')
 @retry
+@check_health
+@add_client_options
 def wsman_put(client, resource_uri, data, options=None, silent=False):
     '''Invoke method on target server
     :param silent: Ignore WSMan errors, and return the document anyway. Does not
     ignore the endpoint being down.
     '''
-    doc = client.put(options, resource_uri, str(data), len(data))
+    doc = _send(client, 'put', options, resource_uri, str(data), len(data))
     return _validate(doc, silent=silent)
 
-@add_client_options
+@instrument('Invoke')
 @retry
+@check_health
+@add_client_options
 def wsman_invoke(client, resource_uri, method, data=None, options=None, silent=False):
     '''Invoke method on target server.'''
-    doc = client.invoke(options, resource_uri, str(method), pywsman.create_doc_from_string(str(data)))
+    if not isinstance(client, Transport):
+        import pywsman
+        data = pywsman.create_doc_from_string(str(data))
+    doc = _send(client, 'invoke', options, resource_uri, str(method), data)
     return _validate(doc, silent=silent)
 
 
-def get_resource(client, resource_name, options=None, as_xmldoc=False):
+@instrument('Subscribe')
+@retry
+@check_health
+@add_client_options
+def wsman_subscribe(client, resource_uri, options=None, wsman_filter=None, silent=False):
+    '''Subscribe to events, to be pushed to the options' delivery URI.'''
+    doc = _send(client, 'subscribe', options, wsman_filter, resource_uri)
+    return _validate(doc, silent=silent)
+
+
+@instrument('Renew')
+@retry
+@check_health
+@add_client_options
+def wsman_renew(client, resource_uri, identifier, options=None, silent=False):
+    '''Extend a subscription by the options' expiration.'''
+    doc = _send(client, 'renew', options, resource_uri, identifier)
+    return _validate(doc, silent=silent)
+
+
+@instrument('Unsubscribe')
+@retry
+@check_health
+@add_client_options
+def wsman_unsubscribe(client, resource_uri, identifier, options=None, wsman_filter=None, silent=False):
+    '''Cancel a subscription.'''
+    doc = _send(client, 'unsubscribe', options, wsman_filter, resource_uri, identifier)
+    return _validate(doc, silent=silent)
+
+
+@instrument('Identify')
+@retry
+@check_health
+@add_client_options
+def wsman_identify(client, options=None, silent=False):
+    '''Ask the server what it is. Works without authentication.'''
+    doc = _send(client, 'identify', options)
+    return _validate(doc, silent=silent)
+
+
+def get_resource(client, resource_name, options=None, as_xmldoc=False, cache=None):
     '''
+    :param cache: A cache.ResourceCache to consult before the device, and to
+    store the resource in afterwards. Not used when as_xmldoc is True. Each
+    set of selectors in options is cached separately; native options are
+    taken to have none.
     '''
+    selectors = getattr(options, 'selectors', ())
+    if cache is not None and not as_xmldoc:
+        resource = cache.get(resource_name, selectors)
+        if resource is not None:
+            return resource
     uri = RESOURCE_URIs[resource_name]
     doc = wsman_get(client, uri, options=options)
     if as_xmldoc:
         return doc
-    return WryDict(doc)
+    resource = WryDict(doc)
+    if cache is not None:
+        cache.set(resource_name, resource, selectors)
+    return resource
  
 
-def enumerate_resource(client, resource_name, wsman_filter=None, options=None):
+def _enumeration_options(options, max_elements):
+    '''Options set up to fetch up to max_elements instances per round trip.'''
+    if not max_elements:
+        return get_options_copy(options)
+    return _updated_options(options, flags=wsman.FLAG_ENUMERATION_OPTIMIZATION, max_elements=max_elements)
+
+
+def _enumerated_items(response, resource_name):
+    '''The instances in an EnumerateResponse or PullResponse, as a list.'''
+    items = (response.get('Items') or {}).get(resource_name, [])
+    if not isinstance(items, list):
+        items = [items]
+    return [data_structures.decode_fields(resource_name, item) if isinstance(item, dict) else item for item in items]
+
+
+def iter_resource(client, resource_name, wsman_filter=None, options=None,
+    max_elements=ENUMERATION_MAX_ELEMENTS, context=None, resume_attempts=CONNECT_RETRIES):
     '''
-    class.
+    Enumerate the instances of a resource, yielding each one as the response
+    containing it arrives.
+
+    :param max_elements: The number of instances to ask for in each round
+    trip, using WS-Man optimized enumeration. If 0 or None, instances are
+    pulled one at a time.
+    :param context: The EnumerationContext of an interrupted enumeration, to
+    resume it instead of starting a new one.
+    :param resume_attempts: The number of times a Pull which fails with
+    AMTConnectFailure is reattempted with the same context. If the
+    enumeration still cannot continue, the AMTConnectFailure is raised with
+    the context attached as its context attribute.
     '''
     uri = RESOURCE_URIs[resource_name]
-    doc = wsman_enumerate(client, uri, options=options) # Add in relevant kwargs... filter?
-    doc = WryDict(doc)
-    context = doc['EnumerateResponse']['EnumerationContext']
-    ended = False
-    output = {resource_name: []}
-    while ended is False:
-        doc = wsman_pull(client, uri, context=str(context), options=options)
+    options = _enumeration_options(options, max_elements)
+    if context is None:
+        doc = wsman_enumerate(client, uri, options=options, wsman_filter=wsman_filter)
+        response = WryDict(doc)['EnumerateResponse']
+        for item in _enumerated_items(response, resource_name):
+            yield item
+        if 'EndOfSequence' in response:
+            return
+        context = response['EnumerationContext']
+    failures = 0
+    while True:
+        try:
+            doc = wsman_pull(client, uri, context=str(context), options=options, wsman_filter=wsman_filter)
+        except exceptions.AMTConnectFailure as error:
+            failures += 1
+            if failures > resume_attempts:
+                error.context = context
+                raise
+            continue
+        failures = 0
         response = WryDict(doc)['PullResponse']
-        ended = response.pop('EndOfSequence', False)
-        output[resource_name].append(response['Items'][resource_name])
-    return output
+        for item in _enumerated_items(response, resource_name):
+            yield item
+        if 'EndOfSequence' in response:
+            return
+        context = response.get('EnumerationContext', context)
 
 
-def put_resource(client, indict, options=None, uri=None, silent=False):
+def enumerate_resource(client, resource_name, wsman_filter=None, options=None, max_elements=ENUMERATION_MAX_ELEMENTS):
+    '''
+    Enumerate the instances of a resource.
+
+    :returns: A dict mapping resource_name to a list of its instances.
+    :param max_elements: See iter_resource.
+    '''
+    items = iter_resource(client, resource_name, wsman_filter=wsman_filter, options=options, max_elements=max_elements)
+    return {resource_name: list(items)}
+
+
+def put_resource(client, indict, options=None, uri=None, silent=False, cache=None):
     '''
     Given a dict or  describing a wsman resource, post this resource to the client.
     :returns: data_structures.WryDict
@@ -136,26 +356,139 @@ def put_resource(client, indict, options=None, uri=None, silent=False):
     common.RESOURCE_URIs.
     :param uri: If a mapping does not exist in common.RESOURCE_URIs, the resource URI can be specified manually here.
     :param mappings: A dictionary providing extra mappings between resource names and URIs.
+    :param cache: A cache.ResourceCache in which to invalidate the resource.
     '''
     if not uri:
         uri = RESOURCE_URIs[indict.keys()[0]] # Possible to support multiple simply here?
     data = indict.as_xml()
-    doc = wsman_put(client, uri, data, options=options, silent=silent)
+    try:
+        doc = wsman_put(client, uri, data, options=options, silent=silent)
+    finally:
+        if cache is not None:
+            cache.invalidate(*indict.keys())
     return WryDict(doc)
 
 
-def invoke_method(service_name, method_name, options, client, resource_name=None, affected_item=None, selector=None, args_before=(), args_after=(), anonymous=False):
+def load_from_dict(client, input_dict, options=None, cache=None):
     '''
-    selector should be a dictionary in the form:
-    {selector_name: {element_name: element_value}} ???
-    Change this for a tuple, I think, it will make things easier.
+    Bring a device's resources to the state described by input_dict, which is
+    in the shape returned by AMTDevice.dump. Each resource is fetched once, and
+    put once with its differing fields changed, if any differ.
+
+    Resources which cannot be put (see config.RESOURCE_METHODS) are ignored.
+
+    :returns: An OrderedDict mapping the name of each resource which was put to
+    an OrderedDict of {field: (previous value, new value)}.
+    '''
+    changes = OrderedDict()
+    for resource_name, desired in input_dict.iteritems():
+        if 'put' not in RESOURCE_METHODS.get(resource_name, ()):
+            continue
+        current = get_resource(client, resource_name, options=options, cache=cache)
+        differences = data_structures.diff_fields(resource_name, current[resource_name], desired)
+        if not differences:
+            continue
+        for field, (_, value) in differences.iteritems():
+            current[resource_name][field] = value
+        put_resource(client, current, options=options, cache=cache)
+        changes[resource_name] = differences
+    return changes
+
+
+def identify(client, options=None):
     '''
+    Return the device's IdentifyResponse, as a WryDict with ProtocolVersion,
+    ProductVendor and ProductVersion.
+    '''
+    return WryDict(wsman_identify(client, options=get_options_copy(options)))['IdentifyResponse']
+
+
+class Subscription(namedtuple('Subscription', ['resource_uri', 'identifier', 'expires'])):
+    '''
+    A WS-Eventing subscription on a device. expires is as the device reported
+    it (an xs:duration or xs:dateTime), or None.
+    '''
+
+
+def _delivery_options(options, notify_to, expiration):
+    '''Options set up to have events pushed to notify_to for expiration seconds.'''
+    if isinstance(options, WryOptions) or options is None:
+        return (options or WryOptions()).with_delivery(notify_to, expiration)
+    options = get_options_copy(options)
+    if notify_to:
+        options.set_delivery_uri(notify_to)
+    if expiration:
+        options.set_sub_expiry(int(expiration))
+    return options
+
+
+def subscribe(client, notify_to, resource_uri=EVENT_RESOURCE_URI, expiration=EVENT_SUBSCRIPTION_EXPIRATION,
+    options=None, wsman_filter=None):
+    '''
+    Have a device push events for resource_uri to the HTTP endpoint notify_to
+    (see events.EventListener), for expiration seconds.
+
+    :returns: A Subscription, for use with renew() and unsubscribe().
+    '''
+    options = _delivery_options(options, notify_to, expiration)
+    response = WryDict(wsman_subscribe(client, resource_uri, options=options, wsman_filter=wsman_filter))
+    response = response['SubscribeResponse']
+    manager = response.get('SubscriptionManager') or {}
+    identifier = (manager.get('ReferenceParameters') or {}).get('Identifier')
+    return Subscription(resource_uri, identifier, response.get('Expires'))
+
+
+def renew(client, subscription, expiration=EVENT_SUBSCRIPTION_EXPIRATION, options=None):
+    '''Extend a Subscription by expiration seconds, and return it as the device now reports it.'''
+    options = _delivery_options(options, None, expiration)
+    response = WryDict(wsman_renew(client, subscription.resource_uri, subscription.identifier, options=options))
+    return subscription._replace(expires=(response.get('RenewResponse') or {}).get('Expires'))
+
+
+def unsubscribe(client, subscription, options=None):
+    wsman_unsubscribe(client, subscription.resource_uri, subscription.identifier, options=get_options_copy(options))
+
+
+class _Template(object):
+    '''
+    An XML document with slots for text content, which are filled in by
+    render() with a list of values, in slot order.
+    '''
+
+    _SLOT = re.compile(r'@@wry-slot-(\d+)@@')
+
+    def __init__(self, xml):
+        self.parts = self._SLOT.split(xml)
+        for index in range(1, len(self.parts), 2):
+            self.parts[index] = int(self.parts[index])
+
+    @classmethod
+    def slots(cls, count):
+        '''Placeholder values which render() will replace.'''
+        return ['@@wry-slot-%d@@' % index for index in range(count)]
+
+    def render(self, values):
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            value = values[parts[index]]
+            if value is None:
+                value = u''
+            elif isinstance(value, str):
+                value = value.decode('utf-8')
+            parts[index] = wsman._escape(unicode(value))
+        return u''.join(parts)
+
+
+_INVOCATION_TEMPLATES = {}
+
+
+def _invocation_body(service_uri, method_name, resource_name=None, affected_item=None, selector=None, args_before=(), args_after=(), anonymous=False):
+    '''The XML body of a method invocation, as unparsed by xmltodict.'''
+    import xmltodict
     if anonymous:
         address_schema = 'addressing_anonymous'
     else:
         address_schema = 'addressing'
-    options = get_options_copy(options)
-    service_uri = RESOURCE_URIs[service_name]
 
     def add_arguments(data_dict, argument_pairs=()):
         for arg_name, arg_value in argument_pairs:
@@ -192,15 +525,89 @@ def invoke_method(service_name, method_name, options, client, resource_name=None
             },
             '@xmlns': SCHEMAS['wsman'],
         }
+    return xmltodict.unparse(data, full_document=False, pretty=True)
+
+
+def _invocation_template(service_name, method_name, resource_name, affected_item, selector_name, before_names, after_names, anonymous):
+    '''
+    The _Template for invocations with this signature, compiled on first use.
+    Its slots are the arguments before, the arguments after, then the selector.
+    '''
+    key = (service_name, method_name, resource_name, affected_item, selector_name, before_names, after_names, anonymous)
+    template = _INVOCATION_TEMPLATES.get(key)
+    if template is None:
+        slots = _Template.slots(len(before_names) + len(after_names) + 1)
+        selector = (selector_name, slots[-1]) if selector_name else None
+        xml = _invocation_body(
+            RESOURCE_URIs[service_name], method_name,
+            resource_name=resource_name,
+            affected_item=affected_item,
+            selector=selector,
+            args_before=zip(before_names, slots),
+            args_after=zip(after_names, slots[len(before_names):]),
+            anonymous=anonymous,
+        )
+        template = _INVOCATION_TEMPLATES[key] = _Template(xml)
+    return template
+
+
+def build_invocation(service_name, method_name, options, resource_name=None, affected_item=None, selector=None, args_before=(), args_after=(), anonymous=False):
+    '''
+    Build the body of a method invocation, from a template cached per
+    signature, so that repeated invocations only substitute their values.
+
+    :returns: A (service_uri, xml, options) tuple, where options are the
+    options passed in, with any selector needed for the invocation added.
+    '''
+    service_uri = RESOURCE_URIs[service_name]
+    template = _invocation_template(
+        service_name, method_name, resource_name, affected_item,
+        selector[0] if selector else None,
+        tuple(name for name, _ in args_before),
+        tuple(name for name, _ in args_after),
+        anonymous,
+    )
+    values = [value for _, value in args_before] + [value for _, value in args_after]
+    if selector:
+        values.append(selector[1])
         if len(selector) > 2:
             assert len(selector) == 3
-            options.add_selector(selector[0], selector[-1])
+            options = _updated_options(options, selector=(selector[0], selector[-1]))
+    return service_uri, template.render(values), options
 
-    xml = xmltodict.unparse(data, full_document=False, pretty=True)
-    doc = wsman_invoke(client, service_uri, method_name, xml, options=options)
+
+def method_return(doc, method_name):
+    '''Check the ReturnValue of an invocation's response.'''
     returned = WryDict(doc)
     return_value = returned[method_name + '_OUTPUT']['ReturnValue']
     if return_value != 0:
         raise exceptions.NonZeroReturn(return_value)
     return not return_value
 
+
+def invoke_method(service_name, method_name, options, client, resource_name=None, affected_item=None, selector=None, args_before=(), args_after=(), anonymous=False, cache=None):
+    '''
+    selector should be a dictionary in the form:
+    {selector_name: {element_name: element_value}} ???
+    Change this for a tuple, I think, it will make things easier.
+
+    :param cache: A cache.ResourceCache in which to invalidate the service,
+    the resource, and anything they affect.
+    '''
+    service_uri, xml, options = build_invocation(
+        service_name,
+        method_name,
+        options,
+        resource_name=resource_name,
+        affected_item=affected_item,
+        selector=selector,
+        args_before=args_before,
+        args_after=args_after,
+        anonymous=anonymous,
+    )
+    try:
+        doc = wsman_invoke(client, service_uri, method_name, xml, options=options)
+    finally:
+        if cache is not None:
+            cache.invalidate(*filter(None, [service_name, resource_name]))
+    return method_return(doc, method_name)
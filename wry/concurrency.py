@@ -0,0 +1,141 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Helpers for running blocking wsman calls concurrently.
+"""
+
+import sys
+import threading
+from Queue import Queue, Empty
+from time import sleep, time
+from wry import exceptions
+
+
+
+_POLL_INTERVAL = .1 # How often a waiting caller checks for cancellation
+
+
+class RateLimiter(object):
+    '''
+    Lets up to rate calls to acquire() through per second, and up to burst of
+    them at once after a lull. Instances are thread-safe.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until the caller may go ahead.'''
+        with self._lock:
+            now = time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1 # Reserve a turn, even if it is not due yet.
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+def imap_unordered(func, items, max_workers, timeout=None, cancel=None, exc_info=False):
+    '''
+    Call func on each of items from a bounded pool of worker threads, and return
+    an iterator of an (item, result, exception) tuple for each call as it
+    completes. The calls start straight away, rather than when the iterator is
+    first advanced.
+
+    :param max_workers: The maximum number of calls in progress at once.
+    :param timeout: An overall deadline, in seconds. Items which have not
+    completed by then are yielded with a DeadlineExceeded exception.
+    :param cancel: A threading.Event, or anything else with an is_set()
+    method. Once it is set, items which have not completed are yielded with an
+    OperationCancelled exception.
+    :param exc_info: If True, exceptions are yielded as sys.exc_info() triples,
+    so that the caller can re-raise them with their original tracebacks.
+
+    Once the deadline passes (or the operation is cancelled), no more calls
+    are started, whether or not the iterator is being consumed. Calls already
+    in progress cannot be interrupted. Their worker threads are abandoned, and
+    their results discarded.
+    '''
+    items = list(items)
+    if not items:
+        return iter(())
+    deadline = None if timeout is None else time() + timeout
+    pending = Queue()
+    done = Queue()
+    stop = threading.Event()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def stopped():
+        return (stop.is_set() or (cancel is not None and cancel.is_set())
+            or (deadline is not None and time() >= deadline))
+
+    def worker():
+        while not stopped():
+            try:
+                index, item = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                outcome = (item, func(item), None)
+            except Exception as exc:
+                outcome = (item, None, sys.exc_info() if exc_info else exc)
+            done.put((index, outcome))
+
+    for _ in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    return _completed(items, done, stop, deadline, timeout, cancel, exc_info)
+
+
+def _completed(items, done, stop, deadline, timeout, cancel, exc_info):
+    '''Yield the outcomes of imap_unordered's calls, as they are put on done.'''
+    outstanding = set(range(len(items)))
+    try:
+        while outstanding:
+            abandon_with = None
+            wait = _POLL_INTERVAL
+            if cancel is not None and cancel.is_set():
+                abandon_with = exceptions.OperationCancelled('The operation was cancelled.')
+            elif deadline is not None:
+                wait = min(wait, deadline - time())
+                if wait <= 0:
+                    abandon_with = exceptions.DeadlineExceeded('The operation did not complete within %ss.' % timeout)
+            if abandon_with is not None:
+                if exc_info:
+                    abandon_with = (type(abandon_with), abandon_with, None)
+                stop.set()
+                while True: # Report the calls which did complete first.
+                    try:
+                        index, outcome = done.get_nowait()
+                    except Empty:
+                        break
+                    outstanding.discard(index)
+                    yield outcome
+                for index in sorted(outstanding):
+                    yield items[index], None, abandon_with
+                return
+            try:
+                index, outcome = done.get(timeout=wait)
+            except Empty:
+                continue
+            outstanding.discard(index)
+            yield outcome
+    finally:
+        stop.set()
@@ -13,6 +13,52 @@
 
 CONNECT_RETRIES = 3 # Number of times to retry a WSMan connection
 
+RETRY_BASE_DELAY = .1 # Upper bound in seconds of the first retry's delay, doubling for each retry after
+
+RETRY_MAX_DELAY = 10 # Upper bound in seconds of any retry's delay
+
+BREAKER_THRESHOLD = 5 # Consecutive connection failures after which requests to a host fail fast
+
+BREAKER_COOLDOWN = 30 # Seconds before a host which is failing fast is tried again
+
+FLEET_MAX_WORKERS = 64 # Number of devices an AMTFleet operates on at once
+
+DEVICE_MAX_CONCURRENCY = 4 # Requests in flight to a single device at once, where that is allowed for
+
+ENUMERATION_MAX_ELEMENTS = 32 # Instances to request per round trip when enumerating
+
+RESOURCE_CACHE_TTL = 5 # Seconds for which a cached resource is considered fresh
+
+RESOURCE_CACHE_SIZE = 64 # Maximum number of resources cached per device
+
+UNSUPPORTED_FAULTS = ('DestinationUnreachable', 'ActionNotSupported') # Fault subcodes (without a prefix) of firmware lacking a resource
+
+XML_DECODER = 'expat' # How responses are decoded: 'expat', or 'xmltodict' (slower)
+
+DISCOVERY_MAX_IN_FLIGHT = 512 # Probes open at once when scanning for devices; each needs a file descriptor
+
+DISCOVERY_TIMEOUT = 3 # Seconds allowed for each probe when scanning for devices
+
+REIMAGE_WAVE_SIZE = 16 # Devices reimaged in each wave
+
+REIMAGE_STARTS_PER_SECOND = 2 # Devices which may begin reimaging each second
+
+REIMAGE_CONFIRM_TIMEOUT = 600 # Seconds to wait for a wave's devices to reach the expected power state
+
+WATCH_FAST_INTERVAL = 1 # Seconds between power state polls of a host which is expected to change state
+
+WATCH_SLOW_INTERVAL = 60 # Upper bound in seconds between power state polls of a host which is stable
+
+WATCH_STOP_TIMEOUT = 5 # Seconds PowerWatcher.stop waits for polls in progress to finish
+
+EVENT_SUBSCRIPTION_EXPIRATION = 3600 # Seconds for which an event subscription lasts, unless it is renewed
+
+EVENT_QUEUE_SIZE = 10000 # Events an EventListener holds awaiting dispatch, beyond which new ones are dropped
+
+EVENT_WORKERS = 4 # Threads dispatching events to an EventListener's handlers
+
+WATCH_SETTLE_TIME = 90 # Seconds for which a host is polled quickly, after a power state change is requested
+
 
 _URI_PREFIXES = {
     'CIM': 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/',
@@ -41,12 +87,29 @@ RESOURCE_METHODS = {
 }
 
 
+RESOURCE_DEPENDENCIES = {
+        # Resources whose state may change when the resource (or service) named
+        # in the key is put, or has a method invoked on it. Used to invalidate
+        # cached resources.
+        'CIM_PowerManagementService': ['CIM_AssociatedPowerManagementService', 'CIM_ComputerSystem'],
+        'CIM_KVMRedirectionSAP': ['IPS_KVMRedirectionSettingData'],
+        'IPS_KVMRedirectionSettingData': ['CIM_KVMRedirectionSAP'],
+        'AMT_RedirectionService': ['CIM_KVMRedirectionSAP'],
+        'CIM_BootConfigSetting': ['CIM_BootSourceSetting', 'AMT_BootSettingData'],
+        'CIM_BootService': ['CIM_BootConfigSetting', 'AMT_BootSettingData'],
+        'AMT_BootSettingData': ['CIM_BootConfigSetting'],
+}
+
+
 RESOURCE_URIs = {}
 for name in RESOURCE_METHODS.keys():
     prefix = name.split('_')[0]
     RESOURCE_URIs[name] = _URI_PREFIXES[prefix] + name
 
 
+EVENT_RESOURCE_URI = 'http://schemas.dmtf.org/wbem/wscim/1/*' # Subscribed to for all of a device's indications
+
+
 SCHEMAS = dict(
     addressing = 'http://schemas.xmlsoap.org/ws/2004/08/addressing',
     addressing_anonymous = 'http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous',
@@ -14,11 +14,13 @@
 Wry data structures and helpers.
 """
 
-import xmltodict
 import json
-from ast import literal_eval
-from collections import OrderedDict# as NormalOrderedDict
-from wry.config import RESOURCE_URIs
+import re
+from collections import namedtuple, OrderedDict# as NormalOrderedDict
+from xml.parsers import expat
+from wry import schema
+from wry.config import RESOURCE_URIs, XML_DECODER
+from wry.wsman import FLAG_DUMP_REQUEST
 
 
 
@@ -41,6 +43,7 @@ class WryDict(OrderedDict):
 
     def as_xml(self):
         '''TODO: Make this clearer and better and more integrated an stuff.'''
+        import xmltodict
         output = self.with_namespaces()
         output = _convert_values(output)
         _xml = xmltodict.unparse(output, full_document=False, pretty=False)
@@ -55,6 +58,11 @@ class WryDict(OrderedDict):
             output[resource_name][u'@xmlns'] = uri
         return output
 
+    @property
+    def attempts(self):
+        '''The number of attempts it took to fetch this from a device, if known.'''
+        return getattr(getattr(self, 'source_doc', None), 'attempts', None)
+
     @property
     def error(self):
         if self.source_doc.is_fault():
@@ -63,20 +71,11 @@ class WryDict(OrderedDict):
             return None
 
     def _from_xmldoc(self, doc):
-        mydict = xmltodict.parse(doc.root().string(), process_namespaces=False)
-        # .root() as opposed to .body() because they both seem to return the same thing:
-        mydict = _strip_namespace_prefixes(mydict)
-        body = mydict[u'Envelope'][u'Body']
-        outdict = WryDict()
-        for key, value in body.values()[0].iteritems():
-            if value in (u'true', u'false'):
-                value = value.capitalize()
-            try:
-                value = literal_eval(value)
-            except (SyntaxError, ValueError):
-                pass
-            outdict[key] = value
-        return {body.keys()[0]: outdict}
+        decoded = getattr(doc, '_wry_decoded', None)
+        if decoded is not None:
+            doc._wry_decoded = None # Only once, as WryDicts may be changed.
+            return decoded
+        return _decode_xmldoc(doc)
 
     def __repr__(self):
         items = ''
@@ -92,31 +91,180 @@ class WryDict(OrderedDict):
         return json.dumps(self, indent=indent)
 
 
-def _convert_values(input_dict):
+def _decode_xmldoc(doc):
+    # .root() as opposed to .body() because they both seem to return the same thing:
+    mydict = DECODERS[XML_DECODER](doc.root().string())
+    body = mydict[u'Envelope'][u'Body']
+    resource_name = body.keys()[0]
+    return {resource_name: decode_fields(resource_name, body[resource_name])}
+
+
+def predecode(doc):
+    '''
+    Decode a response ahead of WryDict(doc), which then takes the result
+    rather than decoding it again. Used to measure decoding as part of a
+    request.
+    '''
+    try:
+        doc._wry_decoded = _decode_xmldoc(doc)
+    except Exception:
+        pass # WryDict(doc) will fail as it would have done.
+
+
+_NATIVE_OPTIONS = {}
+_NATIVE_OPTIONS_SIZE = 1024
+
+
+class WryOptions(namedtuple('WryOptions', ['flags', 'selectors', 'max_elements', 'timeout', 'retry_policy',
+    'delivery_uri', 'expiration'])):
+    '''
+    Immutable options for WS-Man requests. Changing an option returns a new
+    WryOptions, so one instance can be shared by many requests, and threads,
+    without selectors or flags leaking between them.
+
+    Pure-Python transports (common.Transport) use these directly; for
+    pywsman.Client, native() converts them when a request is sent.
+
+    timeout is in seconds. The device is asked to complete each operation
+    within it (as a WS-Man OperationTimeout), and pure-Python transports wait
+    no longer than that for each response, in place of their own timeout.
+
+    retry_policy is a decorators.RetryPolicy for the requests made with these
+    options, or None for the default.
+
+    delivery_uri and expiration (in seconds) apply to WS-Eventing
+    subscriptions: where events are to be pushed, and for how long.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, flags=0, selectors=(), max_elements=None, timeout=None, retry_policy=None,
+        delivery_uri=None, expiration=None):
+        return super(WryOptions, cls).__new__(cls, flags, tuple(selectors), max_elements, timeout, retry_policy,
+            delivery_uri, expiration)
+
+    def get_flags(self):
+        return self.flags
+
+    @property
+    def dump_request(self):
+        return bool(self.flags & FLAG_DUMP_REQUEST)
+
+    def with_flags(self, flags):
+        return self._replace(flags=self.flags | flags)
+
+    def without_flags(self, flags):
+        return self._replace(flags=self.flags & ~flags)
+
+    def with_dump_request(self, dump_request=True):
+        if dump_request:
+            return self.with_flags(FLAG_DUMP_REQUEST)
+        return self.without_flags(FLAG_DUMP_REQUEST)
+
+    def with_selector(self, name, value):
+        return self._replace(selectors=self.selectors + ((name, value), ))
+
+    def with_max_elements(self, max_elements):
+        return self._replace(max_elements=max_elements)
+
+    def with_timeout(self, timeout):
+        return self._replace(timeout=timeout)
+
+    def with_retry_policy(self, retry_policy):
+        return self._replace(retry_policy=retry_policy)
+
+    def with_delivery(self, delivery_uri, expiration=None):
+        return self._replace(delivery_uri=delivery_uri, expiration=expiration)
+
+    def native(self):
+        '''
+        Return an equivalent pywsman.ClientOptions. It is made once for each
+        distinct set of options, and must not be modified.
+        '''
+        key = self[:4] + self[5:] # The retry policy is not the client's concern.
+        options = _NATIVE_OPTIONS.get(key)
+        if options is None:
+            import pywsman
+            options = pywsman.ClientOptions()
+            if self.flags:
+                options.set_flags(self.flags)
+            for name, value in self.selectors:
+                options.add_selector(name, value)
+            if self.max_elements:
+                options.set_max_elements(self.max_elements)
+            if self.timeout:
+                options.set_timeout(int(self.timeout * 1000)) # In milliseconds.
+            if self.delivery_uri:
+                options.set_delivery_uri(self.delivery_uri)
+            if self.expiration:
+                options.set_sub_expiry(int(self.expiration)) # In seconds.
+            if len(_NATIVE_OPTIONS) >= _NATIVE_OPTIONS_SIZE:
+                _NATIVE_OPTIONS.clear()
+            _NATIVE_OPTIONS[key] = options
+        return options
+
+
+def decode_fields(resource_name, fields):
+    '''
+    Return a WryDict of a resource's fields, with their values (as decoded from
+    XML) converted by the field types in wry.schema, or else by guessing.
+    '''
+    decoders = schema.DECODERS.get(resource_name, {})
+    output = WryDict()
+    if fields is None:
+        return output # An empty element, such as <RenewResponse/>.
+    for key, value in fields.iteritems():
+        decode = decoders.get(key)
+        output[key] = decode(value) if decode else _literal(value)
+    return output
+
+
+def diff_fields(resource_name, current, desired):
+    '''
+    Compare the fields of a resource with their desired values, as they would
+    be written to XML. Fields whose desired value is None are not compared.
+
+    :returns: An OrderedDict of {field: (current value, desired value)} for
+    each field which differs.
     '''
+    encoders = schema.ENCODERS.get(resource_name)
+    current_xml = _convert_values(current, encoders)
+    desired_xml = _convert_values(desired, encoders)
+    output = OrderedDict()
+    for key, value in desired_xml.iteritems():
+        if current_xml.get(key) != value:
+            output[key] = (current.get(key), desired[key])
+    return output
+
+
+def _convert_values(input_dict, encoders=None):
+    '''
+    Convert the values of a resource dict, keyed by resource name, to XML text:
+    by the field types in wry.schema, or else by guessing.
+
     TODO: add an ns_uri kwarg so we can specify a namespace if one is not
     here...
     '''
     output = OrderedDict()
     for key, value in input_dict.iteritems():
-        try:
-            value = _convert_values(value)
-        except AttributeError:
-            if value is None:
-                continue # Omit this tag - fixes issues with passwords, could possibly cause them elsewhere?
-            if value in (True, False):
-                value = unicode(value).lower()
-            else:
-                value = unicode(value)
+        if value is None:
+            continue # Omit this tag - fixes issues with passwords, could possibly cause them elsewhere?
+        encode = encoders and encoders.get(key)
+        if isinstance(value, dict): # Nil, or carrying attributes: convert its parts instead.
+            value = _convert_values(value, schema.ENCODERS.get(key))
+        elif encode:
+            value = encode(value)
+        elif value in (True, False):
+            value = unicode(value).lower()
+        else:
+            value = unicode(value)
         output[key] = value
     return output
-        
 
 
 def _strip_namespace_prefixes(input_dict):
     '''
-    Given a dict-like object, perhaps containing dict-like objects to an arbitary
-    depth, return a copy with XML namespace prefixes stripped from each
+    Given a dict-like object, perhaps containing dict-like objects (or lists of
+    them) to an arbitary depth, return a copy with XML namespace prefixes stripped from each
     dict[like-object]'s keys.
     '''
     try:
@@ -127,6 +275,116 @@ def _strip_namespace_prefixes(input_dict):
         return None
     for key, value in input_dict.iteritems():
         key = key.split(':')[-1]
-        value = _strip_namespace_prefixes(value) or value
+        if isinstance(value, list):
+            value = [_strip_namespace_prefixes(item) or item for item in value]
+        else:
+            value = _strip_namespace_prefixes(value) or value
         outdict[key] = value
     return outdict
+
+
+def decode_with_xmltodict(xml):
+    '''
+    The original decoder: parse with xmltodict, then strip the namespace
+    prefixes from a copy of the result.
+    '''
+    import xmltodict
+    return _strip_namespace_prefixes(xmltodict.parse(xml, process_namespaces=False))
+
+
+class _ExpatHandler(object):
+    '''
+    Builds the same structure as decode_with_xmltodict, stripping namespace
+    prefixes as it goes, so that no second pass over the result is needed.
+
+    The one difference is that elements whose names differ only by prefix are
+    collected together, rather than the last of them winning.
+    '''
+
+    def __init__(self):
+        self.item = None
+        self.data = []
+        self.stack = []
+
+    def start(self, name, attributes):
+        self.stack.append((self.item, self.data))
+        self.data = []
+        if attributes:
+            self.item = OrderedDict()
+            for index in range(0, len(attributes), 2):
+                key = attributes[index]
+                colon = key.rfind(':')
+                self.item[key[colon + 1:] if colon >= 0 else '@' + key] = attributes[index + 1]
+        else:
+            self.item = None
+
+    def end(self, name):
+        data = u''.join(self.data).strip() or None
+        item = self.item
+        if item is None:
+            item = data
+        elif data is not None:
+            item['#text'] = data
+        self.item, self.data = self.stack.pop()
+        if self.item is None:
+            self.item = OrderedDict()
+        key = name[name.rfind(':') + 1:]
+        if key in self.item:
+            existing = self.item[key]
+            if isinstance(existing, list):
+                existing.append(item)
+            else:
+                self.item[key] = [existing, item]
+        else:
+            self.item[key] = item
+
+    def characters(self, data):
+        self.data.append(data)
+
+
+def decode_with_expat(xml):
+    '''
+    Decode an XML document into nested OrderedDicts, with namespace prefixes
+    removed from element and attribute names, in a single streaming pass.
+    '''
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    handler = _ExpatHandler()
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.ordered_attributes = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+    parser.Parse(xml, True)
+    return handler.item
+
+
+DECODERS = {
+    'expat': decode_with_expat,
+    'xmltodict': decode_with_xmltodict,
+}
+
+
+_INTEGER = re.compile(r'(?:0|[1-9][0-9]*)\Z')
+_LITERAL_START = frozenset(u'0123456789.+-([{\'"uUbBrRTFN')
+
+
+def _literal(value):
+    '''
+    Convert a value decoded from XML to the Python literal it spells, if any,
+    as ast.literal_eval would. Common cases are handled without compiling.
+    '''
+    if not isinstance(value, basestring):
+        return value
+    if value in (u'true', u'false'):
+        return value == u'true'
+    if _INTEGER.match(value):
+        return int(value)
+    if value[:1] not in _LITERAL_START:
+        return value
+    from ast import literal_eval
+    try:
+        return literal_eval(value)
+    except (SyntaxError, ValueError):
+        return value
@@ -10,32 +10,157 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import random
+import sys
 from functools import wraps
-from time import sleep
-import pywsman
-from wry.config import CONNECT_RETRIES
-from wry.exceptions import AMTConnectFailure
+from time import sleep, time
+from wry.config import CONNECT_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+from wry import health
+from wry.data_structures import WryOptions
+from wry.exceptions import AMTConnectFailure, CircuitOpen, WSManFault
 
 
 
+class RetryPolicy(object):
+    '''
+    Decides whether, and after how long, a failed WS-Man call is retried.
+
+    Delays grow exponentially from base_delay up to max_delay, and each is
+    drawn uniformly from zero up to that bound ("full jitter"), so that calls
+    to many devices which fail together do not retry in lockstep.
+    '''
+
+    def __init__(self, max_attempts=None, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+        deadline=None, retryable=(AMTConnectFailure, ), retryable_faults=('TimedOut', )):
+        '''
+        :param max_attempts: The number of attempts to make, including the
+        first. By default, one more than CONNECT_RETRIES.
+        :param deadline: Seconds after the first attempt beyond which no retry
+        is started.
+        :param retryable: The exception classes which are worth retrying.
+        :param retryable_faults: The WS-Man fault subcodes (without a prefix)
+        which are worth retrying. Other faults are raised straight away.
+        '''
+        self._max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable = tuple(retryable)
+        self.retryable_faults = frozenset(retryable_faults)
+
+    @property
+    def max_attempts(self):
+        if self._max_attempts is None:
+            return CONNECT_RETRIES + 1
+        return self._max_attempts
+
+    def is_retryable(self, error):
+        if isinstance(error, CircuitOpen):
+            return False
+        if isinstance(error, WSManFault):
+            return str(error.subcode).split(':')[-1] in self.retryable_faults
+        return isinstance(error, self.retryable)
+
+    def backoff(self, attempt):
+        '''A random delay to wait after the given (1-based) attempt fails.'''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def next_delay(self, error, attempt, started):
+        '''
+        Return the delay before retrying after the given attempt failed with
+        error, or None if error should be raised instead.
+
+        :param started: When the first attempt was made.
+        '''
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        delay = self.backoff(attempt)
+        if self.deadline is not None and time() + delay >= started + self.deadline:
+            return None
+        return delay
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def get_retry_policy(kwargs):
+    '''
+    Pop a retry_policy keyword argument from kwargs, falling back to the
+    policy of the WryOptions passed as options, then DEFAULT_RETRY_POLICY.
+    '''
+    return (kwargs.pop('retry_policy', None)
+        or getattr(kwargs.get('options'), 'retry_policy', None)
+        or DEFAULT_RETRY_POLICY)
+
+
+def record_attempts(obj, attempts):
+    '''Note on a result or exception how many attempts it took, where possible.'''
+    try:
+        obj.attempts = attempts
+    except (AttributeError, TypeError):
+        pass
+
+
 def retry(infunc):
+    '''
+    Retry infunc according to a RetryPolicy (see get_retry_policy). The number
+    of attempts made is recorded as the attempts attribute of the result, or
+    of the exception raised.
+    '''
     @wraps(infunc)
     def newfunc(*args, **kwargs):
-        for _ in range(CONNECT_RETRIES + 1):
+        policy = get_retry_policy(kwargs)
+        started = time()
+        attempt = 0
+        while True:
+            attempt += 1
             try:
-                return infunc(*args, **kwargs)
-            except AMTConnectFailure:
-                sleep(.1)
-            except:
-                break
-        raise
+                result = infunc(*args, **kwargs)
+            except Exception as error:
+                exc_info = sys.exc_info()
+                delay = policy.next_delay(error, attempt, started)
+                if delay is None:
+                    record_attempts(error, attempt)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                sleep(delay)
+            else:
+                record_attempts(result, attempt)
+                return result
     return newfunc
  
 
+def check_health(infunc):
+    '''
+    Consult health.REGISTRY before infunc(client, ...) talks to the client's
+    endpoint, and record whether it could be reached.
+    '''
+    @wraps(infunc)
+    def newfunc(*args, **kwargs):
+        endpoint = health.client_endpoint(args[0])
+        if endpoint is None:
+            return infunc(*args, **kwargs)
+        health.REGISTRY.before(endpoint)
+        reachable = True
+        try:
+            return infunc(*args, **kwargs)
+        except AMTConnectFailure:
+            reachable = False
+            raise
+        finally:
+            health.REGISTRY.record(endpoint, reachable)
+    return newfunc
+
+
 def add_client_options(infunc):
+    '''
+    Default the options passed to infunc(client, ...), and convert WryOptions
+    to native ones for clients, such as pywsman.Client, which need them.
+    '''
     @wraps(infunc)
     def newfunc(*args, **kwargs):
-        options = kwargs.pop('options', None) or pywsman.ClientOptions()
+        options = kwargs.pop('options', None) or WryOptions()
+        if isinstance(options, WryOptions) and not hasattr(args[0], 'new_options'):
+            options = options.native()
         return infunc(*args, options=options, **kwargs)
     return newfunc
 
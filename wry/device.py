@@ -11,15 +11,21 @@
 # under the License.
 
 
-import pywsman
+import json
 import re
+import sys
+import threading
 from collections import namedtuple
 from collections import OrderedDict
+from Queue import Queue, Empty
 from wry import common
-from wry.data_structures import WryDict
+from wry.data_structures import WryDict, WryOptions
+from wry import capabilities
 from wry import common
+from wry import concurrency
 from wry import exceptions
-from wry.config import RESOURCE_METHODS, RESOURCE_URIs, SCHEMAS
+from wry import health
+from wry.config import DEVICE_MAX_CONCURRENCY, RESOURCE_METHODS, RESOURCE_URIs, SCHEMAS, UNSUPPORTED_FAULTS
 
 
 
@@ -63,94 +69,234 @@ schema class.
 
 
 class lazy_property(object):
-    '''A property that is evaluated on first access, and never again thereafter.'''
+    '''
+    A property that is evaluated on first access, and never again thereafter.
+
+    Concurrent first accesses evaluate it once, under the instance's
+    _lazy_lock: a threading.RLock, as one lazy property may use another.
+    '''
 
     def __init__(self, getter):
         self.getter = getter
         self.getter_name = getter.__name__
+        self.__doc__ = getter.__doc__
 
     def __get__(self, obj, _):
         if obj is None:
-            return None
-        value = self.getter(obj)
-        setattr(obj, self.getter_name, value)
+            return self
+        with obj._lazy_lock:
+            if self.getter_name in obj.__dict__:
+                return obj.__dict__[self.getter_name]
+            value = self.getter(obj)
+            setattr(obj, self.getter_name, value)
         return value
 
 
 class AMTDevice(object):
     '''A wrapper class which packages AMT functionality into an accessible, device-centric format.'''
 
-    def __init__(self, location, protocol, username, password):
+    def __init__(self, location, protocol, username, password, transport=None, cache=None, retry_policy=None,
+        capability_cache=None):
+        '''
+        :param transport: The class used to talk to the device. Defaults to
+        pywsman.Client; see common.Transport for alternatives, such as
+        transport.HTTPTransport.
+        :param cache: A cache.ResourceCache, used to avoid fetching resources
+        which have been fetched recently. By default, nothing is cached.
+        :param retry_policy: A decorators.RetryPolicy for requests to the
+        device. By default, decorators.DEFAULT_RETRY_POLICY.
+        :param capability_cache: A capabilities.CapabilityCache, in which what
+        probe() learns is kept. By default, capabilities.CACHE.
+        '''
         port = common.AMT_PROTOCOL_PORT_MAP[protocol]
         path = '/wsman'
-        self.client = pywsman.Client(location, port, path, protocol, username, password)
-        self.options = pywsman.ClientOptions()
 
-        self.boot = AMTBoot(self.client, self.options)
-        self.power = AMTPower(self.client, self.options)
-        self.kvm = AMTKVM(self.client, self.options)
+        def new_client():
+            factory = transport
+            if factory is None:
+                import pywsman # Slow to load, and not needed by the other transports.
+                factory = pywsman.Client
+            return factory(location, port, path, protocol, username, password)
+
+        self._new_client = new_client
+        self._lazy_lock = threading.RLock()
+        self.options = WryOptions(retry_policy=retry_policy)
+        self.cache = cache
+        self.location = location
+        self.port = port
+        self.capability_cache = capabilities.CACHE if capability_cache is None else capability_cache
+        self.capabilities = self.capability_cache.get(location) # Only once checked against the firmware.
+        self.unsupported = set(self.capabilities.unsupported if self.capabilities else ())
+
+    @lazy_property
+    def client(self):
+        '''The transport to the device, made when the first request is.'''
+        return self._new_client()
+
+    @lazy_property
+    def boot(self):
+        return AMTBoot(self.client, self.options, cache=self.cache, unsupported=self.unsupported)
+
+    @lazy_property
+    def power(self):
+        return AMTPower(self.client, self.options, cache=self.cache, unsupported=self.unsupported)
+
+    @lazy_property
+    def kvm(self):
+        return AMTKVM(self.client, self.options, cache=self.cache, unsupported=self.unsupported)
 
     @property
-    def debug(self):
+    def health(self):
         '''
-        When set to True, openwsman will dump every [#]_ request made to the
-        client.
+        The state of the circuit breaker for this device's endpoint (see
+        wry.health): 'closed' while it is reachable, 'open' while requests to it
+        fail fast, and 'half-open' when it is due to be tried again.
 
-        Unfortunately, openwsman does not expose this value, so it only possible
-        to set this property, and not to retrieve it.
+        Reading it does not make the client.
+        '''
+        client = self.__dict__.get('client')
+        endpoint = health.client_endpoint(client) if client is not None else None
+        return health.REGISTRY.state(endpoint or (self.location, self.port))
+
+    @property
+    def debug(self):
+        '''
+        When set to True, the client will dump every [#]_ request made to the
+        device.
 
         .. [#] Actually, every request that makes use of self.options.
         '''
-        raise NotImplemented('There is no way to get the value of this property. Please set it explicitly.')
-        return self.options.get_dump_request()
+        return self.options.dump_request
 
     @debug.setter
     def debug(self, value):
-        if value:
-            self.options.set_dump_request()
-        else:
-            self.options.clear_dump_request()
+        self.options = self.options.with_dump_request(value)
+        for name in ('boot', 'power', 'kvm'):
+            if name in self.__dict__: # Those not made yet are made with the new options.
+                self.__dict__[name].options = self.options
+
+    def probe(self, refresh=False):
+        '''
+        Identify the device's firmware, and learn which resources it does not
+        support, so that they are not requested again: by this instance, or
+        by others sharing its capability cache. A device whose firmware was
+        probed before is not probed again, unless refresh is True.
+
+        Only the Identify is sent when the cache already knows the firmware.
+        Resources are learned to be unsupported from the faults listed in
+        config.UNSUPPORTED_FAULTS; others, such as AccessDenied, do not count.
+
+        :returns: A capabilities.Capabilities.
+        '''
+        product_version = common.identify(self.client, options=self.options).get('ProductVersion')
+        known = None if refresh else self.capability_cache.get(self.location, product_version)
+        if known is None:
+            self.unsupported.clear()
+            unsupported = frozenset(
+                name for name, resource in self.iter_dump()
+                if isinstance(resource, exceptions.WSManFault)
+                and str(resource.subcode).split(':')[-1] in UNSUPPORTED_FAULTS
+            )
+            known = capabilities.Capabilities(product_version, unsupported)
+            self.capability_cache.set(self.location, known)
+        self.capabilities = known
+        self.unsupported.clear()
+        self.unsupported.update(known.unsupported)
+        return known
 
     def get_resource(self, resource_name, as_xmldoc=False):
         '''
         Get a native representaiton of a resource, by name. The resource URI will be
         sourced from config.RESOURCE_URIs
         '''
-        return common.get_resource(self.client, resource_name, options=self.options, as_xmldoc=as_xmldoc)
+        _check_supported(self.unsupported, resource_name)
+        return common.get_resource(self.client, resource_name, options=self.options, as_xmldoc=as_xmldoc, cache=self.cache)
 
-    def enumerate_resource(self, resource_name): # Add in all relevant kwargs...
+    def enumerate_resource(self, resource_name, wsman_filter=None, **kwargs):
         '''
         Get a native representaiton of a resource, and its instances. The
         resource URI will be sourced from config.RESOURCE_URIs
         '''
-        return common.enumerate_resource(self.client, resource_name)
+        _check_supported(self.unsupported, resource_name)
+        return common.enumerate_resource(self.client, resource_name, wsman_filter=wsman_filter, options=self.options, **kwargs)
+
+    def iter_resource(self, resource_name, wsman_filter=None, **kwargs):
+        '''
+        Yield the instances of a resource as they arrive. See
+        common.iter_resource for the keyword arguments.
+        '''
+        _check_supported(self.unsupported, resource_name)
+        return common.iter_resource(self.client, resource_name, wsman_filter=wsman_filter, options=self.options, **kwargs)
 
     def put_resource(self, data, uri=None, silent=False):
         '''
         Given a WryDict describing a resource, put this data to the client.
         '''
-        return common.put_resource(self.client, data, uri, options=self.options, silent=silent)
+        return common.put_resource(self.client, data, uri=uri, options=self.options, silent=silent, cache=self.cache)
+
+    def _dump_resource(self, client, resource_name):
+        methods = RESOURCE_METHODS[resource_name]
+        if 'get' in methods:
+            return common.get_resource(client, resource_name, options=self.options, cache=self.cache)
+        elif 'enumerate' in methods:
+            return common.enumerate_resource(client, resource_name, options=self.options)
+        raise exceptions.NoSupportedMethods('The resource %r does not define a supported method for this action.' % resource_name)
+
+    def iter_dump(self, max_workers=DEVICE_MAX_CONCURRENCY):
+        '''
+        Fetch all of the known information about the device, up to max_workers
+        resources at a time, yielding (resource_name, resource) pairs as each
+        resource arrives. resource is a WryDict, or the WSManFault which
+        prevented it from being fetched, or an UnsupportedResource for a
+        resource which probe() found the device not to support. Those are not
+        requested.
+
+        Unless the client is thread-safe (see common.Transport.thread_safe),
+        each worker uses a client of its own.
+        '''
+        idle = Queue()
+
+        def fetch(resource_name):
+            if getattr(self.client, 'thread_safe', False):
+                return self._dump_resource(self.client, resource_name)
+            try:
+                client = idle.get_nowait()
+            except Empty:
+                client = self._new_client()
+            try:
+                return self._dump_resource(client, resource_name)
+            finally:
+                idle.put(client)
+
+        resource_names = []
+        for resource_name in RESOURCE_METHODS:
+            if resource_name in self.unsupported:
+                yield resource_name, exceptions.UnsupportedResource('%s is not supported by this device.' % resource_name)
+            else:
+                resource_names.append(resource_name)
+        for resource_name, resource, exc_info in concurrency.imap_unordered(fetch, resource_names, max_workers, exc_info=True):
+            if exc_info is not None and isinstance(exc_info[1], exceptions.WSManFault):
+                yield resource_name, exc_info[1]
+            elif exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2] # With the traceback of the failed request.
+            else:
+                yield resource_name, resource
 
-    def dump(self, as_json=True):
+    def dump(self, as_json=True, max_workers=DEVICE_MAX_CONCURRENCY):
         '''
         Print all of the known information about the device.
 
+        :param max_workers: The number of resources to fetch at once.
         :returns: WryDict or json.
         '''
+        resources = dict(self.iter_dump(max_workers=max_workers))
         output = WryDict()
         impossible = []
-        for name, methods in RESOURCE_METHODS.items():
-            try:
-                if 'get' in methods:
-                    resource = self.get_resource(name)
-                elif 'enumerate' in methods:
-                    resource = self.enumerate_resource(name)
-                else:
-                    raise exceptions.NoSupportedMethods('The resource %r does not define a supported method for this action.' % name)
-            except exceptions.WSManFault:
+        for name in RESOURCE_METHODS:
+            if isinstance(resources[name], (exceptions.WSManFault, exceptions.UnsupportedResource)):
                 impossible.append(name)
             else:
-                output.update(resource)
+                output.update(resources[name])
         messages = ['# Could not dump %s' % name for name in impossible]
         if as_json:
             return '\n'.join(messages) + '\n' + output.as_json()
@@ -159,20 +305,43 @@ class AMTDevice(object):
             return output
 
     def load(self, input_dict):
-        return common.load_from_dict(client, input_dict)
+        '''
+        Apply a desired state to the device, putting only the resources which
+        differ from it.
+
+        :param input_dict: A dict in the shape returned by dump(as_json=False),
+        or the JSON returned by dump().
+        :returns: See common.load_from_dict.
+        '''
+        if isinstance(input_dict, basestring):
+            lines = [line for line in input_dict.splitlines() if not line.startswith('#')]
+            input_dict = json.loads('\n'.join(lines), object_pairs_hook=OrderedDict)
+        return common.load_from_dict(self.client, input_dict, options=self.options, cache=self.cache)
+
+
+def _check_supported(unsupported, resource_name):
+    if resource_name in unsupported:
+        raise exceptions.UnsupportedResource('%s is not supported by this device.' % resource_name)
 
 
 class DeviceCapability(object):
     '''self.resource_name should be set on the subclass if needed.'''
 
-    def __init__(self, client, options=None):
+    def __init__(self, client, options=None, cache=None, unsupported=frozenset()):
+        '''
+        :param unsupported: The names of resources not to request, as the
+        device does not support them. Shared with, and updated by, the device.
+        '''
         self.client = client
         self.options = options
+        self.cache = cache
+        self.unsupported = unsupported
 
     def get(self, resource_name=None, setting=None):
         if not resource_name:
             resource_name = self.resource_name
-        resource = common.get_resource(self.client, resource_name, options=self.options)
+        _check_supported(self.unsupported, resource_name)
+        resource = common.get_resource(self.client, resource_name, options=self.options, cache=self.cache)
         if setting:
             return resource[resource_name][setting]
         return resource[resource_name]
@@ -182,17 +351,23 @@ class DeviceCapability(object):
                          # Want to be able to supply only input_dict...
         if not resource_name:
             resource_name = self.resource_name
+        _check_supported(self.unsupported, resource_name)
         if as_update:
-            resource = common.get_resource(self.client, resource_name, options=self.options)
+            resource = common.get_resource(self.client, resource_name, options=self.options, cache=self.cache)
             resource[resource_name].update(input_dict)
         else:
             resource = WryDict({resource_name: input_dict})
-        response = common.put_resource(self.client, resource, silent=silent, options=self.options)
+        response = common.put_resource(self.client, resource, silent=silent, options=self.options, cache=self.cache)
 
     def walk(self, resource_name,  wsman_filter=None):
         '''Enumerate a resource.'''
+        _check_supported(self.unsupported, resource_name)
         return common.enumerate_resource(self.client, resource_name, wsman_filter=wsman_filter, options=self.options)
 
+    def invoke_method(self, **kwargs):
+        '''Invoke a method on the device. See common.invoke_method.'''
+        return common.invoke_method(options=self.options, client=self.client, cache=self.cache, **kwargs)
+
 class AMTPower(DeviceCapability):
     '''Control over a device's power state.'''
 
@@ -201,13 +376,11 @@ class AMTPower(DeviceCapability):
         super(AMTPower, self).__init__(*args, **kwargs)
 
     def request_power_state_change(self, power_state): 
-        return common.invoke_method(
+        return self.invoke_method(
             service_name='CIM_PowerManagementService',
             resource_name='CIM_ComputerSystem',
             affected_item='ManagedElement',
             method_name='RequestPowerStateChange',
-            options=self.options,
-            client=self.client,
             selector=('Name', 'ManagedSystem', 'Intel(r) AMT Power Management Service', ),
             args_before=[('PowerState', str(power_state)), ],
             anonymous=True,
@@ -228,7 +401,7 @@ class AMTPower(DeviceCapability):
         '''Turn on the device.'''
         sub_state = None
         index = AMT_POWER_STATE_MAP.index(('on', sub_state))
-        self.request_power_state_change(index)
+        return self.request_power_state_change(index)
 
     def turn_off(self):
         '''Turn off the device.'''
@@ -263,11 +436,9 @@ class AMTKVM(DeviceCapability):
                 },
             }
         }
-        return common.invoke_method(
+        return self.invoke_method(
             service_name='CIM_KVMRedirectionSAP',
             method_name='RequestStateChange',
-            options=self.options,
-            client=self.client,
             args_before=[('RequestedState', str(requested_state)), ],
         )
 
@@ -353,13 +524,52 @@ class AMTKVM(DeviceCapability):
 
 
 class AMTBoot(DeviceCapability):
-    '''Control how the machine will boot next time.'''
+    '''
+    Control how the machine will boot next time.
+
+    The boot sources' InstanceIDs, the boot configuration's InstanceID and the
+    boot service are looked up from the device the first time they are needed,
+    and remembered thereafter, so that setting the medium again costs only the
+    two method invocations. Call forget() if they may have changed.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(AMTBoot, self).__init__(*args, **kwargs)
+        self.forget()
+
+    def forget(self):
+        '''Forget what has been learned about the device's boot sources, configuration and service.'''
+        self._sources = None # [(StructuredBootString, InstanceID), ...]
+        self._config_instance = None
+        self._service_checked = False
+
+    def _remember_sources(self, returned):
+        sources = returned['CIM_BootSourceSetting']
+        if not isinstance(sources, list):
+            sources = [sources]
+        self._sources = [(source['StructuredBootString'], source['InstanceID']) for source in sources]
+
+    def _source_id(self, value):
+        for boot_string, instance_id in self._sources:
+            if value in boot_string:
+                return instance_id
+        raise LookupError('This medium is not supported by the device')
+
+    def _change_boot_order(self, instance_id):
+        return self.invoke_method(
+            service_name='CIM_BootConfigSetting',
+            resource_name='CIM_BootSourceSetting',
+            affected_item='Source',
+            method_name='ChangeBootOrder',
+            selector=('InstanceID', instance_id, self._config_instance, ),
+        )
 
     @property
     def supported_media(self):
         '''Media the device can be configured to boot from.'''
-        returned = self.walk('CIM_BootSourceSetting')
-        return [source['StructuredBootString'].split(':')[-2] for source in returned['CIM_BootSourceSetting']]
+        if self._sources is None:
+            self._remember_sources(self.walk('CIM_BootSourceSetting'))
+        return [boot_string.split(':')[-2] for boot_string, _ in self._sources]
 
     @property
     def medium(self):
@@ -368,37 +578,22 @@ class AMTBoot(DeviceCapability):
     @medium.setter
     def medium(self, value):
         '''Set boot medium for next boot.'''
-        # Zero out boot options - unwise, but just testing right now...
-        settings = self.get('AMT_BootSettingData')
-        for setting in settings:
-            if type(settings[setting]) == int:
-                settings[setting] = 0
-            elif type(settings[setting]) == bool:
-                settings[setting] = False
-            else:
-                pass
-
-        sources = self.walk('CIM_BootSourceSetting')['CIM_BootSourceSetting']
-        for source in sources:
-            if value in source['StructuredBootString']:
-                instance_id = source['InstanceID']
-                break
-        else:
-            raise LookupError('This medium is not supported by the device')
-
-        boot_config = self.get('CIM_BootConfigSetting') # Should be an
-        # enumerate, as it has intances... But for now...
-        config_instance = str(boot_config['InstanceID'])
-
-        response = common.invoke_method(
-            service_name='CIM_BootConfigSetting',
-            resource_name='CIM_BootSourceSetting',
-            affected_item='Source',
-            method_name='ChangeBootOrder',
-            options=self.options,
-            client=self.client,
-            selector=('InstanceID', instance_id, config_instance, ),
-        )
+        remembered = self._sources is not None and self._config_instance is not None
+        if self._sources is None:
+            self._remember_sources(self.walk('CIM_BootSourceSetting'))
+        instance_id = self._source_id(value)
+        if self._config_instance is None:
+            boot_config = self.get('CIM_BootConfigSetting') # Should be an
+            # enumerate, as it has intances... But for now...
+            self._config_instance = str(boot_config['InstanceID'])
+        try:
+            response = self._change_boot_order(instance_id)
+        except exceptions.WSManFault:
+            if not remembered:
+                raise
+            self.forget() # The device may have been reconfigured since: look again.
+            self.medium = value
+            return
         self._set_boot_config_role()
         return response
 
@@ -412,15 +607,15 @@ class AMTBoot(DeviceCapability):
             role = '1'
         elif enabled_state == False:
             role = '32768'
-        svc = self.get('CIM_BootService')
-        assert svc['ElementName'] == 'Intel(r) AMT Boot Service'
-        return common.invoke_method(
+        if not self._service_checked:
+            svc = self.get('CIM_BootService')
+            assert svc['ElementName'] == 'Intel(r) AMT Boot Service'
+            self._service_checked = True
+        return self.invoke_method(
             service_name='CIM_BootService',
             resource_name='CIM_BootConfigSetting',
             affected_item='BootConfigSetting',
             method_name='SetBootConfigRole',
-            options=self.options,
-            client=self.client,
             selector=('InstanceID', 'Intel(r) AMT: Boot Configuration 0', ),
             args_after=[('Role', role)],
         )
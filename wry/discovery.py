@@ -0,0 +1,162 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Finding AMT devices on a network.
+
+>>> for found in scan(['10.1.0.0/16']):
+...     print found.address, found.protocol, found.product_version
+>>> fleet = AMTFleet(found.device(username, password) for found in scan(['10.1.0.0/16']))
+"""
+
+import logging
+import socket
+import ssl
+import struct
+from collections import deque, namedtuple
+from time import time
+from wry import wsman
+from wry.aio import AsyncTransport
+from wry.common import AMT_PROTOCOL_PORT_MAP
+from wry.config import DISCOVERY_MAX_IN_FLIGHT, DISCOVERY_TIMEOUT
+from wry.data_structures import WryDict
+from wry.device import AMTDevice
+from wry.eventloop import Return, coroutine, get_event_loop
+
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Discovery(namedtuple('Discovery', ['address', 'protocol', 'product_version'])):
+    '''
+    A device which answered a WS-Man Identify. product_version is as it
+    reported it, eg. u'AMT 11.8'.
+    '''
+
+    def device(self, username, password, **kwargs):
+        '''Return an AMTDevice for this device. kwargs are passed to AMTDevice.'''
+        return AMTDevice(self.address, self.protocol, username, password, **kwargs)
+
+
+def iter_addresses(networks):
+    '''
+    Yield the IPv4 addresses in each of networks, given in CIDR notation (or
+    as single addresses). The network and broadcast addresses of networks
+    larger than /31 are skipped.
+    '''
+    for network in networks:
+        address, _, prefix = network.partition('/')
+        prefix = int(prefix) if prefix else 32
+        if not 0 <= prefix <= 32:
+            raise ValueError('Invalid network: %r' % network)
+        size = 1 << (32 - prefix)
+        first = struct.unpack('!I', socket.inet_aton(address))[0] & ~(size - 1) & 0xffffffff
+        numbers = xrange(first, first + size)
+        if prefix < 31:
+            numbers = xrange(first + 1, first + size - 1)
+        for number in numbers:
+            yield socket.inet_ntoa(struct.pack('!I', number))
+
+
+class _Probe(AsyncTransport):
+    '''Sends a single unauthenticated Identify, on a connection of its own.'''
+
+    @coroutine
+    def identify(self, options=None):
+        deadline = time() + self.timeout
+        request = wsman.http_request('POST', '%s:%s' % (self.host, self.port), self.path, wsman.identify_request(),
+            [('Content-Type', 'application/soap+xml;charset=UTF-8')])
+        try:
+            sock = yield self._open(deadline)
+        except socket.error:
+            raise Return(None)
+        try:
+            response = yield self._exchange(sock, request, deadline)
+        except (socket.error, EOFError):
+            raise Return(None)
+        finally:
+            sock.close()
+        if response.status != 200 or not response.body:
+            raise Return(None)
+        try:
+            doc = wsman.XmlDoc(response.body)
+        except wsman.ElementTree.ParseError:
+            raise Return(None)
+        if doc.is_fault():
+            raise Return(None)
+        raise Return(WryDict(doc).get('IdentifyResponse'))
+
+
+@coroutine
+def identify(address, protocol, port=None, loop=None, timeout=DISCOVERY_TIMEOUT, ssl_context=None):
+    '''
+    Confirm that address runs AMT, with an unauthenticated WS-Man Identify.
+
+    :returns: A Future for a Discovery, or None if the host did not answer.
+    '''
+    if protocol == 'https' and ssl_context is None:
+        # Only the Identify is sent: no credentials are at stake, and AMT's
+        # certificates are usually self-signed.
+        ssl_context = ssl._create_unverified_context()
+    probe = _Probe(address, port or AMT_PROTOCOL_PORT_MAP[protocol], '/wsman', protocol, '', '',
+        loop=loop, timeout=timeout, ssl_context=ssl_context)
+    response = yield probe.identify()
+    if response is None:
+        raise Return(None)
+    raise Return(Discovery(address, protocol, response.get('ProductVersion')))
+
+
+def scan(networks, protocols=('http', 'https'), max_in_flight=DISCOVERY_MAX_IN_FLIGHT, timeout=DISCOVERY_TIMEOUT,
+    ports=None, loop=None):
+    '''
+    Probe every address in networks (see iter_addresses) on the AMT port of
+    each of protocols, and yield a Discovery for each which answers, as it
+    does.
+
+    Probes are made from the calling thread, on an event loop, with up to
+    max_in_flight connections open at once. Each uses a socket, so the
+    process' limit on open files must allow for them.
+
+    :param timeout: Seconds to allow each probe.
+    :param ports: A dict of protocol to port, overriding
+    common.AMT_PROTOCOL_PORT_MAP.
+    '''
+    loop = loop or get_event_loop()
+    ports = dict(AMT_PROTOCOL_PORT_MAP, **(ports or {}))
+    targets = ((address, protocol) for address in iter_addresses(networks) for protocol in protocols)
+    found = deque()
+    in_flight = [0]
+
+    def finished(future):
+        in_flight[0] -= 1
+        if future.exception() is not None:
+            LOG.debug('Probe failed: %s', future.exception())
+        elif future.result() is not None:
+            found.append(future.result())
+
+    def fill():
+        while in_flight[0] < max_in_flight:
+            target = next(targets, None)
+            if target is None:
+                return
+            address, protocol = target
+            in_flight[0] += 1
+            identify(address, protocol, ports[protocol], loop=loop, timeout=timeout).add_done_callback(finished)
+
+    fill()
+    while found or in_flight[0]:
+        while found:
+            yield found.popleft()
+        if in_flight[0]:
+            loop.run_once()
+            fill()
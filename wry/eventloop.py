@@ -0,0 +1,318 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+A minimal single-threaded event loop, with generator-based coroutines, for
+holding many concurrent network conversations without a thread for each.
+
+Coroutines are generators decorated with :func:`coroutine`. They wait on a
+:class:`Future` by yielding it, and return a value by raising :exc:`Return`:
+
+>>> @coroutine
+... def power_states(devices):
+...     states = yield [device.power.state for device in devices]
+...     raise Return(states)
+>>> get_event_loop().run_until_complete(power_states(devices))
+"""
+
+import heapq
+import select
+import sys
+import threading
+import types
+from collections import deque
+from functools import wraps
+from time import time
+
+
+
+class Return(Exception):
+    '''Raised by a coroutine to return a value.'''
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Future(object):
+    '''The eventual result of an asynchronous operation.'''
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('The result is not ready yet.')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self.set_exc_info((type(exception), exception, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError('The result has already been set.')
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def _as_future(yielded):
+    if isinstance(yielded, (list, tuple)):
+        return gather(*yielded)
+    if not isinstance(yielded, Future):
+        raise TypeError('Coroutines may only yield Futures, or lists of them, not %r' % (yielded, ))
+    return yielded
+
+
+class _Task(object):
+    '''Drives a coroutine's generator, resuming it as each Future it yields completes.'''
+
+    def __init__(self, generator, future):
+        self.generator = generator
+        self.future = future
+
+    def step(self, value=None, exc_info=None):
+        while True:
+            try:
+                if exc_info:
+                    yielded = self.generator.throw(*exc_info)
+                else:
+                    yielded = self.generator.send(value)
+                yielded = _as_future(yielded)
+            except Return as returned:
+                self.future.set_result(returned.value)
+                return
+            except StopIteration:
+                self.future.set_result(None)
+                return
+            except Exception:
+                self.future.set_exc_info(sys.exc_info())
+                return
+            if not yielded.done():
+                yielded.add_done_callback(self._wakeup)
+                return
+            value, exc_info = yielded._result, yielded.exc_info()
+
+    def _wakeup(self, future):
+        self.step(future._result, future.exc_info())
+
+
+def coroutine(func):
+    '''Turn a generator function into one which returns a Future.'''
+    @wraps(func)
+    def newfunc(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return as returned:
+            future.set_result(returned.value)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        else:
+            if isinstance(result, types.GeneratorType):
+                _Task(result, future).step()
+            else:
+                future.set_result(result)
+        return future
+    return newfunc
+
+
+def gather(*futures):
+    '''A Future for the results of several Futures, in the order given.'''
+    output = Future()
+    futures = [_as_future(future) for future in futures]
+    remaining = [len(futures)]
+    if not futures:
+        output.set_result([])
+
+    def collect(_):
+        remaining[0] -= 1
+        if remaining[0] or output.done():
+            return
+        for future in futures:
+            if future.exc_info():
+                output.set_exc_info(future.exc_info())
+                return
+        output.set_result([future._result for future in futures])
+
+    for future in futures:
+        future.add_done_callback(collect)
+    return output
+
+
+def sleep(delay, loop=None):
+    '''A Future which completes after delay seconds.'''
+    future = Future()
+    (loop or get_event_loop()).call_later(delay, future.set_result, None)
+    return future
+
+
+class _Timer(object):
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    '''
+    Dispatches socket readiness and timer callbacks, using poll(2) where it is
+    available, so that thousands of sockets can be waited upon at once.
+    '''
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._sequence = 0
+        self._ready = deque()
+        self._poller = select.poll() if hasattr(select, 'poll') else None
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        '''Call callback(*args) after delay seconds. Returns a handle with a cancel() method.'''
+        timer = _Timer(callback, args)
+        self._sequence += 1
+        heapq.heappush(self._timers, (time() + delay, self._sequence, timer))
+        return timer
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._register(fd)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+        self._register(fd)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+        self._register(fd)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+        self._register(fd)
+
+    def _register(self, fd):
+        if self._poller is None:
+            return
+        mask = 0
+        if fd in self._readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self._writers:
+            mask |= select.POLLOUT
+        if mask:
+            self._poller.register(fd, mask)
+        else:
+            try:
+                self._poller.unregister(fd)
+            except KeyError:
+                pass
+
+    def _poll(self, timeout):
+        if self._poller is not None:
+            error = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            events = self._poller.poll(None if timeout is None else timeout * 1000)
+            return (
+                [fd for fd, event in events if event & (select.POLLIN | select.POLLPRI | error)],
+                [fd for fd, event in events if event & (select.POLLOUT | error)],
+            )
+        if not (self._readers or self._writers):
+            if timeout:
+                select.select([], [], [], timeout)
+            return [], []
+        readable, writable, failed = select.select(self._readers.keys(), self._writers.keys(), self._writers.keys(), timeout)
+        return readable, writable + failed
+
+    def run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time())
+        if timeout is None and not (self._readers or self._writers):
+            return
+        readable, writable = self._poll(timeout)
+        for fd in readable:
+            callback = self._readers.get(fd)
+            if callback:
+                callback()
+        for fd in writable:
+            callback = self._writers.get(fd)
+            if callback:
+                callback()
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self.call_soon(timer.callback, *timer.args)
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def run_until_complete(self, future):
+        '''
+        Run the loop until future (or a list of Futures) has completed, and
+        return its result.
+        '''
+        future = _as_future(future)
+        while not future.done():
+            if not (self._ready or self._timers or self._readers or self._writers):
+                raise RuntimeError('The event loop has nothing left to wait for.')
+            self.run_once()
+        return future.result()
+
+
+_local = threading.local()
+
+
+def get_event_loop():
+    '''Return the current thread's event loop, creating it if necessary.'''
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        loop = _local.loop = EventLoop()
+    return loop
@@ -0,0 +1,182 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Receiving the events that devices push to WS-Eventing subscribers, in place of
+polling them.
+
+>>> with EventListener(('0.0.0.0', 8090), advertised_host='10.0.0.1') as listener:
+...     subscription = listener.subscribe(device, handle_event)
+"""
+
+import BaseHTTPServer
+import logging
+import SocketServer
+import threading
+import urllib
+from Queue import Queue, Full
+from wry import common
+from wry import health
+from wry.config import EVENT_QUEUE_SIZE, EVENT_WORKERS
+from wry.data_structures import WryDict
+
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _EventDoc(object):
+    '''Just enough of a pywsman.XmlDoc for WryDict, without parsing the event twice.'''
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def root(self):
+        return self
+
+    def string(self):
+        return self.xml
+
+
+class _EventHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.listener._receive(self.path, self.client_address[0], body)
+        self.send_response(200) # Pushed events are one-way: there is nothing to reply.
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class EventListener(object):
+    '''
+    An HTTP endpoint to which devices push events, and which passes each
+    event, decoded into a WryDict, to the handler registered for its device.
+
+    Events are delivered to a URL per key (see notify_to()), and passed to
+    handler(key, event). Keys are device hosts by default. A handler
+    registered for the key None receives events for keys without one.
+
+    Receiving an event only queues it, so slow handlers do not hold up
+    devices. Events are decoded and handled by a number of worker threads;
+    those for any one key are always handled by the same worker, in the order
+    they arrived. Once a worker has queue_size events waiting, further events
+    for it are dropped, and counted in dropped.
+    '''
+
+    def __init__(self, address=('', 0), advertised_host=None, queue_size=EVENT_QUEUE_SIZE, workers=EVENT_WORKERS):
+        '''
+        :param address: The (host, port) to listen on. Port 0 picks a free one.
+        :param advertised_host: The address devices should send events to, if
+        not the host listened on (eg. when listening on all interfaces).
+        '''
+        self._server = _Server(address, _EventHandler)
+        self._server.listener = self
+        self.host = advertised_host or self._server.server_address[0]
+        self.port = self._server.server_address[1]
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+        self._handlers = {}
+        self._queues = [Queue(max(1, queue_size // workers)) for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def notify_to(self, key):
+        '''The URL to which events for key are to be pushed.'''
+        return 'http://%s:%d/%s' % (self.host, self.port, urllib.quote(str(key), safe=''))
+
+    def add_handler(self, key, handler):
+        self._handlers[key] = handler
+
+    def remove_handler(self, key):
+        self._handlers.pop(key, None)
+
+    def subscribe(self, device, handler, key=None, **kwargs):
+        '''
+        Subscribe to a device's events, and pass them to handler.
+
+        :param key: By default, the device's host (or its id, if that cannot
+        be told).
+        :param kwargs: Passed to common.subscribe, eg. resource_uri or
+        expiration.
+        :returns: A common.Subscription.
+        '''
+        if key is None:
+            key = str(health.client_host(device.client) or id(device))
+        self.add_handler(key, handler)
+        return common.subscribe(device.client, self.notify_to(key), options=device.options, **kwargs)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        targets = [self._server.serve_forever] + [lambda queue=queue: self._dispatch(queue) for queue in self._queues]
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        '''Stop listening. Events already received are still handled.'''
+        if not self._running:
+            return
+        self._running = False
+        self._server.shutdown()
+        self._server.server_close()
+        for queue in self._queues:
+            queue.put(None)
+
+    def _receive(self, path, address, body):
+        key = urllib.unquote(path.lstrip('/')) or address
+        queue = self._queues[hash(key) % len(self._queues)]
+        try:
+            queue.put_nowait((key, body))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            LOG.warning('Dropped an event for %s: the queue is full.', key)
+        else:
+            with self._lock:
+                self.received += 1
+
+    def _dispatch(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            key, body = item
+            handler = self._handlers.get(key) or self._handlers.get(None)
+            if handler is None:
+                continue
+            try:
+                handler(key, WryDict(_EventDoc(body)))
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                LOG.exception('Could not handle an event for %s.', key)
@@ -30,6 +30,10 @@ class AMTConnectFailure(Exception):
     pass
 
 
+class CircuitOpen(AMTConnectFailure):
+    '''Raised, without contacting the device, when its host is known to be unreachable.'''
+
+
 class XMLParseError(Exception):
     pass
 
@@ -37,3 +41,15 @@ class XMLParseError(Exception):
 class NoSupportedMethods(Exception):
     pass
 
+
+class UnsupportedResource(Exception):
+    '''Raised, without contacting the device, for a resource it is known not to support.'''
+
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class OperationCancelled(Exception):
+    pass
@@ -0,0 +1,154 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Operations across many AMT devices at once.
+"""
+
+import threading
+from collections import namedtuple
+from wry import concurrency
+from wry.config import FLEET_MAX_WORKERS
+
+
+
+class FleetResult(namedtuple('FleetResult', ['device', 'value', 'exception'])):
+    '''
+    The outcome of an operation on a single device in an :class:`AMTFleet`.
+
+    If the operation raised (eg. :exc:`wry.exceptions.AMTConnectFailure`,
+    :exc:`wry.exceptions.WSManFault` or :exc:`wry.exceptions.NonZeroReturn`),
+    value is None and the exception is kept in exception.
+    '''
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+
+class FleetOperation(object):
+    '''
+    An operation started by an :class:`AMTFleet`: an iterator of
+    :class:`FleetResult`, which can also cancel the operation.
+    '''
+
+    def __init__(self, operation, devices, max_workers, timeout=None, fleet_cancelled=None):
+        self._cancelled = threading.Event()
+        self._fleet_cancelled = threading.Event() if fleet_cancelled is None else fleet_cancelled
+        self._results = concurrency.imap_unordered(operation, devices, max_workers, timeout=timeout, cancel=self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return FleetResult(*next(self._results))
+
+    def cancel(self):
+        '''
+        Stop starting the operation on more devices. Devices which have not
+        finished are reported with a :exc:`wry.exceptions.OperationCancelled`
+        exception.
+        '''
+        self._cancelled.set()
+
+    def is_set(self):
+        '''Whether the operation has been cancelled, by itself or by its fleet.'''
+        return self._cancelled.is_set() or self._fleet_cancelled.is_set()
+
+
+def _resolve(device, path):
+    '''Follow a dotted attribute path, such as 'power.turn_on', from a device.'''
+    target = device
+    for name in path.split('.'):
+        target = getattr(target, name)
+    return target
+
+
+class AMTFleet(object):
+    '''
+    A group of :class:`wry.AMTDevice` instances, which can be operated on
+    concurrently:
+
+    >>> fleet = AMTFleet(devices)
+    >>> for result in fleet.call('power.turn_on'):
+    ...     print result.device, result.ok
+
+    Each operation starts as soon as it is called, and returns a
+    :class:`FleetOperation`: an iterator of :class:`FleetResult`, yielded in
+    the order that devices finish, rather than the order they were given in.
+    Iterate over it to wait for them all, or cancel it.
+    '''
+
+    def __init__(self, devices, max_workers=FLEET_MAX_WORKERS, timeout=None):
+        '''
+        :param max_workers: The maximum number of devices to operate on at once.
+        :param timeout: Default overall deadline for each operation, in seconds.
+        '''
+        self.devices = list(devices)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._cancel = threading.Event()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def run(self, operation, timeout=None):
+        '''
+        Call operation(device) for every device in the fleet.
+
+        :param timeout: Overall deadline in seconds, overriding self.timeout.
+        Devices which have not finished by then are reported with a
+        :exc:`wry.exceptions.DeadlineExceeded` exception.
+        :returns: A :class:`FleetOperation`.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        return FleetOperation(
+            operation,
+            self.devices,
+            self.max_workers,
+            timeout=timeout,
+            fleet_cancelled=self._cancel,
+        )
+
+    def call(self, path, *args, **kwargs):
+        '''
+        Call a method, given as a dotted path relative to the device, on every
+        device. eg. ``fleet.call('power.request_power_state_change', 8)``
+        '''
+        def operation(device):
+            return _resolve(device, path)(*args, **kwargs)
+        return self.run(operation)
+
+    def get(self, path):
+        '''Read an attribute, such as 'power.state', from every device.'''
+        return self.run(lambda device: _resolve(device, path))
+
+    def set(self, path, value):
+        '''Set an attribute, such as 'kvm.enabled', on every device.'''
+        parent, _, name = path.rpartition('.')
+        def operation(device):
+            target = _resolve(device, parent) if parent else device
+            setattr(target, name, value)
+        return self.run(operation)
+
+    def cancel(self):
+        '''
+        Cancel every operation started so far. Operations started afterwards
+        are not affected. To cancel a single operation, use
+        :meth:`FleetOperation.cancel`.
+        '''
+        cancel, self._cancel = self._cancel, threading.Event()
+        cancel.set()
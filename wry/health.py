@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Per-endpoint circuit breakers, so that requests to devices which are known to
+be unreachable fail immediately rather than waiting to time out.
+
+Breakers are keyed by (host, port), as several devices can share a host
+address behind NAT or port forwarding. The wsman_* functions consult REGISTRY
+before each request. Schedulers can use it to skip dead devices up front:
+
+>>> [device for device in devices if device.health != OPEN]
+"""
+
+import threading
+from time import time
+from wry.config import BREAKER_COOLDOWN, BREAKER_THRESHOLD
+from wry.exceptions import CircuitOpen
+
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Breaker(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+
+class HealthRegistry(object):
+    '''
+    Tracks consecutive connection failures per host, or per (host, port)
+    endpoint, as the wsman_* functions key them (see client_endpoint).
+
+    After threshold consecutive failures, a host's breaker opens, and requests
+    to it raise CircuitOpen without being sent. Once cooldown seconds have
+    passed, the breaker is half-open: a single request is let through as a
+    probe, and its outcome closes or reopens the breaker.
+
+    Instances are thread-safe.
+    '''
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = _Breaker()
+        return breaker
+
+    def _update(self, breaker):
+        if breaker.state == OPEN and time() >= breaker.opened + self.cooldown:
+            breaker.state = HALF_OPEN
+        return breaker.state
+
+    def before(self, host):
+        '''Raise CircuitOpen if a request should not be sent to host.'''
+        with self._lock:
+            breaker = self._breaker(host)
+            state = self._update(breaker)
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not breaker.probing:
+                breaker.probing = True
+                return
+        raise CircuitOpen('%s has failed %d consecutive connection attempts.' % (host, breaker.failures))
+
+    def success(self, host):
+        with self._lock:
+            breaker = self._breaker(host)
+            breaker.state = CLOSED
+            breaker.failures = 0
+            breaker.probing = False
+
+    def failure(self, host):
+        with self._lock:
+            breaker = self._breaker(host)
+            breaker.failures += 1
+            breaker.probing = False
+            if breaker.state == HALF_OPEN or breaker.failures >= self.threshold:
+                breaker.state = OPEN
+                breaker.opened = time()
+
+    def record(self, host, reachable):
+        if reachable:
+            self.success(host)
+        else:
+            self.failure(host)
+
+    def state(self, host):
+        '''Return the state of host's breaker: CLOSED, OPEN or HALF_OPEN.'''
+        with self._lock:
+            breaker = self._breakers.get(host)
+            return self._update(breaker) if breaker else CLOSED
+
+    def available(self, host):
+        '''Whether a request to host would currently be sent.'''
+        return self.state(host) != OPEN
+
+    def states(self):
+        '''Return a dict mapping each host seen to the state of its breaker.'''
+        with self._lock:
+            return dict((host, self._update(breaker)) for host, breaker in self._breakers.items())
+
+    def reset(self, host=None):
+        '''Forget the failures of host, or of every host.'''
+        with self._lock:
+            if host is None:
+                self._breakers.clear()
+            else:
+                self._breakers.pop(host, None)
+
+
+REGISTRY = HealthRegistry()
+
+
+def client_host(client):
+    '''The host a client talks to, or None if it cannot be told.'''
+    host = getattr(client, 'host', None)
+    if callable(host):
+        host = host()
+    return host
+
+
+def client_endpoint(client):
+    '''The (host, port) a client talks to, or None if its host cannot be told.'''
+    host = client_host(client)
+    if host is None:
+        return None
+    port = getattr(client, 'port', None)
+    if callable(port):
+        port = port()
+    return host, port
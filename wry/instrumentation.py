@@ -0,0 +1,263 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Measurements of the WS-Man requests made through the wsman_* functions.
+
+Each request is described by a :class:`Measurement`, passed to every hook
+registered with add_hook(). While none are, requests are not measured.
+:class:`Aggregator` is a hook which keeps latency histograms per host and
+action, and exports them in the Prometheus text format:
+
+>>> aggregator = Aggregator()
+>>> add_hook(aggregator)
+>>> dev.power.turn_on()
+>>> print aggregator.prometheus()
+"""
+
+import bisect
+import logging
+import threading
+from collections import namedtuple
+from functools import wraps
+from time import time
+from wry import health
+from wry.exceptions import WSManFault
+
+
+
+LOG = logging.getLogger(__name__)
+
+_hooks = []
+
+_local = threading.local()
+
+
+class Measurement(namedtuple('Measurement', ['host', 'resource_uri', 'action', 'seconds', 'build', 'network', 'parse',
+    'request_bytes', 'response_bytes', 'attempts', 'fault', 'error'])):
+    '''
+    A request, including any retries of it.
+
+    seconds is its wall time. build, network and parse are the parts of that
+    spent building request envelopes, talking to the device, and parsing its
+    responses: they, and the byte counts, are None where the transport does
+    not report them (as for those of wry.aio). For pywsman.Client, network is
+    the time spent in its calls, which build and parse envelopes in C, and
+    parse is the time spent decoding responses into WryDicts; build and the
+    byte counts are None. fault is the subcode of the WS-Man fault the device
+    answered with, if any, and error the name of the exception raised, if
+    any.
+    '''
+
+
+class Timing(object):
+    '''
+    The phases of the request being measured, as reported by the transport.
+    Those it cannot tell are set to None.
+    '''
+
+    __slots__ = ('build', 'network', 'parse', 'request_bytes', 'response_bytes', 'reported')
+
+    def __init__(self):
+        self.build = self.network = self.parse = 0.
+        self.request_bytes = self.response_bytes = 0
+        self.reported = False
+
+
+def add_hook(hook):
+    '''Call hook(measurement) after each request. Hooks are called on the thread that made it.'''
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def current():
+    '''The Timing of the request being measured on this thread, or None.'''
+    if not _hooks:
+        return None
+    return getattr(_local, 'timing', None)
+
+
+def _fault(result, error):
+    if isinstance(error, WSManFault):
+        return error.subcode
+    is_fault = getattr(result, 'is_fault', None)
+    if is_fault is not None and is_fault():
+        return result.fault().subcode()
+    return None
+
+
+def emit(action, args, kwargs, seconds, result=None, error=None, timing=None):
+    '''
+    Pass a Measurement of a call of a wsman_* function, with args and kwargs,
+    to each hook.
+    '''
+    reported = timing is not None and timing.reported
+    measurement = Measurement(
+        health.client_host(args[0]),
+        kwargs.get('resource_uri', args[1] if len(args) > 1 else None),
+        action,
+        seconds,
+        timing.build if reported else None,
+        timing.network if reported else None,
+        timing.parse if reported else None,
+        timing.request_bytes if reported else None,
+        timing.response_bytes if reported else None,
+        getattr(result if error is None else error, 'attempts', 1),
+        _fault(result, error),
+        None if error is None else type(error).__name__,
+    )
+    for hook in list(_hooks):
+        try:
+            hook(measurement)
+        except Exception:
+            LOG.exception('An instrumentation hook failed.')
+
+
+def instrument(action):
+    '''
+    Measure each call of infunc(client, resource_uri, ...), as a request for
+    action (eg. 'Get'), when any hooks are registered.
+    '''
+    def decorator(infunc):
+        @wraps(infunc)
+        def newfunc(*args, **kwargs):
+            if not _hooks:
+                return infunc(*args, **kwargs)
+            outer = getattr(_local, 'timing', None)
+            timing = _local.timing = Timing()
+            result = error = None
+            started = time()
+            try:
+                result = infunc(*args, **kwargs)
+                return result
+            except Exception as error:
+                raise
+            finally:
+                _local.timing = outer
+                emit(action, args, kwargs, time() - started, result, error, timing)
+        return newfunc
+    return decorator
+
+
+def _label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Series(object):
+    __slots__ = ('counts', 'total', 'count', 'phases', 'request_bytes', 'response_bytes', 'retries', 'faults', 'errors')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.
+        self.count = 0
+        self.phases = [0., 0., 0.]
+        self.request_bytes = self.response_bytes = self.retries = 0
+        self.faults = {}
+        self.errors = {}
+
+    def copy(self):
+        output = _Series(())
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(output, name, type(value)(value) if isinstance(value, (list, dict)) else value)
+        return output
+
+
+class Aggregator(object):
+    '''
+    A hook keeping, per (host, action), a histogram of request latencies,
+    the time spent in each phase, bytes sent and received, retries, and
+    counts of faults (by subcode) and errors (by exception). Instances are
+    thread-safe.
+    '''
+
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=BUCKETS, prefix='wry_'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, measurement):
+        key = (measurement.host, measurement.action)
+        index = bisect.bisect_left(self.buckets, measurement.seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.buckets)
+            series.counts[index] += 1
+            series.total += measurement.seconds
+            series.count += 1
+            series.retries += measurement.attempts - 1
+            for index, seconds in enumerate((measurement.build, measurement.network, measurement.parse)):
+                if seconds is not None:
+                    series.phases[index] += seconds
+            if measurement.request_bytes is not None:
+                series.request_bytes += measurement.request_bytes
+                series.response_bytes += measurement.response_bytes
+            if measurement.fault is not None:
+                series.faults[measurement.fault] = series.faults.get(measurement.fault, 0) + 1
+            if measurement.error is not None:
+                series.errors[measurement.error] = series.errors.get(measurement.error, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def prometheus(self):
+        '''The aggregated measurements, in the Prometheus text exposition format.'''
+        with self._lock:
+            snapshot = sorted((key, series.copy()) for key, series in self._series.items())
+        name = lambda metric: self.prefix + metric
+        lines = []
+
+        def family(metric, kind, description):
+            lines.append('# HELP %s %s' % (name(metric), description))
+            lines.append('# TYPE %s %s' % (name(metric), kind))
+
+        def labels(host, action, **extra):
+            pairs = [('host', host or ''), ('action', action)] + sorted(extra.items())
+            return '{%s}' % ','.join('%s="%s"' % (label, _label(value)) for label, value in pairs)
+
+        family('request_duration_seconds', 'histogram', 'Wall time of WS-Man requests, including retries.')
+        for (host, action), series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name('request_duration_seconds'), labels(host, action, le=repr(float(bound))), cumulative))
+            lines.append('%s_bucket%s %d' % (name('request_duration_seconds'), labels(host, action, le='+Inf'), series.count))
+            lines.append('%s_sum%s %r' % (name('request_duration_seconds'), labels(host, action), series.total))
+            lines.append('%s_count%s %d' % (name('request_duration_seconds'), labels(host, action), series.count))
+        family('request_phase_seconds_total', 'counter', 'Time spent building, sending and parsing WS-Man requests.')
+        for (host, action), series in snapshot:
+            for phase, seconds in zip(('build', 'network', 'parse'), series.phases):
+                lines.append('%s%s %r' % (name('request_phase_seconds_total'), labels(host, action, phase=phase), seconds))
+        family('request_bytes_total', 'counter', 'Bytes of WS-Man requests and responses.')
+        for (host, action), series in snapshot:
+            lines.append('%s%s %d' % (name('request_bytes_total'), labels(host, action, direction='sent'), series.request_bytes))
+            lines.append('%s%s %d' % (name('request_bytes_total'), labels(host, action, direction='received'), series.response_bytes))
+        family('request_retries_total', 'counter', 'Retried WS-Man requests.')
+        for (host, action), series in snapshot:
+            lines.append('%s%s %d' % (name('request_retries_total'), labels(host, action), series.retries))
+        family('request_faults_total', 'counter', 'WS-Man faults, by subcode.')
+        for (host, action), series in snapshot:
+            for subcode, count in sorted(series.faults.items()):
+                lines.append('%s%s %d' % (name('request_faults_total'), labels(host, action, subcode=subcode), count))
+        family('request_errors_total', 'counter', 'WS-Man requests which raised, by exception.')
+        for (host, action), series in snapshot:
+            for exception, count in sorted(series.errors.items()):
+                lines.append('%s%s %d' % (name('request_errors_total'), labels(host, action, exception=exception), count))
+        return '\n'.join(lines) + '\n'
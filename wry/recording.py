@@ -0,0 +1,311 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Recording the WS-Man traffic between wry and devices, and replaying it later
+without them: to reproduce problems seen in production, or to benchmark
+parsing and orchestration against real traces.
+
+>>> with Recorder('trace.jsonl.gz') as recorder:
+...     dev = AMTDevice(address, 'http', username, password, transport=recorder.wrap(HTTPTransport))
+...     dev.dump()
+
+>>> recording = Recording('trace.jsonl.gz')
+>>> dev = AMTDevice(address, 'http', username, password, transport=recording.transport)
+>>> dev.dump() # Served from the recording, as fast as possible.
+
+Recordings are files of JSON lines, one per request, appended to as requests
+are made. Those whose names end in .gz are gzipped. Each line holds the
+request's envelope, as wry's own transports build it, for reading; requests
+are replayed by matching their keys (see Recording).
+"""
+
+import gzip
+import json
+import threading
+from collections import defaultdict
+from time import sleep, time
+from wry import instrumentation
+from wry import wsman
+from wry.common import Transport
+from wry.data_structures import WryOptions
+
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _key(host, operation, resource_uri, options, method=None, context=None, data=None):
+    selectors = getattr(options, 'selectors', None)
+    return (host, operation, resource_uri, method, tuple(map(tuple, selectors)) if selectors else None, context, data)
+
+
+class Recorder(object):
+    '''
+    Appends each request made through the transports it wraps, with the
+    response and the seconds it took, to the file at path. Instances are
+    thread-safe.
+
+    Plain files are flushed after each request, so that a recording survives
+    the process being killed. Gzipped ones are only complete once closed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time()
+        self._file = _open(path, 'ab')
+        self._flush = not path.endswith('.gz')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def wrap(self, transport):
+        '''
+        Return a transport factory, for AMTDevice, which records the requests
+        made through transport (a class such as pywsman.Client, or
+        transport.HTTPTransport).
+        '''
+        def factory(location, *args):
+            url = '%s://%s:%s%s' % (args[2], location, args[0], args[1]) if len(args) >= 3 else location
+            return RecordingTransport(transport(location, *args), self, location, url)
+        return factory
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(',', ':'), sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            if self._flush:
+                self._file.flush()
+
+
+class RecordingTransport(Transport):
+    '''Passes requests to another transport, and records them with a Recorder.'''
+
+    def __init__(self, client, recorder, host, url=None):
+        self.client = client
+        self.recorder = recorder
+        self.host = host
+        self.url = url or host
+        self.native = not hasattr(client, 'new_options')
+
+    @property
+    def thread_safe(self):
+        return getattr(self.client, 'thread_safe', False)
+
+    @property
+    def port(self):
+        port = getattr(self.client, 'port', None)
+        return port() if callable(port) else port
+
+    def set_dumpfile(self, dumpfile):
+        self.client.set_dumpfile(dumpfile)
+
+    def _envelope(self, build, options):
+        '''
+        The envelope build(options) makes for a request, or None for native
+        options, which cannot tell what they would add to it.
+        '''
+        if not isinstance(options, WryOptions):
+            return None
+        timing = instrumentation.current()
+        spent = timing.build if timing is not None else None
+        try:
+            return build(options)
+        finally:
+            if timing is not None:
+                timing.build = spent # The wrapped transport builds its own.
+
+    def _call(self, operation, resource_uri, options, call, build, method=None, context=None, data=None):
+        if self.native and isinstance(options, WryOptions):
+            native = options.native()
+        else:
+            native = options
+        started = time()
+        doc = call(native)
+        seconds = time() - started
+        key = _key(self.host, operation, resource_uri, options, method, context, data)
+        self.recorder.write({
+            'host': key[0],
+            'op': key[1],
+            'uri': key[2],
+            'method': key[3],
+            'selectors': key[4],
+            'context': key[5],
+            'data': key[6],
+            'native': options is not None and not isinstance(options, WryOptions), # Selectors unknown.
+            'at': round(started - self.recorder.started, 6),
+            'seconds': round(seconds, 6),
+            'request': self._envelope(build, options),
+            'response': None if doc is None else doc.root().string(),
+        })
+        return doc
+
+    def get(self, options, resource_uri):
+        return self._call('get', resource_uri, options, lambda native: self.client.get(native, resource_uri),
+            lambda options: wsman.get_request(self.url, resource_uri, options))
+
+    def put(self, options, resource_uri, data, length=None):
+        return self._call('put', resource_uri, options,
+            lambda native: self.client.put(native, resource_uri, data, len(data)),
+            lambda options: wsman.put_request(self.url, resource_uri, data, options), data=data)
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        return self._call('enumerate', resource_uri, options,
+            lambda native: self.client.enumerate(native, wsman_filter, resource_uri),
+            lambda options: wsman.enumerate_request(self.url, resource_uri, options, wsman_filter))
+
+    def pull(self, options, wsman_filter, resource_uri, context):
+        return self._call('pull', resource_uri, options,
+            lambda native: self.client.pull(native, wsman_filter, resource_uri, context),
+            lambda options: wsman.pull_request(self.url, resource_uri, context, options), context=context)
+
+    def invoke(self, options, resource_uri, method, data):
+        body = data
+        if self.native:
+            import pywsman
+            body = pywsman.create_doc_from_string(str(data))
+        return self._call('invoke', resource_uri, options,
+            lambda native: self.client.invoke(native, resource_uri, method, body),
+            lambda options: wsman.invoke_request(self.url, resource_uri, method, data, options), method=method, data=data)
+
+    def identify(self, options):
+        return self._call('identify', None, options, lambda native: self.client.identify(native),
+            lambda options: wsman.identify_request())
+
+    def subscribe(self, options, wsman_filter, resource_uri):
+        return self._call('subscribe', resource_uri, options,
+            lambda native: self.client.subscribe(native, wsman_filter, resource_uri),
+            lambda options: wsman.subscribe_request(self.url, resource_uri, options, wsman_filter))
+
+    def renew(self, options, resource_uri, identifier):
+        return self._call('renew', resource_uri, options,
+            lambda native: self.client.renew(native, resource_uri, identifier),
+            lambda options: wsman.renew_request(self.url, resource_uri, identifier, options), context=identifier)
+
+    def unsubscribe(self, options, wsman_filter, resource_uri, identifier):
+        return self._call('unsubscribe', resource_uri, options,
+            lambda native: self.client.unsubscribe(native, wsman_filter, resource_uri, identifier),
+            lambda options: wsman.unsubscribe_request(self.url, resource_uri, identifier, options), context=identifier)
+
+
+class Recording(object):
+    '''
+    The requests in a recording, and their responses, for ReplayTransports
+    to serve.
+
+    Requests are matched on their host, operation, resource, method,
+    selectors, enumeration context (or subscription identifier) and data.
+    Each is answered with the responses recorded for it in turn, starting
+    again from the first once they run out. Subscriptions are matched
+    whatever their delivery URI and expiration, which differ from run to run.
+    Requests recorded with native options (such as pywsman.ClientOptions),
+    whose selectors cannot be told, match requests with any selectors for
+    which nothing else was recorded.
+    '''
+
+    def __init__(self, path, speed=None):
+        '''
+        :param speed: If given, each response is delayed by the time it took
+        when recorded, divided by speed: 1 replays at recorded speed, 2 at
+        twice it. By default, responses are immediate.
+        '''
+        self.path = path
+        self.speed = speed
+        self.entries = defaultdict(list)
+        self._served = defaultdict(int)
+        self._lock = threading.Lock()
+        with _open(path, 'rb') as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = (entry['host'], entry['op'], entry['uri'], entry['method'],
+                    tuple(map(tuple, entry['selectors'])) if entry['selectors'] else None, entry['context'], entry['data'])
+                self.entries[key].append((entry['seconds'], entry['response']))
+                # Native options cannot tell their selectors, so those requests match any.
+                if entry.get('native'):
+                    self.entries[key[:4] + ('*', ) + key[5:]].append((entry['seconds'], entry['response']))
+
+    def __len__(self):
+        return sum(len(responses) for key, responses in self.entries.items() if key[4] != '*')
+
+    def transport(self, location, *args):
+        '''A transport factory, for AMTDevice, serving the requests recorded for location.'''
+        return ReplayTransport(self, location, args[0] if args else None)
+
+    def respond(self, key):
+        '''The seconds taken, and the response, recorded for the next request matching key.'''
+        matched = key if key in self.entries else key[:4] + ('*', ) + key[5:]
+        responses = self.entries.get(matched)
+        if not responses:
+            raise LookupError('Nothing was recorded for %r.' % (key, ))
+        with self._lock:
+            index = self._served[matched] % len(responses)
+            self._served[matched] += 1
+        return responses[index]
+
+
+class ReplayTransport(Transport):
+    '''Serves a device's requests from a Recording.'''
+
+    thread_safe = True
+
+    def __init__(self, recording, host, port=None):
+        self.recording = recording
+        self.host = host
+        self.port = port
+
+    def _respond(self, operation, resource_uri, options, method=None, context=None, data=None):
+        seconds, response = self.recording.respond(_key(self.host, operation, resource_uri, options, method, context, data))
+        if self.recording.speed:
+            sleep(seconds / self.recording.speed)
+        if response is None:
+            return None
+        return wsman.XmlDoc(response.encode('utf-8'))
+
+    def get(self, options, resource_uri):
+        return self._respond('get', resource_uri, options)
+
+    def put(self, options, resource_uri, data, length=None):
+        return self._respond('put', resource_uri, options, data=data)
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        return self._respond('enumerate', resource_uri, options)
+
+    def pull(self, options, wsman_filter, resource_uri, context):
+        return self._respond('pull', resource_uri, options, context=context)
+
+    def invoke(self, options, resource_uri, method, data):
+        return self._respond('invoke', resource_uri, options, method=method, data=data)
+
+    def identify(self, options):
+        return self._respond('identify', None, options)
+
+    def subscribe(self, options, wsman_filter, resource_uri):
+        return self._respond('subscribe', resource_uri, options)
+
+    def renew(self, options, resource_uri, identifier):
+        return self._respond('renew', resource_uri, options, context=identifier)
+
+    def unsubscribe(self, options, wsman_filter, resource_uri, identifier):
+        return self._respond('unsubscribe', resource_uri, options, context=identifier)
@@ -0,0 +1,264 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Reimaging many devices: setting them to boot from the network, then resetting
+them, in waves, so as not to flood DHCP/TFTP servers or trip power limits.
+
+>>> reimager = Reimager(devices, checkpoint='rack-12.jsonl')
+>>> for result in reimager.run():
+...     print result.device.location, result.ok
+"""
+
+import functools
+import json
+import os
+import threading
+from time import time
+from wry import concurrency
+from wry import exceptions
+from wry import health
+from wry.config import (FLEET_MAX_WORKERS, REIMAGE_CONFIRM_TIMEOUT, REIMAGE_STARTS_PER_SECOND, REIMAGE_WAVE_SIZE,
+    WATCH_FAST_INTERVAL)
+from wry.fleet import FleetResult, _resolve
+from wry.watch import PowerWatcher, poll_power_state
+
+
+
+STARTED = 'started'
+ACTED = 'acted' # The power action was called; confirmation is outstanding.
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _key(device):
+    return getattr(device, 'location', None) or health.client_host(device.client)
+
+
+class Reimager(object):
+    '''
+    Sets each device's boot medium, then calls its power action, a wave of
+    wave_size devices at a time.
+
+    Within a wave, up to max_workers devices are worked on at once, and no
+    more than starts_per_second of them begin each second. If confirm_state
+    is given (eg. 'on'), the next wave only starts once the devices of this
+    one are in that power state, or confirm_timeout seconds have passed;
+    those which are not are reported as failed. A device which was already
+    in confirm_state before its power action (as with the default reset,
+    and 'on') must also be seen out of it afterwards. Its state is polled
+    every poll_interval seconds from before the wave's power actions, so a
+    reset which is over between two polls is reported as failed.
+
+    If checkpoint is given, each device's progress is appended to that file,
+    a JSON line per transition, keyed by address. When a run is interrupted,
+    another with the same checkpoint skips the devices which were done, only
+    confirms those whose power action was called (which need only be in
+    confirm_state, as their change of state may have passed unwatched), and
+    retries the rest.
+    '''
+
+    def __init__(self, devices, medium='Network', power_action='power.reset', wave_size=REIMAGE_WAVE_SIZE,
+        max_workers=FLEET_MAX_WORKERS, starts_per_second=REIMAGE_STARTS_PER_SECOND, confirm_state=None,
+        confirm_timeout=REIMAGE_CONFIRM_TIMEOUT, poll_interval=WATCH_FAST_INTERVAL, checkpoint=None):
+        '''
+        :param power_action: A method to call after setting the medium, as a
+        dotted path relative to the device. If None, the medium is only set.
+        :param starts_per_second: If None, devices are not rate limited.
+        '''
+        self.devices = list(devices)
+        self.medium = medium
+        self.power_action = power_action
+        self.wave_size = wave_size
+        self.max_workers = max_workers
+        self.confirm_state = confirm_state
+        self.confirm_timeout = confirm_timeout
+        self.poll_interval = poll_interval
+        self.checkpoint = checkpoint
+        self.progress = {}
+        self._limiter = concurrency.RateLimiter(starts_per_second) if starts_per_second else None
+        self._lock = threading.Lock()
+        self._outfile = None
+        self._cut_short = False
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as infile:
+                for line in infile:
+                    self._cut_short = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # A line cut short when a run was interrupted.
+                    self.progress[entry['device']] = {'state': entry['state'], 'error': entry['error']}
+
+    def _state(self, device):
+        return self.progress.get(_key(device), {}).get('state')
+
+    @property
+    def pending(self):
+        '''The devices which have not yet been reimaged.'''
+        return [device for device in self.devices if self._state(device) != DONE]
+
+    def _record(self, device, state, error=None):
+        key = _key(device)
+        error = None if error is None else str(error)
+        with self._lock:
+            self.progress[key] = {'state': state, 'error': error}
+            if self._outfile is not None:
+                self._outfile.write(json.dumps({'device': key, 'state': state, 'error': error}) + '\n')
+                self._outfile.flush()
+
+    def _reimage(self, device, confirmation=None):
+        if self._limiter is not None:
+            self._limiter.acquire()
+        self._record(device, STARTED)
+        device.boot.medium = self.medium
+        if not self.power_action:
+            self._record(device, ACTED)
+            return None
+        if confirmation is not None:
+            confirmation.set_before(device, poll_power_state(device.client, getattr(device, 'options', None)))
+        value = _resolve(device, self.power_action)()
+        self._record(device, ACTED)
+        return value
+
+    def _confirm(self, confirmation, devices):
+        '''Wait for devices to reach confirm_state, and return those which did not.'''
+        return confirmation.wait(devices)
+
+    def run(self):
+        '''
+        Reimage the pending devices, and yield a :class:`wry.fleet.FleetResult`
+        for each as it finishes. Devices whose power action was called by an
+        interrupted run are only confirmed, and reported with a value of None.
+        '''
+        pending = self.pending
+        acted = [device for device in pending if self._state(device) == ACTED]
+        pending = [device for device in pending if self._state(device) != ACTED]
+        if self.checkpoint:
+            self._outfile = open(self.checkpoint, 'a')
+            if self._cut_short:
+                self._outfile.write('\n') # So that the next line is not lost after it.
+                self._cut_short = False
+        try:
+            for devices, resumed in ((acted, True), (pending, False)):
+                for start in range(0, len(devices), self.wave_size):
+                    for result in self._wave(devices[start:start + self.wave_size], resumed):
+                        yield result
+        finally:
+            with self._lock:
+                outfile, self._outfile = self._outfile, None
+            if outfile is not None:
+                outfile.close()
+
+    def _wave(self, wave, resumed):
+        '''
+        Reimage a wave of devices (or, if resumed, only confirm them), and
+        yield a FleetResult for each.
+        '''
+        confirmation = None
+        if self.confirm_state:
+            confirmation = _Confirmation(wave, self.confirm_state, self.confirm_timeout, self.poll_interval,
+                min(self.max_workers, len(wave)))
+        try:
+            if resumed:
+                outcomes = [(device, None, None) for device in wave]
+            else:
+                outcomes = concurrency.imap_unordered(
+                    functools.partial(self._reimage, confirmation=confirmation), wave, self.max_workers)
+            succeeded = []
+            for device, value, error in outcomes:
+                if error is not None:
+                    self._record(device, FAILED, error)
+                    yield FleetResult(device, None, error)
+                elif confirmation is None:
+                    self._record(device, DONE)
+                    yield FleetResult(device, value, None)
+                else:
+                    succeeded.append((device, value))
+            if not succeeded:
+                return
+            unconfirmed = self._confirm(confirmation, [device for device, _ in succeeded])
+            for device, value in succeeded:
+                if device in unconfirmed:
+                    error = exceptions.DeadlineExceeded('%s was not %r, after a change of power state, within %ss.' % (
+                        _key(device), self.confirm_state, self.confirm_timeout))
+                    self._record(device, FAILED, error)
+                    yield FleetResult(device, None, error)
+                else:
+                    self._record(device, DONE)
+                    yield FleetResult(device, value, None)
+        finally:
+            if confirmation is not None:
+                confirmation.close()
+
+
+class _Confirmation(object):
+    '''
+    Watches a wave's devices from before their power actions are called, and
+    notes those seen out of the power state they were in beforehand, so that
+    a device which never changed state is not taken to have been reset.
+    '''
+
+    def __init__(self, devices, state, timeout, poll_interval, max_workers):
+        self.state = state
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.before = {}
+        self.departed = set()
+        self._condition = threading.Condition()
+        self.watcher = PowerWatcher(devices, fast_interval=poll_interval, max_workers=max_workers)
+        self.watcher.subscribe(self._transition)
+        self.watcher.start()
+
+    def set_before(self, device, state):
+        '''Note the state of device before its power action is called, and watch it closely from then on.'''
+        with self._condition:
+            self.before[device] = state.state
+        self.watcher.hurry(device, duration=self.timeout)
+
+    def _note(self, device, state):
+        before = self.before.get(device)
+        if before is not None and state is not None and state.state != before:
+            self.departed.add(device)
+
+    def _transition(self, transition):
+        with self._condition:
+            self._note(transition.device, transition.previous)
+            self._note(transition.device, transition.current)
+            self._condition.notify_all()
+
+    def _confirmed(self, device, current):
+        if current is None or current.state != self.state:
+            return False
+        # A device already in the state before its action must be seen leaving it.
+        return self.before.get(device) != self.state or device in self.departed
+
+    def wait(self, devices):
+        '''
+        Wait up to timeout seconds for devices to reach the state, and return
+        those which did not. Devices whose state before their power action is
+        not known (as when a run is resumed) need only be in it.
+        '''
+        deadline = time() + self.timeout
+        with self._condition:
+            while True:
+                states = self.watcher.states()
+                for device in devices:
+                    self._note(device, states.get(device))
+                unconfirmed = [device for device in devices if not self._confirmed(device, states.get(device))]
+                remaining = deadline - time()
+                if not unconfirmed or remaining <= 0:
+                    return unconfirmed
+                self._condition.wait(min(remaining, self.poll_interval))
+
+    def close(self):
+        self.watcher.stop()
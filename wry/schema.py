@@ -0,0 +1,283 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+The types of the fields of the resources wry knows about, and converters
+between them and the strings found in WS-Man XML.
+
+A field's type is int, bool or unicode, or a list containing one of those for
+array properties. Fields not listed here have their types guessed.
+"""
+
+
+
+FIELD_TYPES = {
+    'CIM_AssociatedPowerManagementService': {
+        'AvailableRequestedPowerStates': [int],
+        'OtherPowerState': unicode,
+        'PowerOnTime': unicode,
+        'PowerState': int,
+        'RequestedPowerState': int,
+        'TransitioningToPowerState': int,
+    },
+    'CIM_PowerManagementService': {
+        'CreationClassName': unicode,
+        'ElementName': unicode,
+        'EnabledState': int,
+        'Name': unicode,
+        'RequestedState': int,
+        'SystemCreationClassName': unicode,
+        'SystemName': unicode,
+    },
+    'CIM_ComputerSystem': {
+        'CreationClassName': unicode,
+        'Dedicated': [int],
+        'ElementName': unicode,
+        'EnabledState': int,
+        'HealthState': int,
+        'IdentifyingDescriptions': [unicode],
+        'Name': unicode,
+        'NameFormat': unicode,
+        'OperationalStatus': [int],
+        'OtherDedicatedDescriptions': [unicode],
+        'OtherIdentifyingInfo': [unicode],
+        'PowerManagementCapabilities': [int],
+        'PrimaryOwnerContact': unicode,
+        'PrimaryOwnerName': unicode,
+        'RequestedState': int,
+        'ResetCapability': int,
+        'Roles': [unicode],
+        'StatusDescriptions': [unicode],
+    },
+    'CIM_BootConfigSetting': {
+        'ElementName': unicode,
+        'InstanceID': unicode,
+    },
+    'CIM_BootSourceSetting': {
+        'BIOSBootString': unicode,
+        'BootString': unicode,
+        'ElementName': unicode,
+        'FailThroughSupported': int,
+        'InstanceID': unicode,
+        'StructuredBootString': unicode,
+    },
+    'CIM_BootService': {
+        'CreationClassName': unicode,
+        'ElementName': unicode,
+        'EnabledState': int,
+        'Name': unicode,
+        'OperationalStatus': [int],
+        'RequestedState': int,
+        'SystemCreationClassName': unicode,
+        'SystemName': unicode,
+    },
+    'CIM_KVMRedirectionSAP': {
+        'CreationClassName': unicode,
+        'ElementName': unicode,
+        'EnabledState': int,
+        'KVMProtocol': int,
+        'Name': unicode,
+        'RequestedState': int,
+        'SystemCreationClassName': unicode,
+        'SystemName': unicode,
+    },
+    'IPS_KVMRedirectionSettingData': {
+        'BackToBackFbMode': bool,
+        'DefaultScreen': int,
+        'ElementName': unicode,
+        'EnabledByMEBx': bool,
+        'InstanceID': unicode,
+        'Is5900PortEnabled': bool,
+        'OptInPolicy': bool,
+        'OptInPolicyTimeout': int,
+        'RFBPassword': unicode,
+        'SessionTimeout': int,
+        'ZlibControlSupported': bool,
+    },
+    'AMT_RedirectionService': {
+        'AccessLog': [unicode],
+        'CreationClassName': unicode,
+        'ElementName': unicode,
+        'EnabledState': int,
+        'ListenerEnabled': bool,
+        'Name': unicode,
+        'SystemCreationClassName': unicode,
+        'SystemName': unicode,
+    },
+    'AMT_TLSSettingData': {
+        'AcceptNonSecureConnections': bool,
+        'ElementName': unicode,
+        'Enabled': bool,
+        'InstanceID': unicode,
+        'MutualAuthentication': bool,
+        'TrustedCN': [unicode],
+    },
+    'AMT_BootCapabilities': {
+        'BIOSPause': bool,
+        'BIOSReflash': bool,
+        'BIOSSecureBoot': bool,
+        'BIOSSetup': bool,
+        'ConfigurationDataReset': bool,
+        'ElementName': unicode,
+        'ForceCDorDVDBoot': bool,
+        'ForceDiagnosticBoot': bool,
+        'ForceHardDriveBoot': bool,
+        'ForceHardDriveSafeModeBoot': bool,
+        'ForcePXEBoot': bool,
+        'ForcedProgressEvents': bool,
+        'IDER': bool,
+        'InstanceID': unicode,
+        'KeyboardLock': bool,
+        'PowerButtonLock': bool,
+        'ResetButtonLock': bool,
+        'SOL': bool,
+        'SecureErase': bool,
+        'SleepButtonLock': bool,
+        'UserPasswordBypass': bool,
+        'VerbosityQuiet': bool,
+        'VerbosityScreenBlank': bool,
+        'VerbosityVerbose': bool,
+    },
+    'AMT_BootSettingData': {
+        'BIOSLastStatus': [int],
+        'BIOSPause': bool,
+        'BIOSSetup': bool,
+        'BootMediaIndex': int,
+        'ConfigurationDataReset': bool,
+        'ElementName': unicode,
+        'EnforceSecureBoot': bool,
+        'FirmwareVerbosity': int,
+        'ForcedProgressEvents': bool,
+        'IDERBootDevice': int,
+        'InstanceID': unicode,
+        'LockKeyboard': bool,
+        'LockPowerButton': bool,
+        'LockResetButton': bool,
+        'LockSleepButton': bool,
+        'OptionsCleared': bool,
+        'OwningEntity': unicode,
+        'ReflashBIOS': bool,
+        'RSEPassword': unicode,
+        'SecureErase': bool,
+        'UseIDER': bool,
+        'UseSafeMode': bool,
+        'UseSOL': bool,
+        'UserPasswordBypass': bool,
+    },
+    'AMT_EthernetPortSettings': {
+        'ConsoleTcpMaxRetransmissions': int,
+        'DefaultGateway': unicode,
+        'DHCPEnabled': bool,
+        'ElementName': unicode,
+        'InstanceID': unicode,
+        'IpSyncEnabled': bool,
+        'IPAddress': unicode,
+        'LinkControl': int,
+        'LinkIsUp': bool,
+        'LinkPolicy': [int],
+        'LinkPreference': int,
+        'MACAddress': unicode,
+        'PhysicalConnectionType': int,
+        'PrimaryDNS': unicode,
+        'SecondaryDNS': unicode,
+        'SharedDynamicIP': bool,
+        'SharedMAC': bool,
+        'SharedStaticIp': bool,
+        'SubnetMask': unicode,
+        'WLANLinkProtectionLevel': int,
+    },
+    'AMT_GeneralSettings': {
+        'AMTNetworkEnabled': int,
+        'DDNSPeriodicUpdateInterval': int,
+        'DDNSTTL': int,
+        'DDNSUpdateByDHCPServerEnabled': bool,
+        'DDNSUpdateEnabled': bool,
+        'DHCPv6ConfigurationTimeout': int,
+        'DigestRealm': unicode,
+        'DomainName': unicode,
+        'ElementName': unicode,
+        'HostName': unicode,
+        'HostOSFQDN': unicode,
+        'IdleWakeTimeout': int,
+        'InstanceID': unicode,
+        'NetworkInterfaceEnabled': bool,
+        'PingResponseEnabled': bool,
+        'PowerSource': int,
+        'PreferredAddressFamily': int,
+        'PresenceNotificationInterval': int,
+        'PrivacyLevel': int,
+        'RmcpPingResponseEnabled': bool,
+        'SharedFQDN': bool,
+        'ThunderboltDockEnabled': int,
+        'WsmanOnlyMode': bool,
+    },
+}
+
+
+_BOOLEANS = {u'true': True, u'false': False}
+
+
+def _decode_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value # Nil, or carrying attributes.
+
+
+def _decode_bool(value):
+    if isinstance(value, basestring):
+        return _BOOLEANS.get(value.lower(), value)
+    return value
+
+
+def _decode_unicode(value):
+    return value
+
+
+def _encode_bool(value):
+    if isinstance(value, basestring):
+        return value.lower()
+    return u'true' if value else u'false'
+
+
+_DECODERS = {int: _decode_int, bool: _decode_bool, unicode: _decode_unicode}
+
+_ENCODERS = {int: unicode, bool: _encode_bool, unicode: unicode}
+
+
+def _list_of(convert):
+    def convert_list(value):
+        if value is None:
+            return value
+        if not isinstance(value, (list, tuple)):
+            value = [value] # A single element.
+        return [item if isinstance(item, dict) else convert(item) for item in value]
+    return convert_list
+
+
+def _compile(converters):
+    output = {}
+    for resource_name, fields in FIELD_TYPES.iteritems():
+        output[resource_name] = compiled = {}
+        for field, field_type in fields.iteritems():
+            if isinstance(field_type, list):
+                compiled[field] = _list_of(converters[field_type[0]])
+            else:
+                compiled[field] = converters[field_type]
+    return output
+
+
+DECODERS = _compile(_DECODERS)
+'''resource name -> {field: function converting a decoded XML value}'''
+
+ENCODERS = _compile(_ENCODERS)
+'''resource name -> {field: function converting a value to its XML text}'''
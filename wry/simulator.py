@@ -0,0 +1,660 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Simulated AMT devices, for load testing wry, and what is built on it, against
+thousands of devices from one process, without the hardware.
+
+Each :class:`VirtualDevice` answers WS-Man Identify, Get, Put, Enumerate, Pull
+and Invoke for the resources in config.RESOURCE_METHODS, keeping its power
+state, boot source and KVM state as a real device would. A :class:`Simulator`
+serves them over HTTP, with digest authentication, from a single thread.
+
+Devices can each be given a port of their own:
+
+>>> simulator = Simulator()
+>>> port = simulator.listen(device=VirtualDevice(latency=lognormal(.05, .5)))
+>>> simulator.start()
+
+Or many can share one, as virtual hosts, being chosen by the address the
+client connected to (or else its Host header). On Linux, every 127.x.y.z
+address reaches the loopback interface, so:
+
+>>> simulator.listen(('', 16992))
+>>> for address in discovery.iter_addresses(['127.1.0.0/20']):
+...     simulator.add(address, VirtualDevice())
+
+Or, from the command line:
+
+    $ python -m wry.simulator --listen :16992 --network 127.1.0.0/20 --latency .05
+"""
+
+import argparse
+import errno
+import hashlib
+import logging
+import math
+import os
+import random
+import re
+import socket
+import threading
+import uuid
+from collections import OrderedDict, deque
+from time import time
+from xml.sax.saxutils import escape
+from wry import wsman
+from wry.config import RESOURCE_METHODS, SCHEMAS
+from wry.eventloop import EventLoop, Future, Return, coroutine, sleep
+
+
+
+LOG = logging.getLogger(__name__)
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+_TRANSFER = wsman.NAMESPACES['transfer']
+_ENUMERATION = wsman.NAMESPACES['enumeration']
+_SOAP = '{%s}' % wsman.NAMESPACES['soap']
+_ADDRESSING = '{%s}' % wsman.NAMESPACES['addressing']
+_WSMAN = '{%s}' % wsman.NAMESPACES['wsman']
+
+_BOOT_SOURCES = [
+    ('Intel(r) AMT: Force Hard-drive Boot', 'CIM:Hard-Disk:1'),
+    ('Intel(r) AMT: Force PXE Boot', 'CIM:Network:1'),
+    ('Intel(r) AMT: Force CD/DVD Boot', 'CIM:CD/DVD:1'),
+]
+
+# The state a device reports after each RequestPowerStateChange PowerState.
+_POWER_OUTCOMES = {
+    2: 2, # On
+    3: 3, # Sleep - Light
+    4: 4, # Sleep - Deep
+    5: 2, # Power Cycle (Off - Soft)
+    6: 8, # Off - Hard
+    7: 7, # Hibernate
+    8: 8, # Off - Soft
+    9: 2, # Power Cycle (Off - Hard)
+    10: 2, # Master Bus Reset
+    11: 2, # Diagnostic Interrupt (NMI)
+}
+
+
+def default_resources():
+    '''The fields of each resource a VirtualDevice starts with, keyed by resource name.'''
+    resources = OrderedDict((name, OrderedDict([('ElementName', name)])) for name in sorted(RESOURCE_METHODS))
+    resources['CIM_AssociatedPowerManagementService'].update([
+        ('AvailableRequestedPowerStates', [2, 5, 8, 10]),
+        ('PowerState', 2),
+    ])
+    resources['CIM_PowerManagementService'].update([
+        ('ElementName', 'Intel(r) AMT Power Management Service'),
+        ('Name', 'Intel(r) AMT Power Management Service'),
+    ])
+    resources['CIM_ComputerSystem'].update([('Name', 'ManagedSystem'), ('EnabledState', 2)])
+    resources['CIM_BootConfigSetting'].update([
+        ('ElementName', 'Intel(r) AMT: Boot Configuration'),
+        ('InstanceID', 'Intel(r) AMT: Boot Configuration 0'),
+    ])
+    resources['CIM_BootService'].update([('ElementName', 'Intel(r) AMT Boot Service')])
+    resources['CIM_KVMRedirectionSAP'].update([('EnabledState', 3), ('RequestedState', 3)])
+    resources['IPS_KVMRedirectionSettingData'].update([
+        ('DefaultScreen', 0),
+        ('Is5900PortEnabled', False),
+        ('OptInPolicy', True),
+        ('OptInPolicyTimeout', 300),
+        ('SessionTimeout', 0),
+    ])
+    resources['AMT_BootSettingData'].update([
+        ('ElementName', 'Intel(r) AMT Boot Configuration Settings'),
+        ('InstanceID', 'Intel(r) AMT:BootSettingData 0'),
+        ('BIOSPause', False),
+        ('BIOSSetup', False),
+        ('BootMediaIndex', 0),
+        ('UseSOL', False),
+    ])
+    resources['AMT_GeneralSettings'].update([('HostName', 'virtual'), ('NetworkInterfaceEnabled', True)])
+    return resources
+
+
+def uniform(low, high):
+    '''A latency distribution: uniform between low and high seconds.'''
+    return lambda: random.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    '''A latency distribution, log-normal about median seconds; the long tail real devices show.'''
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return escape(value.encode('utf-8'))
+    return escape(str(value))
+
+
+def _fields(fields):
+    output = []
+    for name, value in fields.items():
+        for item in (value if isinstance(value, list) else [value]):
+            output.append('<h:%s>%s</h:%s>' % (name, _text(item), name))
+    return ''.join(output)
+
+
+def _envelope(action, resource_uri, body, relates_to=None):
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="%s" xmlns:b="%s" xmlns:c="%s" xmlns:g="%s"%s>
+<a:Header><b:To>%s</b:To><b:RelatesTo>%s</b:RelatesTo><b:Action a:mustUnderstand="true">%s</b:Action><b:MessageID>uuid:%s</b:MessageID><c:ResourceURI>%s</c:ResourceURI></a:Header>
+<a:Body>%s</a:Body>
+</a:Envelope>''' % (wsman.NAMESPACES['soap'], wsman.NAMESPACES['addressing'], wsman.NAMESPACES['wsman'], _ENUMERATION,
+        ' xmlns:h="%s"' % escape(resource_uri) if resource_uri else '', SCHEMAS['addressing_anonymous'],
+        escape(relates_to or ''), escape(action), uuid.uuid4(), escape(resource_uri or ''), body)
+
+
+def _fault(subcode, reason, receiver=False):
+    '''
+    An (HTTP status, envelope) pair for a fault. subcode is prefixed with b
+    (addressing), c (wsman) or g (enumeration).
+    '''
+    body = ('<a:Fault><a:Code><a:Value>a:%s</a:Value><a:Subcode><a:Value>%s</a:Value></a:Subcode></a:Code>'
+        '<a:Reason><a:Text xml:lang="en-US">%s</a:Text></a:Reason></a:Fault>') % (
+        'Receiver' if receiver else 'Sender', subcode, escape(reason))
+    return (500 if receiver else 400), _envelope(wsman.NAMESPACES['addressing'] + '/fault', None, body)
+
+
+class VirtualDevice(object):
+    '''
+    The WS-Man interface of a simulated AMT device. It holds state as plain
+    attributes, which may be changed at any time (eg. to inject faults part
+    way through a test):
+
+    resources: the fields of each resource, by resource name.
+    boot_source: the InstanceID of the boot source set for the next boot, or
+    None. It is cleared whenever the device is powered on or reset.
+    boot_config_role: the Role last set with SetBootConfigRole.
+    unsupported: names of resources whose requests fault, as on firmware
+    which lacks them.
+    requests: the number of requests answered.
+    challenges: the number of requests refused for want of authentication.
+    '''
+
+    def __init__(self, username='admin', password='P@ssw0rd', product_version='AMT 11.8', resources=None,
+        latency=0, fault_rate=0, timeout_rate=0, unsupported=(), max_connections=4, max_concurrency=1):
+        '''
+        :param password: If None, requests are not authenticated.
+        :param latency: Seconds to take over each request: a number, or a
+        function returning one, such as uniform() or lognormal().
+        :param fault_rate: The fraction of requests answered with a
+        wsman:InternalError fault.
+        :param timeout_rate: The fraction of requests never answered.
+        :param max_connections: Connections beyond this many are closed as soon
+        as they make a request, as AMT firmware does when its sockets are used
+        up.
+        :param max_concurrency: The number of requests worked on at once.
+        Others wait their turn.
+        '''
+        self.username = username
+        self.password = password
+        self.product_version = product_version
+        self.resources = resources if resources is not None else default_resources()
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.timeout_rate = timeout_rate
+        self.unsupported = set(unsupported)
+        self.max_connections = max_connections
+        self.boot_source = None
+        self.boot_config_role = None
+        self.requests = 0
+        self.challenges = 0
+        self.realm = 'Digest:%s' % os.urandom(16).encode('hex').upper()
+        self.nonce = None
+        self.new_nonce()
+        self.connections = 0
+        self._contexts = {}
+        self._slots = max_concurrency
+        self._waiters = deque()
+
+    def new_nonce(self):
+        '''Replace the digest nonce, so that clients' next requests are rejected as stale.'''
+        self.nonce = os.urandom(16).encode('hex')
+
+    def delay(self):
+        '''The seconds to take over a request.'''
+        return self.latency() if callable(self.latency) else self.latency
+
+    def authenticate(self, method, header):
+        '''
+        Check a request's Authorization header.
+
+        :returns: None if it is acceptable, or else the WWW-Authenticate
+        header to challenge it with.
+        '''
+        if self.password is None:
+            return None
+        parameters = dict(
+            (match.group(1).lower(), match.group(2) if match.group(2) is not None else match.group(3))
+            for match in wsman.DigestAuth._PARAMETER.finditer(header or '')
+        )
+        stale = False
+        if parameters.get('username') == self.username and 'response' in parameters:
+            md5 = lambda *parts: hashlib.md5(':'.join(parts)).hexdigest()
+            ha1 = md5(self.username, self.realm, self.password)
+            ha2 = md5(method, parameters.get('uri', ''))
+            if parameters.get('qop'):
+                expected = md5(ha1, parameters.get('nonce', ''), parameters.get('nc', ''),
+                    parameters.get('cnonce', ''), parameters['qop'], ha2)
+            else:
+                expected = md5(ha1, parameters.get('nonce', ''), ha2)
+            if parameters['response'] == expected:
+                if parameters.get('nonce') == self.nonce:
+                    return None
+                stale = True
+        self.challenges += 1
+        return 'Digest realm="%s", nonce="%s", stale="%s", qop="auth"' % (
+            self.realm, self.nonce, 'true' if stale else 'false')
+
+    def acquire(self):
+        '''A Future which completes when the device may work on another request.'''
+        future = Future()
+        if self._slots:
+            self._slots -= 1
+            future.set_result(None)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def release(self):
+        if self._waiters:
+            self._waiters.popleft().set_result(None)
+        else:
+            self._slots += 1
+
+    def respond(self, request):
+        '''
+        Answer a request envelope.
+
+        :returns: An (HTTP status, response envelope) pair.
+        '''
+        self.requests += 1
+        if self.fault_rate and random.random() < self.fault_rate:
+            return _fault('c:InternalError', 'The service cannot comply with the request due to internal processing errors.', receiver=True)
+        try:
+            envelope = wsman.ElementTree.fromstring(request)
+        except wsman.ElementTree.ParseError:
+            return _fault('c:SchemaValidationError', 'The supplied SOAP violates the corresponding XML schema definition.')
+        header = envelope.find(_SOAP + 'Header')
+        body = envelope.find(_SOAP + 'Body')
+        payload = body[0] if body is not None and len(body) else None
+        if payload is not None and payload.tag == '{%s}Identify' % wsman.NAMESPACES['identity']:
+            return 200, self._identify()
+        action = header.findtext(_ADDRESSING + 'Action', '') if header is not None else ''
+        resource_uri = header.findtext(_WSMAN + 'ResourceURI', '') if header is not None else ''
+        message_id = header.findtext(_ADDRESSING + 'MessageID') if header is not None else None
+        resource_name = resource_uri.rsplit('/', 1)[-1]
+        if resource_name not in self.resources or resource_name in self.unsupported:
+            return _fault('b:DestinationUnreachable', 'No route can be determined to reach the destination role defined by the WS-Addressing To.')
+        if action == _TRANSFER + '/Get':
+            return 200, self._instance(_TRANSFER + '/GetResponse', resource_uri, resource_name, message_id)
+        if action == _TRANSFER + '/Put':
+            return self._put(resource_uri, resource_name, payload, message_id)
+        if action == _ENUMERATION + '/Enumerate':
+            return self._enumerate(resource_uri, resource_name, payload, message_id)
+        if action == _ENUMERATION + '/Pull':
+            return self._pull(resource_uri, resource_name, payload, message_id)
+        if action.startswith(resource_uri + '/'):
+            return self._invoke(resource_uri, action[len(resource_uri) + 1:], payload, message_id)
+        return _fault('b:ActionNotSupported', 'The action is not supported by the service.')
+
+    def _identify(self):
+        return '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="%s" xmlns:b="%s"><a:Header></a:Header><a:Body><b:IdentifyResponse>
+<b:ProtocolVersion>%s</b:ProtocolVersion><b:ProductVendor>Intel Corporation</b:ProductVendor><b:ProductVersion>%s</b:ProductVersion>
+</b:IdentifyResponse></a:Body></a:Envelope>''' % (wsman.NAMESPACES['soap'], wsman.NAMESPACES['identity'],
+            wsman.NAMESPACES['wsman'], escape(self.product_version))
+
+    def _instances(self, resource_name):
+        if resource_name == 'CIM_BootSourceSetting':
+            return [OrderedDict([
+                ('ElementName', 'Intel(r) AMT: Boot Source'),
+                ('FailThroughSupported', 2),
+                ('InstanceID', instance_id),
+                ('StructuredBootString', boot_string),
+            ]) for instance_id, boot_string in _BOOT_SOURCES]
+        return [self.resources[resource_name]]
+
+    def _instance(self, action, resource_uri, resource_name, message_id):
+        body = '<h:%s>%s</h:%s>' % (resource_name, _fields(self._instances(resource_name)[0]), resource_name)
+        return _envelope(action, resource_uri, body, message_id)
+
+    def _put(self, resource_uri, resource_name, payload, message_id):
+        if payload is None:
+            return _fault('c:SchemaValidationError', 'A Put request must contain the resource.')
+        fields = self.resources[resource_name]
+        for element in payload:
+            name = element.tag.split('}')[-1]
+            fields[name] = element.text or ''
+        return 200, self._instance(_TRANSFER + '/PutResponse', resource_uri, resource_name, message_id)
+
+    def _items(self, resource_name, items, limit):
+        sent, remaining = items[:limit], items[limit:]
+        output = ''.join('<h:%s>%s</h:%s>' % (resource_name, _fields(item), resource_name) for item in sent)
+        return output, remaining
+
+    def _enumerate(self, resource_uri, resource_name, payload, message_id):
+        items = self._instances(resource_name)
+        optimized = payload is not None and payload.find(_WSMAN + 'OptimizeEnumeration') is not None
+        context = str(uuid.uuid4())
+        body = '<g:EnumerateResponse><g:EnumerationContext>%s</g:EnumerationContext>' % context
+        if optimized:
+            limit = int(payload.findtext(_WSMAN + 'MaxElements') or 1)
+            output, items = self._items(resource_name, items, limit)
+            body += '<c:Items>%s</c:Items>' % output
+            if not items:
+                body += '<c:EndOfSequence/>'
+        if items:
+            self._contexts[context] = items
+        body += '</g:EnumerateResponse>'
+        return 200, _envelope(_ENUMERATION + '/EnumerateResponse', resource_uri, body, message_id)
+
+    def _pull(self, resource_uri, resource_name, payload, message_id):
+        context = payload.findtext('{%s}EnumerationContext' % _ENUMERATION) if payload is not None else None
+        items = self._contexts.pop(context, None)
+        if items is None:
+            return _fault('g:InvalidEnumerationContext', 'The supplied enumeration context is invalid.', receiver=True)
+        limit = int(payload.findtext('{%s}MaxElements' % _ENUMERATION) or 1)
+        output, items = self._items(resource_name, items, limit)
+        body = '<g:PullResponse><g:EnumerationContext>%s</g:EnumerationContext><g:Items>%s</g:Items>' % (context, output)
+        if items:
+            self._contexts[context] = items
+        else:
+            body += '<g:EndOfSequence/>'
+        body += '</g:PullResponse>'
+        return 200, _envelope(_ENUMERATION + '/PullResponse', resource_uri, body, message_id)
+
+    def _invoke(self, resource_uri, method, payload, message_id):
+        arguments = payload if payload is not None else wsman.ElementTree.Element('input')
+        argument = lambda name: arguments.findtext('{%s}%s' % (resource_uri, name))
+        return_value = 0
+        if method == 'RequestPowerStateChange':
+            requested = int(argument('PowerState') or 0)
+            if requested not in _POWER_OUTCOMES:
+                return_value = 2
+            else:
+                self.resources['CIM_AssociatedPowerManagementService']['PowerState'] = _POWER_OUTCOMES[requested]
+                if _POWER_OUTCOMES[requested] == 2:
+                    self.boot_source = None # A boot source is only used for the next boot.
+        elif method == 'ChangeBootOrder':
+            selectors = [element.text for element in arguments.iter(_WSMAN + 'Selector') if element.get('Name') == 'InstanceID']
+            if not selectors or selectors[0] not in dict(_BOOT_SOURCES):
+                return_value = 1
+            else:
+                self.boot_source = selectors[0]
+        elif method == 'SetBootConfigRole':
+            self.boot_config_role = int(argument('Role') or 0)
+        elif method == 'RequestStateChange' and resource_uri.endswith('/CIM_KVMRedirectionSAP'):
+            state = int(argument('RequestedState') or 0)
+            self.resources['CIM_KVMRedirectionSAP'].update([('EnabledState', state), ('RequestedState', state)])
+        else:
+            return _fault('b:ActionNotSupported', 'The action is not supported by the service.')
+        body = '<h:%s_OUTPUT><h:ReturnValue>%d</h:ReturnValue></h:%s_OUTPUT>' % (method, return_value, method)
+        return 200, _envelope('%s/%sResponse' % (resource_uri, method), resource_uri, body, message_id)
+
+
+class Simulator(object):
+    '''
+    Serves VirtualDevices over HTTP, on an event loop of its own, in a thread
+    started by start() (or the calling thread, in serve_forever()).
+
+    Add devices and listeners before starting it: neither is thread-safe.
+    '''
+
+    def __init__(self, idle_timeout=60):
+        '''
+        :param idle_timeout: Seconds after which idle connections, and those
+        whose requests are never to be answered, are closed.
+        '''
+        self.loop = EventLoop()
+        self.devices = {}
+        self.idle_timeout = idle_timeout
+        self._listeners = []
+        self._running = False
+        self._thread = None
+        self._wake = os.pipe()
+        self.loop.add_reader(self._wake[0], lambda: os.read(self._wake[0], 512))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def add(self, host, device):
+        '''Serve device to requests for host, on any listener without a device of its own.'''
+        self.devices[host] = device
+
+    def listen(self, address=('127.0.0.1', 0), device=None):
+        '''
+        Accept connections on address.
+
+        :param device: The device to answer every request made to this
+        address. If None, each is answered by the device added for the
+        address connected to, or else its Host header.
+        :returns: The port listened on.
+        '''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+        server.listen(socket.SOMAXCONN)
+        server.setblocking(False)
+        self._listeners.append(server)
+        self.loop.add_reader(server.fileno(), lambda: self._accept(server, device))
+        return server.getsockname()[1]
+
+    def start(self):
+        '''Serve, on a daemon thread.'''
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        '''Serve, on the calling thread, until stop() is called from another.'''
+        self._running = True
+        self._run()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        os.write(self._wake[1], 'x')
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        for server in self._listeners:
+            server.close()
+        self._listeners = []
+
+    def _run(self):
+        while self._running:
+            self.loop.run_once()
+
+    def _accept(self, server, device):
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.error as error:
+                if error.errno in _WOULD_BLOCK or error.errno == errno.EBADF:
+                    return
+                if error.errno in (errno.EMFILE, errno.ENFILE):
+                    LOG.warning('Could not accept a connection: %s', error)
+                    return
+                raise
+            connection.setblocking(False)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._serve(connection, device).add_done_callback(self._served)
+
+    def _served(self, future):
+        if future.exception() is not None and not isinstance(future.exception(), (socket.error, EOFError)):
+            LOG.error('A simulated device failed: %r', future.exception())
+
+    def _route(self, connection, parser):
+        device = self.devices.get(connection.getsockname()[0])
+        if device is None:
+            device = self.devices.get(re.sub(r':\d+$', '', parser.headers.get('host', '')))
+        return device
+
+    @coroutine
+    def _serve(self, connection, device):
+        counted = None
+        try:
+            while self._running:
+                parser = wsman.HTTPParser(request=True)
+                while True:
+                    data = yield self._recv(connection, time() + self.idle_timeout)
+                    if not data:
+                        return
+                    if parser.feed(data):
+                        break
+                target = device or self._route(connection, parser)
+                if target is None:
+                    yield self._send(connection, 404, [], '')
+                    return
+                if counted is None:
+                    if target.connections >= target.max_connections:
+                        return # As firmware with no sockets left: the connection is reset.
+                    counted = target
+                    target.connections += 1
+                challenge = target.authenticate(parser.method, parser.headers.get('authorization'))
+                if challenge is not None:
+                    yield self._send(connection, 401, [('WWW-Authenticate', challenge)], '')
+                    continue
+                yield target.acquire()
+                try:
+                    delay = target.delay()
+                    if delay:
+                        yield sleep(delay, loop=self.loop)
+                    if target.timeout_rate and random.random() < target.timeout_rate:
+                        yield self._recv(connection, time() + self.idle_timeout) # Until the client gives up.
+                        return
+                    status, body = target.respond(parser.body)
+                finally:
+                    target.release()
+                yield self._send(connection, status, [('Content-Type', 'application/soap+xml;charset=UTF-8')], body)
+                if not parser.keep_alive:
+                    return
+        finally:
+            if counted is not None:
+                counted.connections -= 1
+            connection.close()
+
+    @coroutine
+    def _recv(self, connection, deadline):
+        '''The next data to arrive, or '' if the connection closed or was idle until deadline.'''
+        while True:
+            try:
+                data = connection.recv(65536)
+            except socket.error as error:
+                if error.errno in _WOULD_BLOCK:
+                    try:
+                        yield self._wait(connection, deadline)
+                    except socket.timeout:
+                        raise Return('')
+                    continue
+                if error.errno in (errno.ECONNRESET, errno.EPIPE):
+                    raise Return('')
+                raise
+            raise Return(data)
+
+    @coroutine
+    def _send(self, connection, status, headers, body):
+        lines = ['HTTP/1.1 %d %s' % (status, _REASONS.get(status, ''))]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.append('Content-Length: %d' % len(body))
+        data = '\r\n'.join(lines) + '\r\n\r\n' + body
+        while data:
+            try:
+                sent = connection.send(data)
+            except socket.error as error:
+                if error.errno not in _WOULD_BLOCK:
+                    raise
+                yield self._wait(connection, time() + self.idle_timeout, writable=True)
+            else:
+                data = data[sent:]
+
+    def _wait(self, connection, deadline, writable=False):
+        '''A Future which completes when connection is ready, or fails with socket.timeout at deadline.'''
+        future = Future()
+        fd = connection.fileno()
+        remove = self.loop.remove_writer if writable else self.loop.remove_reader
+
+        def ready():
+            remove(fd)
+            timer.cancel()
+            future.set_result(None)
+
+        def expired():
+            remove(fd)
+            future.set_exception(socket.timeout())
+
+        timer = self.loop.call_later(max(0, deadline - time()), expired)
+        (self.loop.add_writer if writable else self.loop.add_reader)(fd, ready)
+        return future
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def main(argv=None):
+    from wry.discovery import iter_addresses
+    parser = argparse.ArgumentParser(description='Simulate AMT devices.')
+    parser.add_argument('--listen', default='127.0.0.1:16992', help='The [host]:port to listen on.')
+    parser.add_argument('--network', action='append', default=[],
+        help='Serve a device at each address in this network (in CIDR notation). May be repeated.')
+    parser.add_argument('--devices', type=int, default=0,
+        help='Serve this many devices, each on a port of its own, counting up from that listened on.')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='P@ssw0rd')
+    parser.add_argument('--latency', type=float, default=0, help='The median seconds to take over each request.')
+    parser.add_argument('--fault-rate', type=float, default=0)
+    parser.add_argument('--timeout-rate', type=float, default=0)
+    args = parser.parse_args(argv)
+    host, _, port = args.listen.rpartition(':')
+    port = int(port)
+
+    def new_device():
+        return VirtualDevice(args.username, args.password, latency=lognormal(args.latency, .5) if args.latency else 0,
+            fault_rate=args.fault_rate, timeout_rate=args.timeout_rate)
+
+    simulator = Simulator()
+    if args.network:
+        simulator.listen((host, port))
+        for address in iter_addresses(args.network):
+            simulator.add(address, new_device())
+    for offset in range(args.devices):
+        simulator.listen((host, port + offset + (1 if args.network else 0)), device=new_device())
+    if not (args.network or args.devices):
+        parser.error('Give --network or --devices.')
+    logging.basicConfig(level=logging.INFO)
+    LOG.info('Serving %d devices.', len(simulator.devices) + args.devices)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
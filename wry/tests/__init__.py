@@ -14,12 +14,52 @@ import unittest
 import mock
 import pywsman
 import tempfile
+import threading
+import time
+import traceback
 import os
+import functools
+import json
+import shutil
+import subprocess
+import sys
 import wry
+import wry.aio
+import wry.cache
+import wry.capabilities
+import wry.cli
+import wry.discovery
+import wry.events
+import wry.concurrency
+import wry.health
+import wry.instrumentation
+import wry.recording
+import wry.reimage
+import wry.simulator
+import wry.transport
+import wry.watch
+from StringIO import StringIO
 from wry.tests import data
 
 
-class WryTest(unittest.TestCase):
+class IsolatedTest(unittest.TestCase):
+    '''
+    A test which does not see hosts failed by other tests: health.REGISTRY is
+    shared by the whole process, so it is reset first.
+    '''
+
+    def setUp(self):
+        super(IsolatedTest, self).setUp()
+        wry.health.REGISTRY.reset()
+
+    def mkdtemp(self):
+        '''Make a temporary directory, which is removed after the test.'''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+
+class WryTest(IsolatedTest):
     '''Tests for device power management/control.'''
 
     def setUp(self):
@@ -147,5 +187,1150 @@ class BootTests(WryTest):
                 data.set_boot_config_role,
             )
 
+class BootCacheTests(IsolatedTest):
+    '''Tests that what AMTBoot learns about a device is not looked up again.'''
+
+    def setUp(self):
+        super(BootCacheTests, self).setUp()
+        fields = {
+            'CIM_BootConfigSetting': {'InstanceID': 'Intel(r) AMT: Boot Configuration 0'},
+            'CIM_BootService': {'ElementName': 'Intel(r) AMT Boot Service'},
+        }
+        self.client = data.FakeTransport(fields=fields)
+        self.boot = wry.device.AMTBoot(self.client, wry.data_structures.WryOptions())
+
+    def test_medium_costs_two_invokes_once_known(self):
+        self.boot.medium = 'Network'
+        self.assertEqual(self.client.requests, [
+            ('enumerate', 'CIM_BootSourceSetting'),
+            ('get', 'CIM_BootConfigSetting'),
+            ('invoke', 'ChangeBootOrder'),
+            ('get', 'CIM_BootService'),
+            ('invoke', 'SetBootConfigRole'),
+        ])
+        del self.client.requests[:]
+        self.boot.medium = 'CD/DVD'
+        self.assertEqual(self.client.requests, [('invoke', 'ChangeBootOrder'), ('invoke', 'SetBootConfigRole')])
+        self.assertRaises(LookupError, setattr, self.boot, 'medium', 'Floppy')
+
+
+class FakeDevice(object):
+    '''A stand-in for an AMTDevice, whose power namespace is itself.'''
+
+    def __init__(self, name, delay=0, exception=None):
+        self.name = name
+        self.delay = delay
+        self.exception = exception
+        self.power = self
+        self.calls = 0
+
+    def turn_on(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.exception:
+            raise self.exception
+        return self.name
+
+
+class FleetTests(unittest.TestCase):
+    '''Tests for running operations across many devices.'''
+
+    def test_results_stream_as_devices_finish(self):
+        fleet = wry.AMTFleet([FakeDevice('slow', delay=.2), FakeDevice('fast')])
+        results = list(fleet.call('power.turn_on'))
+        self.assertEqual([result.value for result in results], ['fast', 'slow'])
+        self.assertTrue(all(result.ok for result in results))
+
+    def test_exceptions_are_returned_per_device(self):
+        failure = wry.exceptions.AMTConnectFailure()
+        fleet = wry.AMTFleet([FakeDevice('up'), FakeDevice('down', exception=failure)])
+        results = dict((result.device.name, result) for result in fleet.call('power.turn_on'))
+        self.assertTrue(results['up'].ok)
+        self.assertIs(results['down'].exception, failure)
+
+    def test_deadline(self):
+        fleet = wry.AMTFleet([FakeDevice('fast'), FakeDevice('hung', delay=5)], timeout=.2)
+        results = dict((result.device.name, result) for result in fleet.call('power.turn_on'))
+        self.assertTrue(results['fast'].ok)
+        self.assertIsInstance(results['hung'].exception, wry.exceptions.DeadlineExceeded)
+
+    def test_set(self):
+        devices = [FakeDevice(name) for name in 'abc']
+        list(wry.AMTFleet(devices).set('power.state', 'on'))
+        self.assertEqual([device.state for device in devices], ['on'] * 3)
+
+    def test_operations_start_without_being_iterated(self):
+        devices = [FakeDevice(name) for name in 'abc']
+        wry.AMTFleet(devices).set('power.state', 'on')
+        deadline = time.time() + 2
+        while time.time() < deadline and [getattr(device, 'state', None) for device in devices] != ['on'] * 3:
+            time.sleep(.01)
+        self.assertEqual([getattr(device, 'state', None) for device in devices], ['on'] * 3)
+
+    def test_cancel_without_iterating(self):
+        devices = [FakeDevice(str(number), delay=.05) for number in range(40)]
+        fleet = wry.AMTFleet(devices, max_workers=2)
+        operation = fleet.call('power.turn_on')
+        other = fleet.get('name')
+        time.sleep(.12)
+        operation.cancel()
+        time.sleep(.2)
+        started = sum(device.calls for device in devices)
+        self.assertLess(started, 10)
+        results = list(operation)
+        self.assertEqual(sum(isinstance(result.exception, wry.exceptions.OperationCancelled) for result in results), 40 - started)
+        self.assertTrue(all(result.ok for result in other))
+
+    def test_fleet_cancel_reaches_every_operation(self):
+        devices = [FakeDevice(str(number), delay=.05) for number in range(20)]
+        fleet = wry.AMTFleet(devices, max_workers=1)
+        operations = [fleet.call('power.turn_on'), fleet.call('power.turn_on')]
+        fleet.cancel()
+        for operation in operations:
+            self.assertTrue(any(isinstance(result.exception, wry.exceptions.OperationCancelled) for result in operation))
+        self.assertTrue(all(result.ok for result in fleet.get('name')))
+
+    def test_deadline_without_iterating(self):
+        devices = [FakeDevice(str(number), delay=.05) for number in range(40)]
+        wry.AMTFleet(devices, max_workers=2, timeout=.1).call('power.turn_on')
+        time.sleep(.3)
+        self.assertLess(sum(device.calls for device in devices), 10)
+
+
+def _unreachable(transport, envelope, timeout):
+    '''Stands in for AsyncTransport._send, as if the device were down.'''
+    future = wry.eventloop.Future()
+    future.set_result(None)
+    return future
+
+
+class AsyncTests(IsolatedTest):
+    '''Tests that the non-blocking interface sends the same requests.'''
+
+    def setUp(self):
+        super(AsyncTests, self).setUp()
+        self.device = wry.aio.AsyncAMTDevice('fake_hostname', 'http', 'user', 'password')
+        self.dumpfile = tempfile.TemporaryFile()
+        self.device.client.set_dumpfile(self.dumpfile)
+        self.device.debug = True
+        self.loop = wry.eventloop.get_event_loop()
+
+    def tearDown(self):
+        self.dumpfile.close()
+        super(AsyncTests, self).tearDown()
+
+    def assertRequests(self, future, pattern):
+        with self.assertRaises(wry.exceptions.AMTConnectFailure):
+            self.loop.run_until_complete(future)
+        self.dumpfile.seek(0)
+        self.assertRegexpMatches(self.dumpfile.read(), pattern)
+
+    @mock.patch.object(wry.aio.AsyncTransport, '_send', _unreachable)
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_power_on(self):
+        self.assertRequests(self.device.power.turn_on(), data.power_state_change(2))
+
+    @mock.patch.object(wry.aio.AsyncTransport, '_send', _unreachable)
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_kvm_enable(self):
+        self.assertRequests(self.device.kvm.set_enabled(True), data.kvm_enable())
+
+    @mock.patch.object(wry.aio.AsyncTransport, '_send', _unreachable)
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_set_boot_config_role(self):
+        self.assertRequests(self.device.boot._set_boot_config_role(), data.set_boot_config_role)
+
+    @mock.patch.object(wry.aio.AsyncTransport, '_send', _unreachable)
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_requests_are_measured(self):
+        measurements = []
+        wry.instrumentation.add_hook(measurements.append)
+        self.addCleanup(wry.instrumentation.remove_hook, measurements.append)
+        with self.assertRaises(wry.exceptions.AMTConnectFailure):
+            self.loop.run_until_complete(self.device.power.turn_on())
+        measurement, = measurements
+        self.assertEqual((measurement.host, measurement.action, measurement.error),
+            ('fake_hostname', 'Invoke', 'AMTConnectFailure'))
+
+    @mock.patch.object(wry.aio.AsyncTransport, '_send', _unreachable)
+    def test_retries_on_the_devices_loop(self):
+        loop = wry.eventloop.EventLoop()
+        device = wry.aio.AsyncAMTDevice('fake_hostname', 'http', 'user', 'password', loop=loop,
+            retry_policy=wry.decorators.RetryPolicy(max_attempts=3, base_delay=.01, max_delay=.01))
+        with self.assertRaises(wry.exceptions.AMTConnectFailure) as raised:
+            loop.run_until_complete(device.power.turn_on())
+        self.assertEqual(raised.exception.attempts, 3)
+
+
+class HTTPTransportTests(unittest.TestCase):
+    '''Tests for the pooled, keep-alive HTTP transport.'''
+
+    def setUp(self):
+        super(HTTPTransportTests, self).setUp()
+        self.simulator = wry.simulator.Simulator()
+        self.virtual = wry.simulator.VirtualDevice('user', 'password')
+        port = self.simulator.listen(device=self.virtual)
+        self.simulator.start()
+        self.addCleanup(self.simulator.stop)
+        self.client = wry.transport.HTTPTransport('127.0.0.1', port, '/wsman', 'http', 'user', 'password')
+        self.addCleanup(self.client.close)
+
+    def test_connection_and_nonce_are_reused(self):
+        for _ in range(3):
+            resource = wry.common.get_resource(self.client, 'CIM_BootConfigSetting')
+        self.assertEqual(resource['CIM_BootConfigSetting']['InstanceID'], 'Intel(r) AMT: Boot Configuration 0')
+        self.assertEqual(self.virtual.connections, 1)
+        self.assertEqual(self.virtual.challenges, 1)
+
+    def test_stale_nonce_is_replaced(self):
+        wry.common.get_resource(self.client, 'AMT_BootSettingData')
+        self.virtual.new_nonce()
+        resource = wry.common.get_resource(self.client, 'AMT_BootSettingData')
+        self.assertIs(resource['AMT_BootSettingData']['BIOSPause'], False)
+        self.assertEqual(self.virtual.challenges, 2)
+
+    def test_operations(self):
+        self.assertEqual(wry.common.identify(self.client, wry.data_structures.WryOptions())['ProductVersion'], 'AMT 11.8')
+        device = wry.AMTDevice('127.0.0.1', 'http', 'user', 'password', transport=lambda *args: self.client)
+        self.assertEqual(device.power.state.state, 'on')
+        self.assertTrue(device.power.turn_off())
+        self.assertEqual(self.virtual.resources['CIM_AssociatedPowerManagementService']['PowerState'], 8)
+
+    def test_timeout(self):
+        wry.common.get_resource(self.client, 'CIM_BootService')
+        self.virtual.latency = .5
+        options = wry.data_structures.WryOptions().with_timeout(.1)
+        started = time.time()
+        self.assertIsNone(self.client.get(options, wry.config.RESOURCE_URIs['CIM_BootService']))
+        self.assertLess(time.time() - started, .4)
+        self.assertIn('<wsman:OperationTimeout>PT0.100S</wsman:OperationTimeout>',
+            wry.wsman.get_request(self.client.url, wry.config.RESOURCE_URIs['CIM_BootService'], options))
+
+    @mock.patch('os.urandom', mock.Mock(return_value='\x0a\x4f\x11\x3b'))
+    def test_digest_response(self):
+        '''The worked example from RFC 2617, section 3.5.'''
+        auth = wry.wsman.DigestAuth('Mufasa', 'Circle Of Life')
+        auth.update('Digest realm="testrealm@host.com", qop="auth,auth-int", '
+            'nonce="dcd98b7102dd2f0e8b11d0f600bfb0c093", opaque="5ccc069c403ebaf9f0171e9517f40e41"')
+        self.assertIn('response="6629fae49393a05397450978507c4ef1"', auth.header('GET', '/dir/index.html'))
+        self.assertIn('nc=00000002', auth.header('GET', '/dir/index.html'))
+
+
+class CacheTests(WryTest):
+    '''Tests for caching of resources.'''
+
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        self.cache = wry.cache.ResourceCache(ttl=60)
+        self.boot = wry.device.AMTBoot(self.client, self.options, cache=self.cache)
+
+    @mock.patch.multiple(pywsman.Client, get=mock.Mock(side_effect=data.client_get))
+    def test_reads_are_cached(self):
+        self.assertEqual(self.boot.config, self.boot.config)
+        self.assertEqual(pywsman.Client.get.call_count, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    @mock.patch.multiple(pywsman.Client, get=mock.Mock(side_effect=data.client_get))
+    def test_cached_copies_are_independent(self):
+        self.boot.config['BIOSPause'] = True
+        self.assertIs(self.boot.config['BIOSPause'], False)
+
+    @mock.patch.multiple(pywsman.Client, get=mock.Mock(side_effect=data.client_get))
+    def test_invalidation_follows_dependencies(self):
+        self.boot.config
+        self.cache.invalidate('CIM_BootService')
+        self.boot.config
+        self.assertEqual(pywsman.Client.get.call_count, 2)
+
+    @mock.patch.multiple(pywsman.Client, get=mock.Mock(side_effect=data.client_get))
+    def test_expiry_and_eviction(self):
+        self.cache.ttl = -1
+        self.boot.config
+        self.boot.config
+        self.assertEqual(self.cache.misses, 2)
+        self.cache.ttl = 60
+        self.cache.max_size = 1
+        self.boot.config
+        self.boot.get('CIM_BootConfigSetting')
+        self.assertEqual(len(self.cache), 1)
+        self.assertIsNone(self.cache.get('AMT_BootSettingData'))
+
+    def test_selectors_are_cached_separately(self):
+        client = data.FakeTransport('fake_hostname')
+        options = wry.data_structures.WryOptions()
+        for value in ('a', 'b', 'a'):
+            wry.common.get_resource(client, 'CIM_BootSourceSetting', options=options.with_selector('InstanceID', value),
+                cache=self.cache)
+        self.assertEqual(client.requests, [('get', 'CIM_BootSourceSetting')] * 2)
+        self.cache.invalidate('CIM_BootSourceSetting')
+        self.assertEqual(len(self.cache), 0)
+
+
+class EnumerationTests(WryTest):
+    '''Tests for enumerating the instances of a resource.'''
+
+    def test_optimized_enumeration(self):
+        enumerate = mock.Mock(side_effect=lambda *args: data.client_enumerate_optimized(self.client, *args))
+        pull = mock.Mock()
+        with mock.patch.multiple(pywsman.Client, enumerate=enumerate, pull=pull):
+            sources = wry.common.enumerate_resource(self.client, 'CIM_BootSourceSetting', options=self.options, max_elements=8)
+        self.assertEqual(len(sources['CIM_BootSourceSetting']), 3)
+        options = enumerate.call_args[0][0]
+        self.assertTrue(options.get_flags() & wry.wsman.FLAG_ENUMERATION_OPTIMIZATION)
+        self.assertFalse(pull.called)
+
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_pull_is_resumed(self):
+        client_pull = data.client_pull_factory()
+        responses = [None]
+        pull = mock.Mock(side_effect=lambda *args: responses.pop() if responses else client_pull(self.client, *args))
+        with mock.patch.multiple(pywsman.Client, enumerate=data.client_enumerate, pull=pull):
+            sources = list(wry.common.iter_resource(self.client, 'CIM_BootSourceSetting', options=self.options, max_elements=None))
+        self.assertEqual([source['StructuredBootString'] for source in sources], ['CIM:Hard-Disk:1', 'CIM:Network:1', 'CIM:CD/DVD:1'])
+        self.assertEqual(pull.call_count, 4)
+
+
+class DecoderTests(unittest.TestCase):
+    '''Tests that the XML decoders agree with each other.'''
+
+    def assertDecodersAgree(self, doc):
+        resources = []
+        for decoder in ('expat', 'xmltodict'):
+            with mock.patch('wry.data_structures.XML_DECODER', decoder):
+                resources.append(wry.data_structures.WryDict(doc))
+        self.assertEqual(resources[0], resources[1])
+        self.assertEqual(repr(resources[0]), repr(resources[1]))
+        return resources[0]
+
+    def test_get_response(self):
+        resource = self.assertDecodersAgree(data.client_get(wry.config.RESOURCE_URIs['AMT_BootSettingData']))
+        self.assertIs(resource['AMT_BootSettingData']['BIOSPause'], False)
+        self.assertEqual(resource['AMT_BootSettingData']['BootMediaIndex'], 0)
+
+    def test_enumerate_response(self):
+        response = self.assertDecodersAgree(data.client_enumerate_optimized(None, None, None, wry.config.RESOURCE_URIs['CIM_BootSourceSetting']))
+        sources = response['EnumerateResponse']['Items']['CIM_BootSourceSetting']
+        self.assertEqual(sources[1]['StructuredBootString'], 'CIM:Network:1')
+
+
+class SchemaTests(unittest.TestCase):
+    '''Tests for converting field values by their types.'''
+
+    def test_decode(self):
+        doc = pywsman.create_doc_from_string('''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:g="http://intel.com/wbem/wscim/1/amt-schema/1/AMT_GeneralSettings">
+  <a:Body>
+    <g:AMT_GeneralSettings>
+      <g:HostName>0123</g:HostName>
+      <g:NetworkInterfaceEnabled>true</g:NetworkInterfaceEnabled>
+      <g:PrivacyLevel>1</g:PrivacyLevel>
+      <g:Unknown>2</g:Unknown>
+    </g:AMT_GeneralSettings>
+  </a:Body>
+</a:Envelope>''')
+        settings = wry.data_structures.WryDict(doc)['AMT_GeneralSettings']
+        self.assertEqual(settings['HostName'], '0123')
+        self.assertIs(settings['NetworkInterfaceEnabled'], True)
+        self.assertEqual(settings['PrivacyLevel'], 1)
+        self.assertEqual(settings['Unknown'], 2)
+
+    def test_decode_list(self):
+        fields = wry.data_structures.decode_fields('AMT_EthernetPortSettings', {'LinkPolicy': '14'})
+        self.assertEqual(fields['LinkPolicy'], [14])
+
+    def test_encode(self):
+        resource = wry.data_structures.WryDict({'AMT_EthernetPortSettings': {'DHCPEnabled': 1, 'LinkPolicy': [1, 14]}})
+        xml = resource.as_xml()
+        self.assertIn('<DHCPEnabled>true</DHCPEnabled>', xml)
+        self.assertIn('<LinkPolicy>1</LinkPolicy><LinkPolicy>14</LinkPolicy>', xml)
+
+    def test_nil_and_attributed_fields_are_put_back(self):
+        doc = pywsman.create_doc_from_string('''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:g="http://intel.com/wbem/wscim/1/amt-schema/1/AMT_GeneralSettings" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <a:Body>
+    <g:AMT_GeneralSettings>
+      <g:NetworkInterfaceEnabled xsi:nil="true"/>
+      <g:PrivacyLevel Source="default">1</g:PrivacyLevel>
+    </g:AMT_GeneralSettings>
+  </a:Body>
+</a:Envelope>''')
+        resource = wry.data_structures.WryDict(doc)
+        settings = wry.data_structures._convert_values(resource)['AMT_GeneralSettings']
+        self.assertEqual(settings['NetworkInterfaceEnabled'], {'nil': 'true'})
+        self.assertEqual(settings['PrivacyLevel'], {'@Source': 'default', '#text': '1'})
+        self.assertNotIn('OrderedDict', resource.as_xml())
+
+
+class InvocationTemplateTests(unittest.TestCase):
+    '''Tests that templated invocations match those built from scratch.'''
+
+    def assertMatchesUnparsed(self, service_name, method_name, **kwargs):
+        options = pywsman.ClientOptions()
+        uri, xml, _ = wry.common.build_invocation(service_name, method_name, options, **kwargs)
+        self.assertEqual(xml, wry.common._invocation_body(uri, method_name, **kwargs))
+
+    def test_power_state_change(self):
+        for state in (2, 8):
+            self.assertMatchesUnparsed('CIM_PowerManagementService', 'RequestPowerStateChange',
+                resource_name='CIM_ComputerSystem',
+                affected_item='ManagedElement',
+                selector=('Name', 'ManagedSystem'),
+                args_before=[('PowerState', str(state))],
+                anonymous=True,
+            )
+
+    def test_escaped_values(self):
+        self.assertMatchesUnparsed('CIM_BootConfigSetting', 'ChangeBootOrder',
+            resource_name='CIM_BootSourceSetting',
+            affected_item='Source',
+            selector=('InstanceID', u'Intel(r) AMT: <Force> & \xe9'),
+        )
+
+    def test_template_is_reused(self):
+        for state in (2, 8):
+            wry.common.build_invocation('CIM_KVMRedirectionSAP', 'RequestStateChange', pywsman.ClientOptions(), args_before=[('RequestedState', str(state))])
+        keys = [key for key in wry.common._INVOCATION_TEMPLATES if key[:2] == ('CIM_KVMRedirectionSAP', 'RequestStateChange')]
+        self.assertEqual(len(keys), 1)
+
+
+class OptionsTests(unittest.TestCase):
+    '''Tests for immutable request options.'''
+
+    def test_changes_do_not_leak(self):
+        options = wry.data_structures.WryOptions()
+        _, _, invoked = wry.common.build_invocation('CIM_BootConfigSetting', 'ChangeBootOrder', options,
+            resource_name='CIM_BootSourceSetting',
+            affected_item='Source',
+            selector=('InstanceID', 'Intel(r) AMT: Force PXE Boot', 'Intel(r) AMT: Boot Configuration 0'),
+        )
+        self.assertEqual(invoked.selectors, (('InstanceID', 'Intel(r) AMT: Boot Configuration 0'), ))
+        self.assertEqual(options.selectors, ())
+
+    def test_native_options_are_cached(self):
+        options = wry.data_structures.WryOptions().with_dump_request()
+        native = options.native()
+        self.assertTrue(native.get_flags() & wry.wsman.FLAG_DUMP_REQUEST)
+        self.assertIs(wry.data_structures.WryOptions(flags=wry.wsman.FLAG_DUMP_REQUEST).native(), native)
+
+    def test_debug(self):
+        device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=wry.transport.HTTPTransport)
+        device.debug = True
+        self.assertTrue(device.power.options.dump_request)
+        device.debug = False
+        self.assertFalse(device.kvm.options.dump_request)
+
+
+class Result(object):
+    pass
+
+
+class RetryTests(unittest.TestCase):
+    '''Tests for retrying failed calls.'''
+
+    def setUp(self):
+        self.outcomes = []
+
+        @wry.decorators.retry
+        def call(options=None):
+            outcome = self.outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        self.call = call
+
+    def test_retried_until_success(self):
+        result = Result()
+        self.outcomes = [wry.exceptions.AMTConnectFailure(), wry.exceptions.AMTConnectFailure(), result]
+        policy = wry.decorators.RetryPolicy(max_attempts=3, base_delay=0)
+        self.assertIs(self.call(retry_policy=policy), result)
+        self.assertEqual(result.attempts, 3)
+
+    def test_attempts_are_limited(self):
+        self.outcomes = [wry.exceptions.AMTConnectFailure() for _ in range(3)]
+        policy = wry.decorators.RetryPolicy(max_attempts=2, base_delay=0)
+        options = wry.data_structures.WryOptions(retry_policy=policy)
+        with self.assertRaises(wry.exceptions.AMTConnectFailure) as raised:
+            self.call(options=options)
+        self.assertEqual(raised.exception.attempts, 2)
+        self.assertEqual(len(self.outcomes), 1)
+
+    def test_not_retryable(self):
+        self.outcomes = [ValueError('Not a connection failure.'), Result()]
+        with self.assertRaises(ValueError):
+            self.call()
+        self.assertEqual(len(self.outcomes), 1)
+
+    def test_deadline(self):
+        self.outcomes = [wry.exceptions.AMTConnectFailure(), Result()]
+        policy = wry.decorators.RetryPolicy(max_attempts=5, base_delay=0, deadline=0)
+        with self.assertRaises(wry.exceptions.AMTConnectFailure):
+            self.call(retry_policy=policy)
+
+    def test_backoff(self):
+        policy = wry.decorators.RetryPolicy(base_delay=1, max_delay=5)
+        for attempt, bound in ((1, 1), (2, 2), (3, 4), (4, 5), (10, 5)):
+            self.assertTrue(0 <= policy.backoff(attempt) <= bound)
+
+    def test_device_policy(self):
+        policy = wry.decorators.RetryPolicy(max_attempts=1)
+        device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', retry_policy=policy)
+        self.assertIs(device.boot.options.retry_policy, policy)
+
+
+class HealthTests(unittest.TestCase):
+    '''Tests for failing fast on unreachable hosts.'''
+
+    def setUp(self):
+        self.registry = wry.health.HealthRegistry(threshold=2, cooldown=60)
+        self.client = mock.Mock(host='fake_hostname', port=16992)
+        self.client.get.return_value = None
+
+    def test_breaker(self):
+        self.registry.failure('fake_hostname')
+        self.assertEqual(self.registry.state('fake_hostname'), wry.health.CLOSED)
+        self.registry.failure('fake_hostname')
+        self.assertFalse(self.registry.available('fake_hostname'))
+        self.assertRaises(wry.exceptions.CircuitOpen, self.registry.before, 'fake_hostname')
+        self.registry.cooldown = 0
+        self.assertEqual(self.registry.state('fake_hostname'), wry.health.HALF_OPEN)
+        self.registry.before('fake_hostname') # The probe.
+        self.assertRaises(wry.exceptions.CircuitOpen, self.registry.before, 'fake_hostname')
+        self.registry.success('fake_hostname')
+        self.assertEqual(self.registry.states(), {'fake_hostname': wry.health.CLOSED})
+
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 3)
+    def test_requests_fail_fast(self):
+        policy = wry.decorators.RetryPolicy(base_delay=0)
+        with mock.patch('wry.health.REGISTRY', self.registry):
+            with self.assertRaises(wry.exceptions.CircuitOpen):
+                wry.common.wsman_get(self.client, 'uri', retry_policy=policy)
+            self.assertEqual(self.client.get.call_count, 2)
+            self.assertRaises(wry.exceptions.CircuitOpen, wry.common.wsman_get, self.client, 'uri')
+            self.assertEqual(self.client.get.call_count, 2)
+
+    @mock.patch('wry.decorators.CONNECT_RETRIES', 0)
+    def test_ports_are_separate(self):
+        healthy = mock.Mock(host='fake_hostname', port=16993)
+        healthy.get.return_value.is_fault.return_value = False
+        with mock.patch('wry.health.REGISTRY', self.registry):
+            for _ in range(2):
+                self.assertRaises(wry.exceptions.AMTConnectFailure, wry.common.wsman_get, self.client, 'uri')
+            self.assertRaises(wry.exceptions.CircuitOpen, wry.common.wsman_get, self.client, 'uri')
+            self.assertIs(wry.common.wsman_get(healthy, 'uri'), healthy.get.return_value)
+        self.assertEqual(self.registry.states(), {
+            ('fake_hostname', 16992): wry.health.OPEN,
+            ('fake_hostname', 16993): wry.health.CLOSED,
+        })
+
+    def test_device_health_does_not_make_the_client(self):
+        device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=mock.Mock(side_effect=AssertionError))
+        with mock.patch('wry.health.REGISTRY', self.registry):
+            self.assertEqual(device.health, wry.health.CLOSED)
+            self.registry.failure(('fake_hostname', 16992))
+            self.registry.failure(('fake_hostname', 16992))
+            self.assertEqual(device.health, wry.health.OPEN)
+
+
+class DumpTests(IsolatedTest):
+    '''Tests for dumping all of a device's resources.'''
+
+    def setUp(self):
+        super(DumpTests, self).setUp()
+        self.clients = []
+
+    def device(self, **kwargs):
+        def transport(*args):
+            client = data.FakeTransport(*args, **kwargs)
+            self.clients.append(client)
+            return client
+        return wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=transport)
+
+    def test_dump_is_concurrent(self):
+        device = self.device(delay=.02)
+        output = device.dump(as_json=False, max_workers=4)
+        self.assertEqual(set(output.keys()), set(wry.config.RESOURCE_METHODS.keys()))
+        self.assertEqual(len(output['CIM_BootSourceSetting']), 3)
+        self.assertIn(device.client.most_in_progress, (2, 3, 4))
+
+    def test_faults_are_yielded(self):
+        device = self.device(denied=['AMT_TLSSettingData'])
+        resources = dict(device.iter_dump())
+        self.assertIsInstance(resources['AMT_TLSSettingData'], wry.exceptions.WSManFault)
+        self.assertEqual(resources['AMT_GeneralSettings']['AMT_GeneralSettings']['ElementName'], 'AMT_GeneralSettings')
+        self.assertNotIn('AMT_TLSSettingData', device.dump(as_json=False))
+
+    def test_errors_keep_their_tracebacks(self):
+        device = self.device()
+        def unparseable_get(options, resource_uri):
+            raise wry.exceptions.XMLParseError('Not XML.')
+        device.client.get = unparseable_get
+        try:
+            device.dump(as_json=False)
+        except wry.exceptions.XMLParseError:
+            self.assertEqual(traceback.extract_tb(sys.exc_info()[2])[-1][2], 'unparseable_get')
+        else:
+            self.fail('The XMLParseError was not raised.')
+
+    @mock.patch.object(data.FakeTransport, 'thread_safe', False)
+    def test_client_per_worker(self):
+        device = self.device(delay=.01)
+        device.dump(as_json=False, max_workers=3)
+        self.assertTrue(2 <= len(self.clients) <= 4)
+        self.assertTrue(all(client.most_in_progress <= 1 for client in self.clients))
+
+
+class LoadTests(IsolatedTest):
+    '''Tests for applying a desired state to a device.'''
+
+    def setUp(self):
+        super(LoadTests, self).setUp()
+        fields = {'AMT_GeneralSettings': {'HostName': '0123', 'PingResponseEnabled': 'true'}}
+        self.device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass',
+            transport=lambda *args: data.FakeTransport(*args, fields=fields))
+
+    def test_only_changes_are_put(self):
+        changes = self.device.load({
+            'AMT_GeneralSettings': {'HostName': '0123', 'PingResponseEnabled': False},
+            'AMT_TLSSettingData': {'ElementName': 'AMT_TLSSettingData'},
+            'CIM_ComputerSystem': {'ElementName': 'Read-only'},
+        })
+        self.assertEqual(changes, {'AMT_GeneralSettings': {'PingResponseEnabled': (True, False)}})
+        self.assertEqual([name for name, _ in self.device.client.puts], ['AMT_GeneralSettings'])
+        xml = self.device.client.puts[0][1]
+        self.assertIn('<PingResponseEnabled>false</PingResponseEnabled>', xml)
+        self.assertIn('<HostName>0123</HostName>', xml)
+
+    def test_dump_is_compliant(self):
+        self.assertEqual(self.device.load(self.device.dump()), {})
+        self.assertEqual(self.device.client.puts, [])
+
+
+class WatchTests(IsolatedTest):
+    '''Tests for watching the power state of devices.'''
+
+    def setUp(self):
+        super(WatchTests, self).setUp()
+        self.device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=data.FakeTransport)
+        self.set_power_state(2)
+
+    def set_power_state(self, power_state):
+        self.device.client.fields = {'CIM_AssociatedPowerManagementService': {'PowerState': power_state, 'RequestedPowerState': 8}}
+
+    def test_poll_power_state(self):
+        self.assertEqual(wry.watch.poll_power_state(self.device.client), ('on', None))
+
+    def test_only_transitions_are_reported(self):
+        transitions = []
+        with wry.watch.PowerWatcher([self.device], fast_interval=.01, settle_time=5) as watcher:
+            watcher.subscribe(transitions.append)
+            watcher.hurry(self.device)
+            watcher.wait_for_state([self.device], 'on', timeout=2)
+            time.sleep(.05)
+            self.assertEqual(transitions, [])
+            self.set_power_state(8)
+            states = watcher.wait_for_state([self.device], 'off', timeout=2)
+        self.assertEqual(states, {self.device: ('off', 'soft')})
+        self.assertEqual(transitions, [(self.device, ('on', None), ('off', 'soft'))])
+
+    def test_stable_devices_are_polled_less_often(self):
+        with wry.watch.PowerWatcher([self.device], fast_interval=.01, slow_interval=.04) as watcher:
+            time.sleep(.3)
+        self.assertEqual(watcher._watches[self.device].interval, .04)
+
+    def test_deadline(self):
+        with self.assertRaises(wry.exceptions.DeadlineExceeded):
+            wry.watch.wait_for_state([self.device], 'off', timeout=.1, fast_interval=.01)
+
+    def test_stop_joins_threads(self):
+        watcher = wry.watch.PowerWatcher([self.device], fast_interval=.01, max_workers=2)
+        watcher.start()
+        first = watcher._threads
+        watcher.stop()
+        watcher.start()
+        self.assertFalse(any(thread.is_alive() for thread in first))
+        second = watcher._threads
+        watcher.stop()
+        self.assertFalse(any(thread.is_alive() for thread in second))
+        self.assertEqual(len(second), 3)
+
+    def test_unexpected_errors_are_survived(self):
+        get = self.device.client.get
+        errors = [wry.exceptions.XMLParseError('Not XML.')]
+        def flaky_get(*args):
+            if errors:
+                raise errors.pop()
+            return get(*args)
+        self.device.client.get = flaky_get
+        states = wry.watch.wait_for_state([self.device], 'on', timeout=2, fast_interval=.01, max_workers=1)
+        self.assertEqual(states, {self.device: ('on', None)})
+        self.assertEqual(errors, [])
+
+
+class EventTests(IsolatedTest):
+    '''Tests for subscribing to, and receiving, pushed events.'''
+
+    def setUp(self):
+        super(EventTests, self).setUp()
+        self.listener = wry.events.EventListener(('127.0.0.1', 0))
+        self.listener.start()
+        self.events = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.listener.stop()
+        super(EventTests, self).tearDown()
+
+    def handle(self, key, event):
+        self.events.append((key, event))
+        if len(self.events) == 40:
+            self.done.set()
+
+    def test_subscribe_request(self):
+        options = wry.data_structures.WryOptions().with_delivery('http://10.0.0.1:8090/a', 60)
+        request = wry.wsman.subscribe_request('http://host:16992/wsman', wry.config.EVENT_RESOURCE_URI, options)
+        self.assertIn('<wse:NotifyTo>\n          <wsa:Address>http://10.0.0.1:8090/a</wsa:Address>', request)
+        self.assertIn('<wse:Expires>PT60.000000S</wse:Expires>', request)
+
+    def test_native_subscription_options(self):
+        self.addCleanup(wry.data_structures._NATIVE_OPTIONS.clear)
+        native = mock.Mock(spec=pywsman.ClientOptions())
+        with mock.patch('pywsman.ClientOptions', return_value=native):
+            options = wry.data_structures.WryOptions().with_delivery('http://10.0.0.1:8090/native', 60)
+            self.assertIs(options.native(), native)
+        native.set_delivery_uri.assert_called_once_with('http://10.0.0.1:8090/native')
+        native.set_sub_expiry.assert_called_once_with(60)
+        renewal = mock.Mock(spec=pywsman.ClientOptions())
+        with mock.patch('wry.common.get_options_copy', return_value=renewal):
+            wry.common._delivery_options(pywsman.ClientOptions(), None, 30)
+        renewal.set_sub_expiry.assert_called_once_with(30)
+
+    def test_subscribe(self):
+        device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=data.FakeTransport)
+        subscription = self.listener.subscribe(device, self.handle)
+        self.assertEqual(subscription.identifier, 'uuid:00000000-8086-8086-8086-000000000001')
+        self.assertEqual(device.client.subscriptions[0].delivery_uri, self.listener.notify_to('fake_hostname'))
+
+    def test_events_are_dispatched_in_order_per_device(self):
+        self.listener.add_handler('a', self.handle)
+        self.listener.add_handler(None, self.handle)
+        senders = [
+            threading.Thread(target=lambda key=key: [
+                data.send_event(self.listener.notify_to(key), data.event(sequence)) for sequence in range(20)])
+            for key in ('a', 'b')
+        ]
+        for sender in senders:
+            sender.start()
+        self.assertTrue(self.done.wait(5))
+        for key in ('a', 'b'):
+            sequences = [event['CIM_AlertIndication']['IndicationIdentifier'] for event_key, event in self.events if event_key == key]
+            self.assertEqual(sequences, range(20))
+        self.assertEqual((self.listener.received, self.listener.dropped, self.listener.errors), (40, 0, 0))
+
+
+class DiscoveryTests(unittest.TestCase):
+    '''Tests for scanning networks for devices.'''
+
+    def test_iter_addresses(self):
+        self.assertEqual(list(wry.discovery.iter_addresses(['10.0.0.7/30', '10.0.1.1'])), ['10.0.0.5', '10.0.0.6', '10.0.1.1'])
+        self.assertEqual(len(list(wry.discovery.iter_addresses(['10.0.0.0/16']))), 65534)
+
+    def test_scan(self):
+        simulator = wry.simulator.Simulator()
+        port = simulator.listen(device=wry.simulator.VirtualDevice(password=None))
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        found = list(wry.discovery.scan(['127.0.0.1/30'], protocols=['http'], ports={'http': port}, timeout=2))
+        self.assertEqual(found, [('127.0.0.1', 'http', 'AMT 11.8')])
+        self.assertIsInstance(found[0].device('user', 'pass', transport=data.FakeTransport), wry.AMTDevice)
+
+
+class CapabilityTests(IsolatedTest):
+    '''Tests for learning which resources a device supports.'''
+
+    def setUp(self):
+        super(CapabilityTests, self).setUp()
+        self.path = os.path.join(self.mkdtemp(), 'capabilities.json')
+        self.cache = wry.capabilities.CapabilityCache(self.path)
+
+    def device(self, cache, **kwargs):
+        return wry.AMTDevice('fake_hostname', 'http', 'user', 'pass',
+            transport=lambda *args: data.FakeTransport(*args, **kwargs), capability_cache=cache)
+
+    def test_unsupported_resources_are_not_requested(self):
+        device = self.device(self.cache, unsupported=['AMT_TLSSettingData'], denied=['AMT_GeneralSettings'])
+        self.assertEqual(device.probe(), ('AMT 11.8', frozenset(['AMT_TLSSettingData'])))
+        with mock.patch.object(device.client, 'get', wraps=device.client.get) as get:
+            self.assertIsInstance(dict(device.iter_dump())['AMT_TLSSettingData'], wry.exceptions.UnsupportedResource)
+            self.assertRaises(wry.exceptions.UnsupportedResource, device.get_resource, 'AMT_TLSSettingData')
+            gettable = [name for name, methods in wry.config.RESOURCE_METHODS.items() if 'get' in methods]
+            self.assertEqual(get.call_count, len(gettable) - 1)
+
+    def test_cache_is_kept_on_disk(self):
+        self.device(self.cache, unsupported=['AMT_TLSSettingData']).probe()
+        cache = wry.capabilities.CapabilityCache(self.path)
+        device = self.device(cache)
+        self.assertNotIn('AMT_TLSSettingData', device.kvm.unsupported) # Not until the firmware is known.
+        with mock.patch.object(device, 'iter_dump') as iter_dump:
+            device.probe()
+        self.assertFalse(iter_dump.called)
+        self.assertIn('AMT_TLSSettingData', device.kvm.unsupported)
+        self.assertIn('AMT_TLSSettingData', self.device(cache).unsupported)
+        self.assertIsNone(cache.get('fake_hostname', 'AMT 12.0'))
+
+    def test_upgraded_firmware_is_probed_again(self):
+        self.device(self.cache, unsupported=['AMT_TLSSettingData']).probe()
+        cache = wry.capabilities.CapabilityCache(self.path)
+        device = self.device(cache)
+        with mock.patch.object(data, 'identify_response', data.identify_response.replace('AMT 11.8', 'AMT 12.0')):
+            self.assertEqual(device.probe(), ('AMT 12.0', frozenset()))
+        self.assertEqual(device.get_resource('AMT_TLSSettingData')['AMT_TLSSettingData']['ElementName'], 'AMT_TLSSettingData')
+
+
+class ReimageTests(IsolatedTest):
+    '''Tests for reimaging devices in waves.'''
+
+    fields = {
+        'CIM_BootConfigSetting': {'InstanceID': 'Intel(r) AMT: Boot Configuration 0'},
+        'CIM_BootService': {'ElementName': 'Intel(r) AMT Boot Service'},
+        'CIM_AssociatedPowerManagementService': {'PowerState': 2},
+    }
+
+    def setUp(self):
+        super(ReimageTests, self).setUp()
+        self.checkpoint = os.path.join(self.mkdtemp(), 'checkpoint.jsonl')
+        self.devices = [
+            wry.AMTDevice('node%d' % number, 'http', 'user', 'pass',
+                transport=lambda *args: data.ResettingTransport(*args, fields=self.fields))
+            for number in range(5)
+        ]
+
+    def invoked(self, device):
+        return [name for operation, name in device.client.requests if operation == 'invoke']
+
+    def test_waves(self):
+        reimager = wry.reimage.Reimager(self.devices, wave_size=2, starts_per_second=50, confirm_state='on',
+            poll_interval=.02)
+        results = list(reimager.run())
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(set(result.device for result in results[:2]), set(self.devices[:2]))
+        for device in self.devices:
+            self.assertEqual(self.invoked(device), ['ChangeBootOrder', 'SetBootConfigRole', 'RequestPowerStateChange'])
+
+    def test_device_which_does_not_reset_fails(self):
+        self.devices[1].client.off_polls = 0
+        reimager = wry.reimage.Reimager(self.devices[:3], starts_per_second=None, confirm_state='on',
+            confirm_timeout=.5, poll_interval=.02)
+        results = dict((result.device, result) for result in reimager.run())
+        self.assertIsInstance(results[self.devices[1]].exception, wry.exceptions.DeadlineExceeded)
+        self.assertTrue(results[self.devices[0]].ok and results[self.devices[2]].ok)
+
+    def test_interrupted_run_resumes(self):
+        reimager = wry.reimage.Reimager(self.devices, wave_size=3, max_workers=1, starts_per_second=None,
+            checkpoint=self.checkpoint)
+        for result in reimager.run():
+            if result.device is self.devices[2]:
+                break
+        reimager = wry.reimage.Reimager(self.devices, starts_per_second=None, checkpoint=self.checkpoint)
+        self.assertEqual(reimager.pending, self.devices[3:])
+        list(reimager.run())
+        self.assertEqual([len(self.invoked(device)) for device in self.devices], [3] * 5)
+
+    def test_interrupted_confirmation_is_resumed_without_resetting(self):
+        reimager = wry.reimage.Reimager(self.devices, wave_size=5, starts_per_second=None, confirm_state='on',
+            poll_interval=.02, checkpoint=self.checkpoint)
+        with mock.patch.object(reimager, '_confirm', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, list, reimager.run())
+        reimager = wry.reimage.Reimager(self.devices, starts_per_second=None, confirm_state='on',
+            poll_interval=.02, checkpoint=self.checkpoint)
+        self.assertEqual(reimager.pending, self.devices)
+        results = list(reimager.run())
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual([len(self.invoked(device)) for device in self.devices], [3] * 5)
+        self.assertEqual(wry.reimage.Reimager(self.devices, checkpoint=self.checkpoint).pending, [])
+
+    def test_checkpoint_is_appended(self):
+        reimager = wry.reimage.Reimager(self.devices[:1], starts_per_second=None, checkpoint=self.checkpoint)
+        list(reimager.run())
+        with open(self.checkpoint, 'a') as outfile:
+            outfile.write('{"device": "node0", "sta') # Cut short by an interruption.
+        with open(self.checkpoint) as infile:
+            states = [json.loads(line)['state'] for line in infile.readlines()[:-1]]
+        self.assertEqual(states, ['started', 'acted', 'done'])
+        reimager = wry.reimage.Reimager(self.devices[:2], starts_per_second=None, checkpoint=self.checkpoint)
+        self.assertEqual(reimager.pending, self.devices[1:2])
+        list(reimager.run())
+        self.assertEqual(wry.reimage.Reimager(self.devices[:2], checkpoint=self.checkpoint).pending, [])
+
+    def test_rate_limit(self):
+        limiter = wry.concurrency.RateLimiter(20)
+        started = time.time()
+        for _ in range(5):
+            limiter.acquire()
+        self.assertTrue(.19 <= time.time() - started < .5)
+
+
+class SimulatorTests(IsolatedTest):
+    '''Tests for the simulated devices.'''
+
+    def setUp(self):
+        super(SimulatorTests, self).setUp()
+        self.simulator = wry.simulator.Simulator()
+        self.virtual = wry.simulator.VirtualDevice(unsupported=['AMT_TLSSettingData'])
+        self.port = self.simulator.listen(device=self.virtual)
+        self.simulator.start()
+        self.addCleanup(self.simulator.stop)
+        self.device = self.connect('P@ssw0rd')
+
+    def connect(self, password):
+        transport = lambda location, _, *args: wry.transport.HTTPTransport(location, self.port, *args, timeout=2)
+        return wry.AMTDevice('127.0.0.1', 'http', 'admin', password, transport=transport,
+            capability_cache=wry.capabilities.CapabilityCache(),
+            retry_policy=wry.decorators.RetryPolicy(max_attempts=1))
+
+    def test_power_and_boot_state(self):
+        self.device.power.turn_off()
+        self.assertEqual(self.device.power.state.state, 'off')
+        self.device.boot.medium = 'Network'
+        self.assertEqual(self.virtual.boot_source, 'Intel(r) AMT: Force PXE Boot')
+        self.device.power.turn_on()
+        self.assertEqual(self.device.power.state.state, 'on')
+        self.assertIsNone(self.virtual.boot_source)
+        self.device.kvm.enabled = True
+        self.assertIs(self.device.kvm.enabled, True)
+
+    def test_faults_and_authentication(self):
+        self.assertEqual(self.device.probe().unsupported, frozenset(['AMT_TLSSettingData']))
+        self.virtual.new_nonce()
+        self.assertEqual(self.device.power.state.state, 'on')
+        self.virtual.fault_rate = 1
+        self.assertRaises(wry.exceptions.WSManFault, getattr, self.device.power, 'state')
+        self.virtual.fault_rate = 0
+        self.assertRaises(wry.exceptions.AMTConnectFailure, getattr, self.connect('wrong').power, 'state')
+
+
+class InstrumentationTests(IsolatedTest):
+    '''Tests for measuring requests.'''
+
+    def setUp(self):
+        super(InstrumentationTests, self).setUp()
+        self.measurements = []
+        self.aggregator = wry.instrumentation.Aggregator()
+        for hook in (self.measurements.append, self.aggregator):
+            wry.instrumentation.add_hook(hook)
+            self.addCleanup(wry.instrumentation.remove_hook, hook)
+        self.client = data.FakeTransport('fake_hostname', denied=['AMT_GeneralSettings'])
+
+    def test_measurements(self):
+        wry.common.get_resource(self.client, 'CIM_BootService')
+        self.assertRaises(wry.exceptions.WSManFault, wry.common.get_resource, self.client, 'AMT_GeneralSettings')
+        get, fault = self.measurements
+        self.assertEqual((get.host, get.action, get.resource_uri), ('fake_hostname', 'Get', wry.config.RESOURCE_URIs['CIM_BootService']))
+        self.assertEqual((get.attempts, get.fault, get.error), (1, None, None))
+        self.assertIsNone(get.network) # FakeTransport does not report phases.
+        self.assertEqual((fault.fault, fault.error), ('c:AccessDenied', 'WSManFault'))
+
+    def test_prometheus(self):
+        for _ in range(3):
+            wry.common.get_resource(self.client, 'CIM_BootService')
+        output = self.aggregator.prometheus()
+        self.assertIn('# TYPE wry_request_duration_seconds histogram', output)
+        self.assertIn('wry_request_duration_seconds_bucket{host="fake_hostname",action="Get",le="+Inf"} 3', output)
+        self.assertIn('wry_request_duration_seconds_count{host="fake_hostname",action="Get"} 3', output)
+        self.assertIn('wry_request_retries_total{host="fake_hostname",action="Get"} 0', output)
+
+    def test_phases(self):
+        simulator = wry.simulator.Simulator()
+        port = simulator.listen(device=wry.simulator.VirtualDevice(password=None))
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        client = wry.transport.HTTPTransport('127.0.0.1', port, '/wsman', 'http', 'user', 'password')
+        wry.common.get_resource(client, 'CIM_BootService')
+        measurement, = self.measurements
+        self.assertTrue(measurement.build > 0 and measurement.network > 0 and measurement.parse > 0)
+        self.assertTrue(measurement.request_bytes > 0 and measurement.response_bytes > 0)
+
+    def test_native_client_phases(self):
+        client = mock.Mock(spec=['get', 'host', 'port'], host='fake_hostname', port=16992)
+        client.get.return_value = wry.wsman.XmlDoc(data.get_response('CIM_BootService', ElementName='Boot'))
+        resource = wry.common.get_resource(client, 'CIM_BootService')
+        self.assertEqual(resource['CIM_BootService']['ElementName'], 'Boot')
+        measurement, = self.measurements
+        self.assertTrue(measurement.network > 0 and measurement.parse > 0)
+        self.assertEqual((measurement.build, measurement.request_bytes, measurement.response_bytes), (None, None, None))
+        self.assertIn('wry_request_bytes_total{host="fake_hostname",action="Get",direction="sent"} 0',
+            self.aggregator.prometheus())
+
+
+class RecordingTests(IsolatedTest):
+    '''Tests for recording traffic, and replaying it.'''
+
+    def setUp(self):
+        super(RecordingTests, self).setUp()
+        self.directory = self.mkdtemp()
+
+    def device(self, transport):
+        return wry.AMTDevice('node1', 'http', 'user', 'pass', transport=transport,
+            capability_cache=wry.capabilities.CapabilityCache())
+
+    def test_replay(self):
+        path = os.path.join(self.directory, 'trace.jsonl.gz')
+        fields = dict(ReimageTests.fields, CIM_AssociatedPowerManagementService={'PowerState': 8})
+        with wry.recording.Recorder(path) as recorder:
+            device = self.device(recorder.wrap(lambda *args: data.FakeTransport(*args, fields=fields)))
+            dumped = device.dump()
+            device.boot.medium = 'Network'
+        recording = wry.recording.Recording(path)
+        device = self.device(recording.transport)
+        self.assertEqual(device.dump(), dumped)
+        self.assertEqual(device.power.state.state, 'off')
+        device.boot.medium = 'Network'
+        self.assertRaises(LookupError, device.power.turn_on)
+        self.assertRaises(LookupError, self.device(recording.transport).boot.__setattr__, 'medium', 'CD/DVD')
+
+    def test_selectors_must_match(self):
+        path = os.path.join(self.directory, 'trace.jsonl')
+        selected = wry.data_structures.WryOptions().with_selector('InstanceID', 'a')
+        uri = wry.config.RESOURCE_URIs['CIM_BootConfigSetting']
+        with wry.recording.Recorder(path) as recorder:
+            client = recorder.wrap(data.FakeTransport)('node1', 16992, '/wsman', 'http', 'user', 'pass')
+            wry.common.wsman_get(client, uri, options=wry.data_structures.WryOptions())
+            wry.common.wsman_get(client, uri, options=selected)
+            client.get(mock.Mock(spec=pywsman.ClientOptions()), uri) # Native options, whose selectors are unknown.
+        recording = wry.recording.Recording(path)
+        client = recording.transport('node1')
+        wry.common.wsman_get(client, uri, options=selected)
+        wry.common.wsman_get(client, uri, options=wry.data_structures.WryOptions())
+        unrecorded = wry.data_structures.WryOptions().with_selector('InstanceID', 'b')
+        self.assertIsNotNone(wry.common.wsman_get(client, uri, options=unrecorded)) # Served by the native entry.
+        wildcard = ('node1', 'get', uri, None, '*', None, None)
+        self.assertEqual(recording._served, {('node1', 'get', uri, None, (('InstanceID', 'a'), ), None, None): 1,
+            ('node1', 'get', uri, None, None, None, None): 1, wildcard: 1})
+        with open(path) as infile:
+            lines = [line for line in infile if '"native":true' not in line]
+        with open(path, 'w') as outfile:
+            outfile.writelines(lines)
+        client = wry.recording.Recording(path).transport('node1')
+        self.assertRaises(LookupError, wry.common.wsman_get, client, uri, options=unrecorded)
+
+    def test_subscriptions(self):
+        path = os.path.join(self.directory, 'trace.jsonl')
+        with wry.recording.Recorder(path) as recorder:
+            client = recorder.wrap(data.FakeTransport)('node1', 16992, '/wsman', 'http', 'user', 'pass')
+            subscription = wry.common.subscribe(client, 'http://10.0.0.1:8090/node1')
+            renewed = wry.common.renew(client, subscription)
+            wry.common.unsubscribe(client, renewed)
+        self.assertEqual(wry.health.client_endpoint(client), ('node1', 16992))
+        with open(path) as infile:
+            entries = [json.loads(line) for line in infile]
+        self.assertEqual([entry['op'] for entry in entries], ['subscribe', 'renew', 'unsubscribe'])
+        self.assertIn('<wsa:To s:mustUnderstand="true">http://node1:16992/wsman</wsa:To>', entries[0]['request'])
+        self.assertIn('http://10.0.0.1:8090/node1', entries[0]['request'])
+        self.assertIn(subscription.identifier, entries[2]['request'])
+        client = wry.recording.Recording(path).transport('node1', 16992, '/wsman', 'http', 'user', 'pass')
+        self.assertEqual(wry.health.client_endpoint(client), ('node1', 16992))
+        self.assertEqual(wry.common.subscribe(client, 'http://10.0.0.2:8090/node1'), subscription)
+        self.assertEqual(wry.common.renew(client, subscription), renewed)
+        wry.common.unsubscribe(client, renewed)
+        self.assertRaises(LookupError, wry.common.renew, client, subscription._replace(identifier='uuid:other'))
+
+
+class StartupTests(unittest.TestCase):
+    '''Tests for making devices cheaply.'''
+
+    def test_import_is_light(self):
+        output = subprocess.check_output([sys.executable, '-c', '''if True:
+            import sys, wry
+            wry.AMTDevice('fake_hostname', 'http', 'user', 'pass')
+            print ' '.join(sorted(name for name in ('pywsman', 'xmltodict', 'uuid') if sys.modules.get(name)))
+        '''])
+        self.assertEqual(output.strip(), '')
+
+    def test_client_is_made_on_first_use(self):
+        made = []
+        def transport(*args):
+            made.append(data.FakeTransport(*args))
+            return made[-1]
+        device = wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=transport,
+            capability_cache=wry.capabilities.CapabilityCache())
+        device.debug = True
+        self.assertEqual(made, [])
+        self.assertIs(device.power.client, made[0])
+        self.assertIs(device.boot.client, made[0])
+        self.assertTrue(device.kvm.options.dump_request)
+        self.assertEqual(len(made), 1)
+
+    def test_devices_are_made_independently(self):
+        release = threading.Event()
+        def slow_transport(*args):
+            release.wait(2)
+            return data.FakeTransport(*args)
+        slow = wry.AMTDevice('slow_hostname', 'http', 'user', 'pass', transport=slow_transport)
+        thread = threading.Thread(target=lambda: slow.power)
+        thread.start()
+        started = time.time()
+        wry.AMTDevice('fake_hostname', 'http', 'user', 'pass', transport=data.FakeTransport).power
+        self.assertLess(time.time() - started, 1)
+        release.set()
+        thread.join()
+
+
+class CLITests(IsolatedTest):
+    '''Tests for the wry command.'''
+
+    def test_read_inventory(self):
+        hosts = list(wry.cli.read_inventory([
+            '# Comment',
+            '',
+            'node1',
+            'node2 root secret',
+            '10.0.0.0/30 admin',
+            '{"host": "node3", "password": "secret", "protocol": "https"}',
+        ]))
+        self.assertEqual(hosts, [
+            ('node1', None, None, None),
+            ('node2', 'root', 'secret', None),
+            ('10.0.0.1', 'admin', None, None),
+            ('10.0.0.2', 'admin', None, None),
+            ('node3', None, 'secret', 'https'),
+        ])
+        self.assertRaises(ValueError, list, wry.cli.read_inventory(['node1 a b c']))
+        self.assertRaises(ValueError, list, wry.cli.read_inventory(['{"username": "admin"}']))
+
+    def test_parse_operation(self):
+        self.assertEqual(wry.cli.parse_operation(['power', 'state']), ('power state', []))
+        self.assertEqual(wry.cli.parse_operation(['boot', 'set', 'Network']), ('boot set', ['Network']))
+        self.assertEqual(wry.cli.parse_operation(['dump']), ('dump', []))
+        self.assertRaises(ValueError, wry.cli.parse_operation, ['boot', 'set'])
+        self.assertRaises(ValueError, wry.cli.parse_operation, ['power', 'sideways'])
+
+    def test_run(self):
+        fields = {'CIM_AssociatedPowerManagementService': {'PowerState': 2}}
+        devices = [
+            wry.AMTDevice(host, 'http', 'user', 'pass', capability_cache=wry.capabilities.CapabilityCache(),
+                transport=functools.partial(data.FakeTransport, fields=fields, denied=denied))
+            for host, denied in (('node1', ()), ('node2', ('CIM_AssociatedPowerManagementService', )))
+        ]
+        output = StringIO()
+        self.assertEqual(wry.cli.run(devices, 'power state', concurrency=2, output=output), 1)
+        records = dict((record['host'], record) for record in map(json.loads, output.getvalue().splitlines()))
+        self.assertEqual(sorted(records), ['node1', 'node2'])
+        self.assertTrue(records['node1']['ok'])
+        self.assertEqual(records['node1']['result'], {'state': 'on', 'sub_state': None})
+        self.assertFalse(records['node2']['ok'])
+        self.assertEqual(records['node2']['error'], 'WSManFault')
+
+    def test_verbose_logs_requests(self):
+        fake = functools.partial(data.FakeTransport, denied=('CIM_AssociatedPowerManagementService', ))
+        with mock.patch.dict(wry.cli.TRANSPORTS, fake=fake), mock.patch('logging.basicConfig'), \
+                mock.patch('sys.stdin', StringIO('node1 user pass\n')), mock.patch('sys.stdout', StringIO()), \
+                mock.patch.object(wry.cli.LOG, 'debug') as debug, mock.patch.object(wry.cli.LOG, 'warning') as warning:
+            status = wry.cli.main(['-v', '--transport', 'fake', 'power', 'state'])
+            wry.instrumentation.remove_hook(wry.cli.log_request)
+        self.assertEqual(status, 1)
+        self.assertEqual([call[0][1:4] for call in debug.call_args_list],
+            [('node1', 'Get', wry.config.RESOURCE_URIs['CIM_AssociatedPowerManagementService'])])
+        warning.assert_called_once_with('%d of %d devices failed.', 1, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,8 +10,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import re
+import httplib
+import threading
+import time
+import urlparse
 import pywsman
+from wry.common import Transport
+from wry.config import RESOURCE_URIs
+from wry.wsman import XmlDoc
 
 
 
@@ -218,6 +224,50 @@ def client_enumerate(client, options, _, uri):
         raise RuntimeError
 
 
+def client_enumerate_optimized(client, options, _, uri):
+    '''An optimized enumeration, which returns every instance in its response.'''
+    if uri == 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_BootSourceSetting':
+        return pywsman.create_doc_from_string('''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:b="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:c="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd" xmlns:d="http://schemas.xmlsoap.org/ws/2005/02/trust" xmlns:e="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd" xmlns:f="http://schemas.dmtf.org/wbem/wsman/1/cimbinding.xsd" xmlns:g="http://schemas.xmlsoap.org/ws/2004/09/enumeration" xmlns:h="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_BootSourceSetting" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <a:Header>
+    <b:To>http://schemas.xmlsoap.org/ws/2004/08/addressing/role/anonymous</b:To>
+    <b:RelatesTo>uuid:0041f82d-241a-141a-8002-80db73edaeb8</b:RelatesTo>
+    <b:Action a:mustUnderstand="true">http://schemas.xmlsoap.org/ws/2004/09/enumeration/EnumerateResponse</b:Action>
+    <b:MessageID>uuid:00000000-8086-8086-8086-00000000021E</b:MessageID>
+    <c:ResourceURI>http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_BootSourceSetting</c:ResourceURI>
+  </a:Header>
+  <a:Body>
+    <g:EnumerateResponse>
+      <g:EnumerationContext>26000000-0000-0000-0000-000000000000</g:EnumerationContext>
+      <c:Items>
+        <h:CIM_BootSourceSetting>
+          <h:ElementName>Intel(r) AMT: Boot Source</h:ElementName>
+          <h:FailThroughSupported>2</h:FailThroughSupported>
+          <h:InstanceID>Intel(r) AMT: Force Hard-drive Boot</h:InstanceID>
+          <h:StructuredBootString>CIM:Hard-Disk:1</h:StructuredBootString>
+        </h:CIM_BootSourceSetting>
+        <h:CIM_BootSourceSetting>
+          <h:ElementName>Intel(r) AMT: Boot Source</h:ElementName>
+          <h:FailThroughSupported>2</h:FailThroughSupported>
+          <h:InstanceID>Intel(r) AMT: Force PXE Boot</h:InstanceID>
+          <h:StructuredBootString>CIM:Network:1</h:StructuredBootString>
+        </h:CIM_BootSourceSetting>
+        <h:CIM_BootSourceSetting>
+          <h:ElementName>Intel(r) AMT: Boot Source</h:ElementName>
+          <h:FailThroughSupported>2</h:FailThroughSupported>
+          <h:InstanceID>Intel(r) AMT: Force CD/DVD Boot</h:InstanceID>
+          <h:StructuredBootString>CIM:CD/DVD:1</h:StructuredBootString>
+        </h:CIM_BootSourceSetting>
+      </c:Items>
+      <c:EndOfSequence/>
+    </g:EnumerateResponse>
+  </a:Body>
+</a:Envelope>
+''')
+    else:
+        raise RuntimeError
+
+
 def client_get(*args, **kwargs):
     if args[-1] == 'http://intel.com/wbem/wscim/1/amt-schema/1/AMT_BootSettingData':
         return pywsman.create_doc_from_string('''<?xml version="1.0" encoding="UTF-8"?>
@@ -273,3 +323,221 @@ def client_get(*args, **kwargs):
 </a:Envelope>''')
     raise RuntimeError(args, kwargs)
 
+
+def get_response(resource_name, **fields):
+    '''A Get response for any resource, with the given fields.'''
+    uri = RESOURCE_URIs[resource_name]
+    values = ''.join('<h:%s>%s</h:%s>' % (name, value, name) for name, value in sorted(fields.items()))
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:h="%s">
+  <a:Body>
+    <h:%s>%s</h:%s>
+  </a:Body>
+</a:Envelope>''' % (uri, resource_name, values, resource_name)
+
+
+def invoke_response(resource_uri, method_name, return_value=0):
+    '''The response to a method invocation.'''
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:h="%s">
+  <a:Body>
+    <h:%s_OUTPUT><h:ReturnValue>%d</h:ReturnValue></h:%s_OUTPUT>
+  </a:Body>
+</a:Envelope>''' % (resource_uri, method_name, return_value, method_name)
+
+
+fault_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:c="http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd">
+  <a:Body>
+    <a:Fault>
+      <a:Code>
+        <a:Value>a:Sender</a:Value>
+        <a:Subcode>
+          <a:Value>c:AccessDenied</a:Value>
+        </a:Subcode>
+      </a:Code>
+      <a:Reason>
+        <a:Text xml:lang="en-US">The sender was not authorized to access the resource.</a:Text>
+      </a:Reason>
+    </a:Fault>
+  </a:Body>
+</a:Envelope>'''
+
+
+unsupported_response = fault_response.replace('c:AccessDenied', 'a:DestinationUnreachable').replace(
+    'The sender was not authorized to access the resource.',
+    'No route can be determined to reach the destination role defined by the WS-Addressing To.')
+
+
+identify_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:b="http://schemas.dmtf.org/wbem/wsman/identity/1/wsmanidentity.xsd">
+  <a:Header></a:Header>
+  <a:Body>
+    <b:IdentifyResponse>
+      <b:ProtocolVersion>http://schemas.dmtf.org/wbem/wsman/1/wsman.xsd</b:ProtocolVersion>
+      <b:ProductVendor>Intel Corporation</b:ProductVendor>
+      <b:ProductVersion>AMT 11.8</b:ProductVersion>
+    </b:IdentifyResponse>
+  </a:Body>
+</a:Envelope>'''
+
+
+subscribe_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:b="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:e="http://schemas.xmlsoap.org/ws/2004/08/eventing">
+  <a:Body>
+    <e:SubscribeResponse>
+      <e:SubscriptionManager>
+        <b:Address>http://fake_hostname:16992/wsman</b:Address>
+        <b:ReferenceParameters>
+          <e:Identifier>uuid:00000000-8086-8086-8086-000000000001</e:Identifier>
+        </b:ReferenceParameters>
+      </e:SubscriptionManager>
+      <e:Expires>PT3600.000000S</e:Expires>
+    </e:SubscribeResponse>
+  </a:Body>
+</a:Envelope>'''
+
+
+renew_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:e="http://schemas.xmlsoap.org/ws/2004/08/eventing">
+  <a:Body>
+    <e:RenewResponse>
+      <e:Expires>PT3600.000000S</e:Expires>
+    </e:RenewResponse>
+  </a:Body>
+</a:Envelope>'''
+
+unsubscribe_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope">
+  <a:Body/>
+</a:Envelope>'''
+
+
+def event(sequence, message_id='PLAT0204'):
+    '''An alert indication, as a device pushes it to a subscriber.'''
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<a:Envelope xmlns:a="http://www.w3.org/2003/05/soap-envelope" xmlns:b="http://schemas.xmlsoap.org/ws/2004/08/addressing" xmlns:g="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_AlertIndication">
+  <a:Header>
+    <b:Action a:mustUnderstand="true">http://schemas.dmtf.org/wbem/wsman/1/wsman/Event</b:Action>
+  </a:Header>
+  <a:Body>
+    <g:CIM_AlertIndication>
+      <g:AlertType>6</g:AlertType>
+      <g:IndicationIdentifier>%d</g:IndicationIdentifier>
+      <g:MessageID>%s</g:MessageID>
+    </g:CIM_AlertIndication>
+  </a:Body>
+</a:Envelope>''' % (sequence, message_id)
+
+
+def send_event(url, body):
+    '''Push an event to url, as a device would. Returns the response status.'''
+    parts = urlparse.urlparse(url)
+    connection = httplib.HTTPConnection(parts.hostname, parts.port, timeout=5)
+    try:
+        connection.request('POST', parts.path, body, {'Content-Type': 'application/soap+xml;charset=UTF-8'})
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+class FakeTransport(Transport):
+    '''
+    A transport answering Get requests for any resource, with the fields given
+    for it in fields (or else just its ElementName), or a fault for those named
+    in denied (AccessDenied) or unsupported (DestinationUnreachable), and
+    enumerations with client_enumerate_optimized. Records the
+    most requests that were in progress at once, the data put, the options
+    subscribed with, and the (operation, resource name or
+    subscription identifier) of each request.
+    '''
+
+    thread_safe = True
+
+    def __init__(self, *args, **kwargs):
+        self.host = args[0] if args else None
+        self.port = args[1] if len(args) > 1 else None
+        self.denied = kwargs.pop('denied', ())
+        self.unsupported = kwargs.pop('unsupported', ())
+        self.delay = kwargs.pop('delay', 0)
+        self.fields = kwargs.pop('fields', {})
+        self.puts = []
+        self.subscriptions = []
+        self.requests = []
+        self.in_progress = 0
+        self.most_in_progress = 0
+        self.lock = threading.Lock()
+
+    def _respond(self, xml):
+        with self.lock:
+            self.in_progress += 1
+            self.most_in_progress = max(self.most_in_progress, self.in_progress)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_progress -= 1
+        return XmlDoc(xml)
+
+    def get(self, options, resource_uri):
+        resource_name = resource_uri.split('/')[-1]
+        self.requests.append(('get', resource_name))
+        if resource_name in self.denied:
+            return self._respond(fault_response)
+        if resource_name in self.unsupported:
+            return self._respond(unsupported_response)
+        return self._respond(get_response(resource_name, **self.fields.get(resource_name, {'ElementName': resource_name})))
+
+    def put(self, options, resource_uri, data, length=None):
+        resource_name = resource_uri.split('/')[-1]
+        self.puts.append((resource_name, data))
+        return self.get(options, resource_uri)
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        self.requests.append(('enumerate', resource_uri.split('/')[-1]))
+        return self._respond(client_enumerate_optimized(None, options, wsman_filter, resource_uri).root().string())
+
+    def invoke(self, options, resource_uri, method, data):
+        self.requests.append(('invoke', method))
+        return self._respond(invoke_response(resource_uri, method))
+
+    def identify(self, options):
+        return self._respond(identify_response)
+
+    def subscribe(self, options, wsman_filter, resource_uri):
+        self.subscriptions.append(options)
+        return self._respond(subscribe_response)
+
+    def renew(self, options, resource_uri, identifier):
+        self.requests.append(('renew', identifier))
+        return self._respond(renew_response)
+
+    def unsubscribe(self, options, wsman_filter, resource_uri, identifier):
+        self.requests.append(('unsubscribe', identifier))
+        return self._respond(unsubscribe_response)
+
+
+class ResettingTransport(FakeTransport):
+    '''
+    A FakeTransport of a device which reports that it is off for the first
+    off_polls polls of its power state after a power state change is
+    requested, and its fields otherwise.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.off_polls = kwargs.pop('off_polls', 2)
+        self.resetting = 0
+        FakeTransport.__init__(self, *args, **kwargs)
+
+    def get(self, options, resource_uri):
+        if resource_uri.endswith('/CIM_AssociatedPowerManagementService'):
+            with self.lock:
+                resetting, self.resetting = self.resetting, max(self.resetting - 1, 0)
+            if resetting:
+                return self._respond(get_response('CIM_AssociatedPowerManagementService', PowerState=8))
+        return FakeTransport.get(self, options, resource_uri)
+
+    def invoke(self, options, resource_uri, method, data):
+        if method == 'RequestPowerStateChange':
+            with self.lock:
+                self.resetting = self.off_polls
+        return FakeTransport.invoke(self, options, resource_uri, method, data)
+
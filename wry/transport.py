@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Pure-Python WS-Man transports, for use in place of pywsman.Client.
+
+>>> dev = AMTDevice(address, 'http', username, password, transport=HTTPTransport)
+"""
+
+import httplib
+import logging
+import socket
+import threading
+from time import time
+from wry import exceptions
+from wry import instrumentation
+from wry import wsman
+from wry.common import Transport
+
+
+
+LOG = logging.getLogger(__name__)
+
+
+class HTTPTransport(Transport):
+    '''
+    A WS-Man transport which keeps HTTP/1.1 connections to the device open
+    between requests, and pools them.
+
+    Once the device has issued a digest challenge, every subsequent request is
+    authenticated preemptively with the same nonce, until the device reports
+    that it has gone stale. Most requests therefore cost a single round trip
+    on an existing connection, rather than a connect plus a 401.
+
+    Instances are thread-safe.
+    '''
+
+    thread_safe = True
+
+    def __init__(self, location, port, path, protocol, username, password,
+        timeout=60, pool_size=2, ssl_context=None):
+        '''
+        :param timeout: Socket timeout in seconds, for requests whose options
+        do not set one.
+        :param pool_size: The maximum number of connections to the device, and
+        therefore of requests in flight to it at once.
+        :param ssl_context: An ssl.SSLContext used when protocol is https.
+        '''
+        self.host = location
+        self.port = port
+        self.path = path
+        self.scheme = protocol
+        self.url = '%s://%s:%s%s' % (protocol, location, port, path)
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.auth = wsman.DigestAuth(username, password)
+        self.dumpfile = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def get(self, options, resource_uri):
+        return self._request(wsman.get_request(self.url, resource_uri, options), options)
+
+    def put(self, options, resource_uri, data, length=None):
+        return self._request(wsman.put_request(self.url, resource_uri, data, options), options)
+
+    def enumerate(self, options, wsman_filter, resource_uri):
+        return self._request(wsman.enumerate_request(self.url, resource_uri, options, wsman_filter), options)
+
+    def pull(self, options, wsman_filter, resource_uri, context):
+        return self._request(wsman.pull_request(self.url, resource_uri, context, options), options)
+
+    def invoke(self, options, resource_uri, method, data):
+        return self._request(wsman.invoke_request(self.url, resource_uri, method, data, options), options)
+
+    def identify(self, options=None):
+        return self._request(wsman.identify_request(), options)
+
+    def subscribe(self, options, wsman_filter, resource_uri):
+        return self._request(wsman.subscribe_request(self.url, resource_uri, options, wsman_filter), options)
+
+    def renew(self, options, resource_uri, identifier):
+        return self._request(wsman.renew_request(self.url, resource_uri, identifier, options), options)
+
+    def unsubscribe(self, options, wsman_filter, resource_uri, identifier):
+        return self._request(wsman.unsubscribe_request(self.url, resource_uri, identifier, options), options)
+
+    def close(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _request(self, envelope, options):
+        if self.dumpfile is not None and getattr(options, 'get_flags', lambda: 0)() & wsman.FLAG_DUMP_REQUEST:
+            self.dumpfile.write(envelope + '\n')
+            self.dumpfile.flush()
+        if isinstance(envelope, unicode):
+            envelope = envelope.encode('utf-8')
+        timing = instrumentation.current()
+        with self._slots:
+            started = time()
+            try:
+                status, body = self._post(envelope, getattr(options, 'timeout', None) or self.timeout)
+            except (socket.error, httplib.HTTPException) as error:
+                LOG.debug('Request to %s failed: %s', self.url, error)
+                return None
+            finally:
+                if timing is not None:
+                    timing.network += time() - started
+                    timing.request_bytes += len(envelope)
+                    timing.reported = True
+        if status == 401:
+            LOG.warning('Authentication with %s failed.', self.url)
+            return None
+        if not body:
+            return None
+        if timing is not None:
+            timing.response_bytes += len(body)
+            started = time()
+        try:
+            return wsman.XmlDoc(body)
+        except wsman.ElementTree.ParseError as error:
+            raise exceptions.XMLParseError('Could not parse the response from %s: %s' % (self.url, error))
+        finally:
+            if timing is not None:
+                timing.parse += time() - started
+
+    def _post(self, envelope, timeout):
+        challenges = 0
+        while True:
+            connection, reused = self._checkout(timeout)
+            headers = {'Content-Type': 'application/soap+xml;charset=UTF-8'}
+            if self.auth.ready:
+                headers['Authorization'] = self.auth.header('POST', self.path)
+            try:
+                connection.request('POST', self.path, envelope, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    continue # The device closed an idle connection; try a fresh one.
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            challenge = response.getheader('www-authenticate')
+            if response.status == 401 and challenge and challenges < 2:
+                challenges += 1
+                self.auth.update(challenge)
+                continue
+            return response.status, body
+
+    def _checkout(self, timeout):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port, timeout=timeout, context=self.ssl_context), False
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append(connection)
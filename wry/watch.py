@@ -0,0 +1,321 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Watching the power state of many devices at once, from a single scheduler.
+
+>>> watcher = PowerWatcher(devices)
+>>> watcher.subscribe(lambda transition: print_transition(transition))
+>>> for device in devices:
+...     watcher.request_power_state_change(device, 8)
+>>> watcher.wait_for_state(devices, 'off', timeout=300)
+"""
+
+import heapq
+import itertools
+import logging
+import re
+import threading
+from collections import namedtuple
+from Queue import Queue
+from time import time
+from wry import common
+from wry import exceptions
+from wry.config import (FLEET_MAX_WORKERS, RESOURCE_URIs, WATCH_FAST_INTERVAL, WATCH_SETTLE_TIME, WATCH_SLOW_INTERVAL,
+    WATCH_STOP_TIMEOUT)
+from wry.data_structures import WryDict
+from wry.decorators import RetryPolicy
+from wry.device import AMT_POWER_STATE_MAP, StateMap
+
+
+
+LOG = logging.getLogger(__name__)
+
+_RESOURCE = 'CIM_AssociatedPowerManagementService'
+
+_POWER_STATE = re.compile(r'<(?:[\w.-]+:)?PowerState>\s*(\d+)\s*</')
+
+# A failed poll is not retried: the next poll will come round soon enough.
+_POLL_POLICY = RetryPolicy(max_attempts=1)
+
+
+class PowerTransition(namedtuple('PowerTransition', ['device', 'previous', 'current'])):
+    '''
+    A change in a device's power state. previous and current are
+    :class:`wry.device.StateMap` instances from
+    :data:`wry.device.AMT_POWER_STATE_MAP`.
+    '''
+
+
+def poll_power_state(client, options=None):
+    '''
+    Fetch a device's power state, as a StateMap.
+
+    Unlike AMTPower.state, this never consults a cache, and picks PowerState
+    straight out of the response rather than decoding all of it.
+    '''
+    doc = common.wsman_get(client, RESOURCE_URIs[_RESOURCE], options=options, retry_policy=_POLL_POLICY)
+    match = _POWER_STATE.search(doc.root().string())
+    if match:
+        index = int(match.group(1))
+    else:
+        index = WryDict(doc)[_RESOURCE]['PowerState']
+    return AMT_POWER_STATE_MAP[index]
+
+
+def _client_for(device):
+    '''Polls run on worker threads, so a device needs a client of its own unless its client is thread-safe.'''
+    if getattr(device.client, 'thread_safe', False) or not hasattr(device, '_new_client'):
+        return device.client
+    return device._new_client()
+
+
+def _matches(current, state):
+    if current is None:
+        return False
+    if isinstance(state, StateMap):
+        return current == state
+    return current.state == state
+
+
+class _Watch(object):
+    def __init__(self, device, client, interval):
+        self.device = device
+        self.client = client
+        self.interval = interval
+        self.state = None
+        self.error = None
+        self.due = None
+        self.hurried_until = 0
+        self.polling = False
+
+
+class PowerWatcher(object):
+    '''
+    Tracks the power state of a set of :class:`wry.AMTDevice` instances.
+
+    Each device is polled adaptively: every fast_interval seconds for
+    settle_time seconds after a power state change is requested through the
+    watcher (or hurry() is called), and after any transition is seen. While a
+    device's state stays the same, the interval doubles, up to slow_interval.
+
+    Callbacks given to subscribe() are called with a :class:`PowerTransition`
+    only when a device's state changes, from the worker thread which polled
+    it. To consume transitions elsewhere, subscribe a Queue's put method.
+
+    Polls are scheduled by one thread, and made by up to max_workers others.
+    Threads are started by start() (or by using the watcher as a context
+    manager, or by wait_for_state()).
+    '''
+
+    def __init__(self, devices=(), fast_interval=WATCH_FAST_INTERVAL, slow_interval=WATCH_SLOW_INTERVAL,
+        settle_time=WATCH_SETTLE_TIME, max_workers=FLEET_MAX_WORKERS):
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.settle_time = settle_time
+        self.max_workers = max_workers
+        self._watches = {}
+        self._callbacks = []
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._work = Queue()
+        self._threads = []
+        self._running = False
+        for device in devices:
+            self.watch(device)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _enqueue(self, watch, delay):
+        watch.due = time() + delay
+        heapq.heappush(self._schedule, (watch.due, next(self._sequence), watch))
+        self._condition.notify_all()
+
+    def watch(self, device):
+        '''Start tracking device. Its state is polled straight away.'''
+        with self._condition:
+            if device in self._watches:
+                return
+            watch = self._watches[device] = _Watch(device, _client_for(device), self.fast_interval)
+            self._enqueue(watch, 0)
+
+    def unwatch(self, device):
+        with self._condition:
+            self._watches.pop(device, None)
+
+    def subscribe(self, callback):
+        '''Call callback(transition) whenever a watched device changes state.'''
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def state(self, device):
+        '''The last known StateMap of a watched device, or None before it has been polled.'''
+        with self._condition:
+            return self._watches[device].state
+
+    def states(self):
+        '''Return a dict mapping each watched device to its last known StateMap.'''
+        with self._condition:
+            return dict((device, watch.state) for device, watch in self._watches.items())
+
+    def hurry(self, device, duration=None):
+        '''
+        Poll device every fast_interval seconds for the next duration seconds
+        (by default, settle_time), eg. because its state is about to change.
+        '''
+        if duration is None:
+            duration = self.settle_time
+        with self._condition:
+            watch = self._watches[device]
+            watch.hurried_until = max(watch.hurried_until, time() + duration)
+            watch.interval = self.fast_interval
+            if not watch.polling and watch.due > time() + self.fast_interval:
+                self._enqueue(watch, self.fast_interval)
+
+    def request_power_state_change(self, device, power_state):
+        '''
+        Request a power state change (see AMTPower.request_power_state_change),
+        and watch the device closely until it settles.
+        '''
+        self.watch(device)
+        output = device.power.request_power_state_change(power_state)
+        self.hurry(device)
+        return output
+
+    def wait_for_state(self, devices, state, timeout=None):
+        '''
+        Block until each of devices is in state, and return a dict mapping
+        them to their StateMaps.
+
+        :param state: A StateMap, or just its state, such as 'off'.
+        :raises DeadlineExceeded: If timeout seconds pass first.
+        '''
+        devices = list(devices)
+        for device in devices:
+            self.watch(device)
+            self.hurry(device, duration=timeout)
+        self.start()
+        deadline = None if timeout is None else time() + timeout
+        with self._condition:
+            while True:
+                states = dict((device, getattr(self._watches.get(device), 'state', None)) for device in devices)
+                pending = [device for device in devices if not _matches(states[device], state)]
+                if not pending:
+                    return states
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise exceptions.DeadlineExceeded('%d of %d devices were not %r within %ss.' % (
+                        len(pending), len(devices), state, timeout))
+                self._condition.wait(remaining)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            previous = self._threads
+        if previous and previous[0] is not threading.current_thread():
+            previous[0].join() # The scheduler of the last run, which exits as soon as it wakes.
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            # Workers of the last run may still be polling; they keep the queue they were given.
+            self._work = Queue()
+            self._threads = [threading.Thread(target=self._run)] + [
+                threading.Thread(target=self._work_on, args=(self._work, )) for _ in range(self.max_workers)]
+            threads = self._threads
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=WATCH_STOP_TIMEOUT):
+        '''
+        Stop polling, and wait up to timeout seconds for polls in progress to
+        finish, and the watcher's threads to exit.
+        '''
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            threads, work = self._threads, self._work
+            self._condition.notify_all()
+        for _ in threads[1:]:
+            work.put(None)
+        deadline = time() + timeout
+        for thread in threads:
+            if thread is not threading.current_thread(): # A callback may stop the watcher.
+                thread.join(max(deadline - time(), 0))
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                now = time()
+                while self._schedule and self._schedule[0][0] <= now:
+                    due, _, watch = heapq.heappop(self._schedule)
+                    if self._watches.get(watch.device) is watch and watch.due == due and not watch.polling:
+                        watch.polling = True
+                        self._work.put(watch)
+                wait = self._schedule[0][0] - now if self._schedule else None
+                self._condition.wait(wait)
+
+    def _work_on(self, work):
+        while True:
+            watch = work.get()
+            if watch is None:
+                return
+            self._poll(watch)
+
+    def _poll(self, watch):
+        try:
+            state, error = poll_power_state(watch.client, getattr(watch.device, 'options', None)), None
+        except (exceptions.AMTConnectFailure, exceptions.WSManFault) as exc:
+            state, error = None, exc
+        except Exception as exc: # eg. a response which is not XML. The device must still be polled again.
+            LOG.exception('Polling the power state of %r failed.', watch.device)
+            state, error = None, exc
+        transition = None
+        with self._condition:
+            watch.polling = False
+            watch.error = error
+            if error is None:
+                if watch.state is not None and state != watch.state:
+                    transition = PowerTransition(watch.device, watch.state, state)
+                watch.state = state
+            if transition or time() < watch.hurried_until:
+                watch.interval = self.fast_interval
+            else:
+                watch.interval = min(watch.interval * 2, self.slow_interval)
+            if self._watches.get(watch.device) is watch:
+                self._enqueue(watch, watch.interval)
+        if transition:
+            for callback in list(self._callbacks):
+                try:
+                    callback(transition)
+                except Exception:
+                    LOG.exception('Power transition callback %r failed.', callback)
+
+
+def wait_for_state(devices, state, timeout=None, **kwargs):
+    '''
+    Block until each of devices is in state, using a PowerWatcher of its own.
+    kwargs are passed to PowerWatcher. See PowerWatcher.wait_for_state.
+    '''
+    with PowerWatcher(**kwargs) as watcher:
+        return watcher.wait_for_state(devices, state, timeout=timeout)
@@ -0,0 +1,497 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+A pure-Python implementation of the parts of WS-Man (and HTTP digest
+authentication) that wry uses, for transports which do not go through
+openwsman.
+
+Requests are laid out exactly as openwsman lays them out, so that the same
+operation produces the same envelope whichever transport sends it.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from time import time
+from xml.etree import ElementTree
+from wry import instrumentation
+from wry.config import SCHEMAS
+
+
+
+NAMESPACES = dict(
+    soap = 'http://www.w3.org/2003/05/soap-envelope',
+    addressing = SCHEMAS['addressing'],
+    wsman = SCHEMAS['wsman'],
+    transfer = 'http://schemas.xmlsoap.org/ws/2004/09/transfer',
+    enumeration = 'http://schemas.xmlsoap.org/ws/2004/09/enumeration',
+    identity = 'http://schemas.dmtf.org/wbem/wsman/identity/1/wsmanidentity.xsd',
+    eventing = 'http://schemas.xmlsoap.org/ws/2004/08/eventing',
+)
+
+# Prefixes are declared on the envelope in this order, as openwsman does.
+# Any other namespace used in the body is given the next free nN prefix.
+_PREFIXES = OrderedDict([
+    (NAMESPACES['soap'], 's'),
+    (NAMESPACES['addressing'], 'wsa'),
+    (NAMESPACES['wsman'], 'wsman'),
+])
+
+_KNOWN_PREFIXES = {
+    NAMESPACES['enumeration']: 'wsen',
+    NAMESPACES['identity']: 'wsmid',
+    NAMESPACES['eventing']: 'wse',
+}
+
+# As defined by openwsman, so that the same values work with pywsman.ClientOptions.
+FLAG_ENUMERATION_OPTIMIZATION = 0x2
+FLAG_DUMP_REQUEST = 0x10
+
+
+def _qname(namespace, tag):
+    return '{%s}%s' % (namespace, tag)
+
+
+def _element(parent, namespace, tag, text=None, **attributes):
+    element = ElementTree.SubElement(parent, _qname(NAMESPACES[namespace], tag))
+    for name, value in attributes.items():
+        if name == 'mustUnderstand':
+            name = _qname(NAMESPACES['soap'], name)
+        element.set(name, value)
+    element.text = text
+    return element
+
+
+def _split(tag):
+    if tag.startswith('{'):
+        return tag[1:].split('}', 1)
+    return None, tag
+
+
+def _escape(text, attribute=False):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if attribute:
+        text = text.replace('"', '&quot;')
+    return text
+
+
+def _prefixed(name, prefixes):
+    namespace, local = _split(name)
+    if namespace is None:
+        return local
+    return '%s:%s' % (prefixes[namespace], local)
+
+
+def _write(element, prefixes, depth, lines, declarations=''):
+    indent = '  ' * depth
+    tag = _prefixed(element.tag, prefixes)
+    attributes = declarations + ''.join(
+        ' %s="%s"' % (_prefixed(name, prefixes), _escape(value, attribute=True))
+        for name, value in element.items()
+    )
+    children = list(element)
+    if children:
+        lines.append('%s<%s%s>' % (indent, tag, attributes))
+        for child in children:
+            _write(child, prefixes, depth + 1, lines)
+        lines.append('%s</%s>' % (indent, tag))
+    elif element.text:
+        lines.append('%s<%s%s>%s</%s>' % (indent, tag, attributes, _escape(element.text), tag))
+    else:
+        lines.append('%s<%s%s/>' % (indent, tag, attributes))
+
+
+def serialize(envelope):
+    '''Render an envelope Element as openwsman would put it on the wire.'''
+    prefixes = OrderedDict(_PREFIXES)
+    numbered = 0
+    for element in envelope.iter():
+        for name in [element.tag] + element.keys():
+            namespace, _ = _split(name)
+            if namespace and namespace not in prefixes:
+                if namespace in _KNOWN_PREFIXES:
+                    prefixes[namespace] = _KNOWN_PREFIXES[namespace]
+                else:
+                    numbered += 1
+                    prefixes[namespace] = 'n%d' % numbered
+    declarations = ''.join(' xmlns:%s="%s"' % (prefix, uri) for uri, prefix in prefixes.items())
+    lines = ['<?xml version="1.0"?>']
+    _write(envelope, prefixes, 0, lines, declarations)
+    return '\n'.join(lines)
+
+
+def _uuid4():
+    '''As str(uuid.uuid4()), without importing uuid, which loads ctypes.'''
+    value = int(os.urandom(16).encode('hex'), 16)
+    value = value & ~(0xc000 << 48) | 0x8000 << 48 # RFC 4122 variant.
+    value = value & ~(0xf000 << 64) | 4 << 76 # Version 4.
+    digits = '%032x' % value
+    return '%s-%s-%s-%s-%s' % (digits[:8], digits[8:12], digits[12:16], digits[16:20], digits[20:])
+
+
+def _duration(seconds):
+    '''An xs:duration, as openwsman writes them.'''
+    return 'PT%fS' % seconds
+
+
+def build_request(action, to, resource_uri, options=None, body=None, identifier=None):
+    '''
+    Build a request envelope, and return it as a string.
+
+    :param body: An Element, or an XML string, to be placed in the SOAP body.
+    :param options: A data_structures.WryOptions. Its selectors, and its
+    timeout as an OperationTimeout, are added to the header.
+    :param identifier: The identifier of a WS-Eventing subscription, for
+    requests which manage one.
+    '''
+    timing = instrumentation.current()
+    started = time() if timing is not None else None
+    envelope = ElementTree.Element(_qname(NAMESPACES['soap'], 'Envelope'))
+    header = _element(envelope, 'soap', 'Header')
+    _element(header, 'addressing', 'Action', action, mustUnderstand='true')
+    _element(header, 'addressing', 'To', to, mustUnderstand='true')
+    _element(header, 'wsman', 'ResourceURI', resource_uri, mustUnderstand='true')
+    _element(header, 'addressing', 'MessageID', 'uuid:%s' % _uuid4(), mustUnderstand='true')
+    reply_to = _element(header, 'addressing', 'ReplyTo')
+    _element(reply_to, 'addressing', 'Address', SCHEMAS['addressing_anonymous'])
+    if getattr(options, 'timeout', None):
+        _element(header, 'wsman', 'OperationTimeout', 'PT%.3fS' % options.timeout)
+    selectors = getattr(options, 'selectors', None)
+    if selectors:
+        selector_set = _element(header, 'wsman', 'SelectorSet')
+        for name, value in selectors:
+            _element(selector_set, 'wsman', 'Selector', value, Name=name)
+    if identifier:
+        _element(header, 'eventing', 'Identifier', identifier)
+    soap_body = _element(envelope, 'soap', 'Body')
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if isinstance(body, str):
+        body = ElementTree.fromstring(body)
+    if body is not None:
+        soap_body.append(body)
+    output = serialize(envelope)
+    if timing is not None:
+        timing.build += time() - started
+    return output
+
+
+def get_request(to, resource_uri, options=None):
+    return build_request(NAMESPACES['transfer'] + '/Get', to, resource_uri, options)
+
+
+def put_request(to, resource_uri, data, options=None):
+    return build_request(NAMESPACES['transfer'] + '/Put', to, resource_uri, options, body=data)
+
+
+def enumerate_request(to, resource_uri, options=None, wsman_filter=None):
+    body = ElementTree.Element(_qname(NAMESPACES['enumeration'], 'Enumerate'))
+    if getattr(options, 'get_flags', lambda: 0)() & FLAG_ENUMERATION_OPTIMIZATION:
+        _element(body, 'wsman', 'OptimizeEnumeration')
+        if getattr(options, 'max_elements', None):
+            _element(body, 'wsman', 'MaxElements', str(options.max_elements))
+    if wsman_filter:
+        _element(body, 'wsman', 'Filter', str(wsman_filter))
+    return build_request(NAMESPACES['enumeration'] + '/Enumerate', to, resource_uri, options, body=body)
+
+
+def pull_request(to, resource_uri, context, options=None):
+    body = ElementTree.Element(_qname(NAMESPACES['enumeration'], 'Pull'))
+    context_element = ElementTree.SubElement(body, _qname(NAMESPACES['enumeration'], 'EnumerationContext'))
+    context_element.text = context
+    if getattr(options, 'max_elements', None):
+        max_elements = ElementTree.SubElement(body, _qname(NAMESPACES['enumeration'], 'MaxElements'))
+        max_elements.text = str(options.max_elements)
+    return build_request(NAMESPACES['enumeration'] + '/Pull', to, resource_uri, options, body=body)
+
+
+def invoke_request(to, resource_uri, method, data, options=None):
+    return build_request('%s/%s' % (resource_uri, method), to, resource_uri, options, body=data)
+
+
+def subscribe_request(to, resource_uri, options=None, wsman_filter=None):
+    '''
+    Subscribe to events, to be pushed to the options' delivery_uri, for the
+    options' expiration in seconds (or indefinitely).
+    '''
+    body = ElementTree.Element(_qname(NAMESPACES['eventing'], 'Subscribe'))
+    delivery = _element(body, 'eventing', 'Delivery', Mode=NAMESPACES['eventing'] + '/DeliveryModes/Push')
+    notify_to = _element(delivery, 'eventing', 'NotifyTo')
+    _element(notify_to, 'addressing', 'Address', options.delivery_uri)
+    if options.expiration:
+        _element(body, 'eventing', 'Expires', _duration(options.expiration))
+    if wsman_filter:
+        _element(body, 'wsman', 'Filter', str(wsman_filter))
+    return build_request(NAMESPACES['eventing'] + '/Subscribe', to, resource_uri, options, body=body)
+
+
+def renew_request(to, resource_uri, identifier, options=None):
+    body = ElementTree.Element(_qname(NAMESPACES['eventing'], 'Renew'))
+    if getattr(options, 'expiration', None):
+        _element(body, 'eventing', 'Expires', _duration(options.expiration))
+    return build_request(NAMESPACES['eventing'] + '/Renew', to, resource_uri, options, body=body, identifier=identifier)
+
+
+def unsubscribe_request(to, resource_uri, identifier, options=None):
+    body = ElementTree.Element(_qname(NAMESPACES['eventing'], 'Unsubscribe'))
+    return build_request(NAMESPACES['eventing'] + '/Unsubscribe', to, resource_uri, options, body=body, identifier=identifier)
+
+
+def identify_request():
+    envelope = ElementTree.Element(_qname(NAMESPACES['soap'], 'Envelope'))
+    _element(envelope, 'soap', 'Header')
+    body = _element(envelope, 'soap', 'Body')
+    ElementTree.SubElement(body, _qname(NAMESPACES['identity'], 'Identify'))
+    return serialize(envelope)
+
+
+class _Fault(object):
+    def __init__(self, element):
+        self.element = element
+
+    def _text(self, path):
+        found = self.element.find(path.format(s='{%s}' % NAMESPACES['soap']))
+        if found is None:
+            return None
+        return (found.text or '').strip() or None
+
+    def reason(self):
+        return self._text('{s}Reason/{s}Text')
+
+    def subcode(self):
+        return self._text('{s}Code/{s}Subcode/{s}Value')
+
+    def detail(self):
+        detail = self.element.find('{%s}Detail' % NAMESPACES['soap'])
+        if detail is None:
+            return None
+        return ''.join(detail.itertext()).strip() or None
+
+
+class _Node(object):
+    def __init__(self, xml):
+        self.xml = xml
+
+    def string(self):
+        return self.xml
+
+
+class XmlDoc(object):
+    '''
+    A parsed response envelope, exposing the subset of pywsman's XmlDoc
+    interface that wry uses, so that WryDict and WSManFault can be built
+    from it unchanged.
+    '''
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.element = ElementTree.fromstring(xml)
+
+    def root(self):
+        return _Node(self.xml)
+
+    def body(self):
+        return _Node(self.xml)
+
+    def _fault_element(self):
+        return self.element.find('{s}Body/{s}Fault'.format(s='{%s}' % NAMESPACES['soap']))
+
+    def is_fault(self):
+        return self._fault_element() is not None
+
+    def fault(self):
+        return _Fault(self._fault_element())
+
+    def __str__(self):
+        return self.xml
+
+
+class DigestAuth(object):
+    '''
+    HTTP digest authentication (RFC 2617), as used by AMT.
+
+    Once a challenge has been received, an Authorization header can be
+    generated for each subsequent request without another round trip.
+    '''
+
+    _PARAMETER = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = {}
+        self.nonce_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return 'nonce' in self.challenge
+
+    def update(self, header):
+        '''
+        Store the parameters of a WWW-Authenticate header.
+
+        :returns: True if the server only rejected the request because its nonce was stale.
+        '''
+        scheme, _, parameters = header.partition(' ')
+        if scheme.lower() != 'digest':
+            raise ValueError('Unsupported authentication scheme: %r' % scheme)
+        challenge = dict(
+            (match.group(1).lower(), match.group(2) if match.group(2) is not None else match.group(3))
+            for match in self._PARAMETER.finditer(parameters)
+        )
+        with self._lock:
+            self.challenge = challenge
+            self.nonce_count = 0
+        return challenge.get('stale', '').lower() == 'true'
+
+    def header(self, method, uri):
+        '''Return the value of an Authorization header for a request.'''
+        def md5(*parts):
+            return hashlib.md5(':'.join(parts)).hexdigest()
+        with self._lock:
+            challenge = self.challenge
+            self.nonce_count += 1
+            nonce_count = '%08x' % self.nonce_count
+        cnonce = os.urandom(8).encode('hex')
+        ha1 = md5(self.username, challenge.get('realm', ''), self.password)
+        ha2 = md5(method, uri)
+        qop = challenge.get('qop')
+        if qop:
+            qop = 'auth'
+            response = md5(ha1, challenge['nonce'], nonce_count, cnonce, qop, ha2)
+        else:
+            response = md5(ha1, challenge['nonce'], ha2)
+        fields = [
+            ('username', self.username),
+            ('realm', challenge.get('realm', '')),
+            ('nonce', challenge['nonce']),
+            ('uri', uri),
+            ('response', response),
+        ]
+        if 'opaque' in challenge:
+            fields.append(('opaque', challenge['opaque']))
+        output = 'Digest ' + ', '.join('%s="%s"' % field for field in fields)
+        if qop:
+            output += ', qop=%s, nc=%s, cnonce="%s"' % (qop, nonce_count, cnonce)
+        return output
+
+
+class HTTPParser(object):
+    '''
+    An incremental parser for a single HTTP/1.1 message, for use with
+    non-blocking sockets.
+
+    Feed it data as it arrives. Once complete is True, status (or method and
+    path, for requests), headers and body are available.
+    '''
+
+    def __init__(self, request=False):
+        self.request = request
+        self.complete = False
+        self.headers = {}
+        self.body = ''
+        self.status = self.reason = self.method = self.path = None
+        self._buffer = ''
+        self._state = 'head'
+        self._remaining = None
+
+    @property
+    def keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close'
+
+    def feed(self, data):
+        self._buffer += data
+        while not self.complete:
+            if not getattr(self, '_parse_' + self._state)():
+                break
+        return self.complete
+
+    def eof(self):
+        '''The connection was closed. Returns True if that completed the message.'''
+        if self._state == 'until_close':
+            self.body, self._buffer = self._buffer, ''
+            self.complete = True
+        return self.complete
+
+    def _parse_head(self):
+        head, separator, rest = self._buffer.partition('\r\n\r\n')
+        if not separator:
+            return False
+        self._buffer = rest
+        lines = head.split('\r\n')
+        first = lines[0].split(' ', 2)
+        if self.request:
+            self.method, self.path = first[0], first[1]
+        else:
+            self.status = int(first[1])
+            self.reason = first[2] if len(first) > 2 else ''
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._state = 'chunk_size'
+        elif 'content-length' in self.headers:
+            self._remaining = int(self.headers['content-length'])
+            self._state = 'length'
+        elif self.request or self.status in (204, 304) or self.status < 200:
+            self.complete = True
+        else:
+            self._state = 'until_close'
+        return True
+
+    def _parse_length(self):
+        if len(self._buffer) < self._remaining:
+            return False
+        self.body, self._buffer = self._buffer[:self._remaining], self._buffer[self._remaining:]
+        self.complete = True
+        return True
+
+    def _parse_chunk_size(self):
+        line, separator, rest = self._buffer.partition('\r\n')
+        if not separator:
+            return False
+        self._buffer = rest
+        self._remaining = int(line.split(';')[0].strip(), 16)
+        self._state = 'chunk' if self._remaining else 'trailer'
+        return True
+
+    def _parse_chunk(self):
+        if len(self._buffer) < self._remaining + 2:
+            return False
+        self.body += self._buffer[:self._remaining]
+        self._buffer = self._buffer[self._remaining + 2:]
+        self._state = 'chunk_size'
+        return True
+
+    def _parse_trailer(self):
+        line, separator, rest = self._buffer.partition('\r\n')
+        if not separator:
+            return False
+        self._buffer = rest
+        if not line:
+            self.complete = True
+        return True
+
+    def _parse_until_close(self):
+        return False
+
+
+def http_request(method, host, path, body='', headers=()):
+    '''Render an HTTP/1.1 request as a string.'''
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+    lines.extend('%s: %s' % header for header in headers)
+    lines.append('Content-Length: %d' % len(body))
+    return '\r\n'.join(lines) + '\r\n\r\n' + body